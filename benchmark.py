@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+import json
+import sys
+from scadasim.benchmark import SHAPES, run_suite
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Benchmark simulations of synthetic plants and print the results as JSON')
+    parser.add_argument('-s', '--shapes', help='Plant shapes to generate', nargs='+',
+                        default=sorted(SHAPES), choices=sorted(SHAPES))
+    parser.add_argument('-n', '--sizes', help='Number of stages of each plant', nargs='+',
+                        type=int, default=[10, 100, 1000])
+    parser.add_argument('-t', '--ticks', help='Ticks to measure', type=int, default=100)
+    parser.add_argument('-e', '--engine', help='Flow engine, e.g. vectorized', default=None)
+    parser.add_argument('-p', '--processes', help='Worker processes', type=int, default=None)
+    parser.add_argument('-r', '--rpc-seconds', help='Seconds spent measuring RPC reads',
+                        type=float, default=1.0)
+    parser.add_argument('-o', '--output', help='Write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = run_suite(args.shapes, args.sizes, ticks=args.ticks, engine=args.engine,
+                        processes=args.processes, rpc_seconds=args.rpc_seconds)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write('\n')
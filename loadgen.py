@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import json
+import sys
+from scadasim.loadgen import PROTOCOLS, run_load, check
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Poll the PLCs of a config with virtual PLC clients and print a load report as JSON')
+    parser.add_argument('-c', '--config', help='YAML configuration file of the PLCs to poll', required=True)
+    parser.add_argument('-n', '--clients', help='Virtual PLC clients', type=int, default=10)
+    parser.add_argument('-r', '--scan-rate', help='Scans per second of each client', type=float, default=10)
+    parser.add_argument('-w', '--write-ratio', help='Share of scans writing a coil or register',
+                        type=float, default=0.1)
+    parser.add_argument('-t', '--seconds', help='Duration of the run', type=float, default=10)
+    parser.add_argument('-P', '--protocol', help='Transport to poll', choices=PROTOCOLS, default='binary')
+    parser.add_argument('-a', '--address', help='host:port of a running simulation, '
+                        'the config is simulated locally otherwise')
+    parser.add_argument('-p', '--processes', help='Client processes', type=int, default=None)
+    parser.add_argument('-e', '--engine', help='Flow engine of the local simulation, e.g. vectorized', default=None)
+    parser.add_argument('--max-error-rate', help='Fail when the error rate is above this', type=float, default=0.0)
+    parser.add_argument('--max-p99-ms', help='Fail when a p99 latency is above this', type=float, default=None)
+    parser.add_argument('-o', '--output', help='Write the report to this file instead of stdout')
+    args = parser.parse_args()
+
+    address = None
+    if args.address:
+        host, port = args.address.rsplit(':', 1)
+        address = (host, int(port))
+    result = run_load(args.config, clients=args.clients, scan_rate=args.scan_rate, write_ratio=args.write_ratio,
+                      seconds=args.seconds, protocol=args.protocol, address=address, processes=args.processes,
+                      engine=args.engine)
+    result['failures'] = check(result, args.max_error_rate, args.max_p99_ms)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(result, output, indent=2, sort_keys=True)
+    output.write('\n')
+    sys.exit(1 if result['failures'] else 0)
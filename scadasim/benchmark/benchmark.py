@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import itertools
+import platform
+import resource
+import tempfile
+import logging
+import math
+import time
+import os
+from scadasim import Simulator
+from scadasim.rpc import BinaryRPCServer, BinaryRPCClient
+
+log = logging.getLogger('scadasim')
+
+
+class PlantBuilder(object):
+    """Assemble a synthetic plant and render it in the `default_config.yml` schema.
+        Each stage is a valve and a pump feeding a tank, with a state sensor on the
+        valve and the pump and a volume sensor on the tank.
+    """
+
+    def __init__(self):
+        self.devices = []
+        self.connections = {}
+        self.sensors = []
+        self.counter = itertools.count()
+
+    def add(self, kind, fields=''):
+        label = '%s%s' % (kind, next(self.counter))
+        self.devices.append("  - !%s\n    label: %s\n%s" % (kind, label, fields))
+        return label
+
+    def connect(self, source, destination):
+        self.connections.setdefault(source, []).append(destination)
+
+    def sensor(self, kind, device):
+        label = '%s_sensor' % device
+        self.sensors.append((label, kind, device))
+        return label
+
+    def reservoir(self, volume=1000):
+        return self.add('reservoir', "    volume: %s\n    fluid: !water {}\n" % volume)
+
+    def stage(self, source):
+        """Add a valve -> pump -> tank stage drawing from `source`. Returns the tank"""
+        valve = self.add('valve', "    state: 'open'\n")
+        pump = self.add('pump', "    state: 'on'\n")
+        tank = self.add('tank')
+        self.connect(source, valve)
+        self.connect(valve, pump)
+        self.connect(pump, tank)
+        self.sensor('state', valve)
+        self.sensor('state', pump)
+        self.sensor('volume', tank)
+        return tank
+
+    def to_yaml(self, sensors_per_plc=16):
+        """Render the plant. Sensors are registered with PLCs of `sensors_per_plc` sensors,
+            states as coils and volumes as input registers
+        """
+        lines = ["settings:\n  speed: 1\n\ndevices:\n"]
+        lines.extend(self.devices)
+        lines.append("\nconnections:\n")
+        for source in sorted(self.connections):
+            lines.append("  %s:\n    outputs:\n" % source)
+            lines.extend("     - %s\n" % destination for destination in self.connections[source])
+        lines.append("\nsensors:\n")
+        for label, kind, device in self.sensors:
+            lines.append("  - !%s\n    label: %s\n    connected_to: %s\n" % (kind, label, device))
+        lines.append("\nplcs:\n")
+        for plc in range(0, len(self.sensors), sensors_per_plc):
+            # Modbus unit ids range from 1 to 247
+            lines.append("  plc%s:\n    slaveid: %s\n    sensors:\n" % (plc // sensors_per_plc, plc // sensors_per_plc % 247 + 1))
+            addresses = {'c': 0, 'i': 0}
+            for label, kind, device in self.sensors[plc:plc + sensors_per_plc]:
+                register_type = 'c' if kind == 'state' else 'i'
+                lines.append("      %s:\n          register_type: %s\n          data_address: %s\n" % (
+                    label, register_type, addresses[register_type]))
+                addresses[register_type] += 1
+        return ''.join(lines)
+
+
+def chain(size):
+    """One reservoir feeding `size` stages in series"""
+    plant = PlantBuilder()
+    tank = plant.reservoir()
+    for _ in range(size):
+        tank = plant.stage(tank)
+    return plant
+
+def tree(size, fanout=2):
+    """One reservoir feeding a tree of `size` stages, each tank feeding `fanout` stages"""
+    plant = PlantBuilder()
+    sources = [plant.reservoir()]
+    for stage in range(size):
+        sources.append(plant.stage(sources[stage // fanout]))
+    return plant
+
+def mesh(size):
+    """A grid of about `size` tanks. Each tank feeds its right and lower neighbours,
+        so flows split and merge
+    """
+    plant = PlantBuilder()
+    side = max(1, int(math.ceil(math.sqrt(size))))
+    tanks = {}
+    for row in range(side):
+        for column in range(side):
+            if not row and not column:
+                tanks[0, 0] = plant.stage(plant.reservoir())
+                continue
+            # Feed from the left neighbour, then join the flow from the upper one
+            tank = plant.stage(tanks[row, column - 1] if column else tanks[row - 1, column])
+            if row and column:
+                upper = plant.add('pump', "    state: 'on'\n")
+                plant.connect(tanks[row - 1, column], upper)
+                plant.connect(upper, tank)
+            tanks[row, column] = tank
+    return plant
+
+def plcs(size):
+    """`size` independent sites of one stage, each with its own PLC"""
+    plant = PlantBuilder()
+    for _ in range(size):
+        plant.stage(plant.reservoir())
+    return plant
+
+SHAPES = {'chain': chain, 'tree': tree, 'mesh': mesh, 'plcs': plcs}
+
+def generate(shape, size):
+    """YAML config of a synthetic plant of `shape` (see `SHAPES`) and `size` stages"""
+    sensors_per_plc = 3 if shape == 'plcs' else 16
+    return SHAPES[shape](size).to_yaml(sensors_per_plc=sensors_per_plc)
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """Nearest-rank percentiles of `samples`, plus the max"""
+    ordered = sorted(samples)
+    result = dict(('p%s' % point, ordered[max(0, int(math.ceil(point / 100.0 * len(ordered))) - 1)]) for point in points)
+    result['max'] = ordered[-1]
+    return result
+
+def rss_kb():
+    """Peak resident set size of this process in KB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_benchmark(path, ticks=100, engine=None, processes=None, rpc_seconds=1.0):
+    """Load `path` as a fixed-step simulation and measure startup time, ticks per second,
+        per-tick latency, peak RSS (of this process, not of partition workers) and
+        binary RPC reads per second. Returns a dict of results
+    """
+    started = time.time()
+    sim = Simulator(realtime=False, engine=engine, processes=processes)
+    sim.load_yml(path)
+    result = {'startup_s': time.time() - started,
+              'devices': len(sim.devices), 'sensors': len(sim.sensors), 'plcs': len(sim.plcs)}
+
+    # The first step activates every device, keep it out of the tick latencies
+    started = time.time()
+    sim.step()
+    result['first_tick_s'] = time.time() - started
+
+    latencies = []
+    for _ in range(ticks):
+        started = time.time()
+        sim.step()
+        latencies.append(time.time() - started)
+    result['ticks_per_s'] = ticks / sum(latencies)
+    result['tick_latency_ms'] = dict((key, value * 1000) for key, value in percentiles(latencies).items())
+
+    if sim.plcs and rpc_seconds:
+        result['rpc'] = measure_rpc(sim, rpc_seconds)
+    result['rss_kb'] = rss_kb()
+
+    if sim.partitions:
+        sim.partitions.close()
+    return result
+
+def measure_rpc(sim, seconds=1.0):
+    """Single and bulk reads per second over one binary RPC connection"""
+    server = BinaryRPCServer(sim, host='127.0.0.1', port=0)
+    server.start()
+    client = BinaryRPCClient(server.address)
+    plc = sorted(sim.plcs)[0]
+    sensor = sim.plc_sensors(plc)[0]
+    try:
+        result = {}
+        for name, call in [('reads_per_s', lambda: client.read_sensor(plc, sensor)),
+                           ('bulk_reads_per_s', lambda: client.read_sensors(plc))]:
+            count = 0
+            deadline = time.time() + seconds / 2.0
+            while time.time() < deadline:
+                call()
+                count += 1
+            result[name] = count / (seconds / 2.0)
+        result['sensors_per_bulk_read'] = len(sim.plc_sensors(plc))
+        return result
+    finally:
+        client.close()
+        server.stop_server()
+
+def _run_case(case, results):
+    """Generate and benchmark one case, sending the result to the `results` connection"""
+    try:
+        results.send(run_case(*case))
+    except Exception as e:
+        log.exception("Benchmark of %s %s failed" % case[:2])
+        results.send({'shape': case[0], 'size': case[1], 'error': '%s: %s' % (e.__class__.__name__, e)})
+
+def run_case(shape, size, options):
+    """Generate and benchmark one case in the current process"""
+    fd, path = tempfile.mkstemp(suffix='.yml', prefix='scadasim-%s-%s-' % (shape, size))
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            stream.write(generate(shape, size))
+        result = run_benchmark(path, **options)
+    finally:
+        os.unlink(path)
+    result.update(shape=shape, size=size, engine=options.get('engine'), processes=options.get('processes'))
+    return result
+
+def run_suite(shapes, sizes, **options):
+    """Benchmark every shape at every size, each case in a fresh process so
+        RSS and startup are measured in isolation. `options` go to `run_benchmark()`.
+        Returns a dict with the environment and the list of results
+    """
+    results = []
+    for shape in shapes:
+        for size in sizes:
+            # Not a Pool: the case may start partition worker processes of its own
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_case, args=((shape, size, options), writer))
+            process.start()
+            writer.close()
+            try:
+                result = reader.recv()
+            except EOFError:
+                result = None
+            process.join()
+            if result is None:
+                # The worker died before sending its result
+                result = {'shape': shape, 'size': size, 'error': 'exit code %s' % process.exitcode}
+            results.append(result)
+            log.info("Benchmarked %s %s" % (shape, size))
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(), 'time': time.time(), 'results': results}
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+import cPickle as pickle
+import logging
+import struct
+import array
+import math
+import zlib
+import sys
+import os
+from scadasim.devices import COMPOSITION_FIELDS
+
+log = logging.getLogger('scadasim')
+
+MAGIC = 'SCADACKP'
+VERSION = 2
+
+# Layout of a checkpoint, all little-endian:
+#   header      magic, version, time and tick of the clock, step size (0 for a realtime clock),
+#               device count, sensor count, size of the labels block, size of the meta block
+#   labels      zlib compressed labels of the devices then the sensors, separated by newlines
+#   meta        pickled dict: fluid table, PLC registration flags, queued sensor writes,
+#               run of the flow engine and the values that don't fit in the columns
+#   columns     one entry per device then per sensor, each column stored whole:
+#               volume kind (uint8), volume (float64), state kind (uint8), state (float64),
+#               fluid (int32 index in the fluid table, -1 for none), active (uint8),
+#               next run in seconds from the clock (float64, NaN when not queued),
+#               pH, temperature and salinity of the contents (float64, NaN when unknown)
+_header = struct.Struct('<8sIdQdIIII')
+
+# Kinds of the volume and state values. OTHER values are pickled in the meta block
+NONE, FALSE, TRUE, INT, FLOAT, OTHER = range(6)
+_kinds = {type(None): NONE, int: INT, long: INT, float: FLOAT}
+
+_columns = (('volume_kinds', 'B'), ('volumes', 'd'), ('state_kinds', 'B'), ('states', 'd'),
+            ('fluids', 'i'), ('active', 'B'), ('next_runs', 'd')) + tuple((name, 'd') for name in COMPOSITION_FIELDS)
+
+
+class CheckpointError(Exception):
+        """Exception thrown when a checkpoint can't be read or doesn't fit the simulation
+        """
+        def __init__(self, message):
+            super(CheckpointError, self).__init__(message)
+
+
+class Checkpoint(object):
+    """State of a simulation: tank volumes and compositions, device states, fluids, sensor
+        values, PLC registration flags, queued runs and writes and the clock. See `write_checkpoint()`.
+        Read a checkpoint once and `apply()` it to as many simulators as needed, e.g. to
+        fork what-if runs from one warmed up plant.
+    """
+
+    def __init__(self, time, tick, step_size, device_labels, sensor_labels, meta, columns):
+        self.time = time
+        self.tick = tick
+        self.step_size = step_size
+        self.device_labels = device_labels
+        self.sensor_labels = sensor_labels
+        self.meta = meta
+        self.columns = columns
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as stream:
+            data = stream.read()
+        if len(data) < _header.size:
+            raise CheckpointError("%s is not a scadasim checkpoint" % path)
+        magic, version, time, tick, step_size, devices, sensors, labels_size, meta_size = _header.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise CheckpointError("%s is not a version %s scadasim checkpoint" % (path, VERSION))
+
+        offset = _header.size
+        labels = zlib.decompress(data[offset:offset + labels_size])
+        labels = labels.split('\n') if labels else []
+        offset += labels_size
+        meta = pickle.loads(data[offset:offset + meta_size])
+        offset += meta_size
+
+        count = devices + sensors
+        columns = {}
+        for name, typecode in _columns:
+            column = array.array(typecode)
+            size = column.itemsize * count
+            column.fromstring(data[offset:offset + size])
+            columns[name] = _little_endian(column)
+            offset += size
+        if offset != len(data) or len(labels) != count:
+            raise CheckpointError("%s is truncated" % path)
+        return cls(time, tick, step_size, labels[:devices], labels[devices:], meta, columns)
+
+    def apply(self, simulator):
+        """Restore the state onto `simulator`, matching devices and sensors by label.
+            Devices the checkpoint doesn't know keep their state.
+        """
+        scheduler = simulator.scheduler
+        # Queued runs are only restored between fixed-step clocks, a realtime clock
+        # schedules the devices again when they are activated
+        fixed_step = not simulator.realtime and self.step_size > 0
+        if fixed_step and abs(self.step_size - scheduler.step_size) > 1e-9:
+            raise CheckpointError("The checkpoint was taken with a step size of %s, not %s" % (
+                self.step_size, scheduler.step_size))
+
+        columns = self.columns
+        extras = self.meta['extras']
+        fluids = _shared_fluids(self.meta['fluids'], simulator)
+        volumes = _decode(columns['volume_kinds'], columns['volumes'], extras, 'volume')
+        states = _decode(columns['state_kinds'], columns['states'], extras, 'state')
+
+        with scheduler.lock:
+            scheduler.ticks = self.tick
+            if fixed_step:
+                # Runs are queued again from the checkpoint below
+                scheduler.clear()
+            now = scheduler.now()
+            runs = []
+            missing = 0
+            for offset, labels, targets in ((0, self.device_labels, simulator.devices),
+                                            (len(self.device_labels), self.sensor_labels, simulator.sensors)):
+                for i, label in enumerate(labels, offset):
+                    device = targets.get(label)
+                    if device is None:
+                        missing += 1
+                        continue
+                    if hasattr(type(device), 'volume'):
+                        device.volume = volumes[i]
+                    device.state = states[i]
+                    fluid = columns['fluids'][i]
+                    device.fluid = fluids[fluid] if fluid >= 0 else None
+                    for name in COMPOSITION_FIELDS:
+                        if hasattr(type(device), name):
+                            value = columns[name][i]
+                            setattr(device, name, None if math.isnan(value) else value)
+                    if fixed_step:
+                        device.active = bool(columns['active'][i])
+                        if not math.isnan(columns['next_runs'][i]):
+                            runs.append((device, now + columns['next_runs'][i]))
+            if missing:
+                log.warning("%s devices and sensors of the checkpoint are not in the simulation" % missing)
+
+            engine = simulator.engine
+            if engine and fixed_step and self.meta['engine'] is not None:
+                engine.active, next_run = self.meta['engine']
+                if next_run is not None:
+                    runs.append((engine, now + next_run))
+            scheduler.queue(runs)
+
+            for label, registered in self.meta['plcs'].iteritems():
+                if label in simulator.plcs:
+                    simulator.plcs[label]['registered'] = registered
+            simulator.pending_writes.clear()
+            simulator.pending_writes.extend(self.meta['writes'])
+            if fixed_step:
+                simulator.active = any(columns['active'])
+
+            # Sensors were updated through their devices, publish them all at once
+            simulator.changed_sensors = set()
+            simulator.snapshot = None
+            simulator.publish_snapshot()
+
+
+def write_checkpoint(simulator, path):
+    """Save the state of `simulator` into a checkpoint file at `path`. See `Checkpoint`"""
+    scheduler = simulator.scheduler
+    with scheduler.lock:
+        now = scheduler.now()
+        queued = scheduler.queued()
+        device_labels = simulator.devices.keys()
+        sensor_labels = simulator.sensors.keys()
+        nodes = simulator.devices.values() + simulator.sensors.values()
+
+        extras = {}
+        volume_kinds, volumes = _encode([getattr(node, 'volume', None) for node in nodes], extras, 'volume')
+        state_kinds, states = _encode([node.state for node in nodes], extras, 'state')
+
+        fluid_table = []
+        fluid_ids = {}
+        fluids = array.array('i', [-1]) * len(nodes)
+        for i, node in enumerate(nodes):
+            fluid = node.fluid
+            if fluid is not None:
+                if id(fluid) not in fluid_ids:
+                    fluid_ids[id(fluid)] = len(fluid_table)
+                    fluid_table.append(fluid)
+                fluids[i] = fluid_ids[id(fluid)]
+
+        nan = float('nan')
+        columns = {
+            'volume_kinds': volume_kinds, 'volumes': volumes, 'state_kinds': state_kinds, 'states': states,
+            'fluids': fluids,
+            'active': array.array('B', [bool(node.active) for node in nodes]),
+            'next_runs': array.array('d', [queued[node] - now if node in queued else nan for node in nodes])}
+        for name in COMPOSITION_FIELDS:
+            values = [getattr(node, name, None) for node in nodes]
+            columns[name] = array.array('d', [nan if value is None else value for value in values])
+
+        engine = simulator.engine
+        meta = {
+            'fluids': fluid_table,
+            'plcs': dict((label, plc.get('registered', False)) for label, plc in (simulator.plcs or {}).iteritems()),
+            'writes': list(simulator.pending_writes),
+            'engine': (engine.active, queued[engine] - now if engine in queued else None) if engine else None,
+            'extras': extras}
+        step_size = 0.0 if simulator.realtime else scheduler.step_size
+        tick = scheduler.ticks
+
+    labels = zlib.compress('\n'.join(device_labels + sensor_labels), 1)
+    meta = pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as stream:
+        stream.write(_header.pack(MAGIC, VERSION, now, tick, step_size, len(device_labels), len(sensor_labels),
+                                  len(labels), len(meta)))
+        stream.write(labels)
+        stream.write(meta)
+        for name, typecode in _columns:
+            stream.write(_little_endian(columns[name]).tostring())
+    os.rename(tmp_path, path)
+
+def read_checkpoint(path):
+    """Read the checkpoint at `path`. Returns a `Checkpoint`"""
+    return Checkpoint.read(path)
+
+
+def _encode(values, extras, column):
+    """Kind and float64 columns of `values`. Values of other kinds go into `extras`"""
+    kinds = array.array('B', [NONE]) * len(values)
+    numbers = array.array('d', [0.0]) * len(values)
+    for i, value in enumerate(values):
+        kind = _kinds.get(type(value), OTHER)
+        if value is True:
+            kind = TRUE
+        elif value is False:
+            kind = FALSE
+        elif kind == INT and abs(value) >= 2 ** 53:
+            kind = OTHER
+        if kind == INT or kind == FLOAT:
+            numbers[i] = value
+        elif kind == OTHER:
+            extras[column, i] = value
+        kinds[i] = kind
+    return kinds, numbers
+
+def _decode(kinds, numbers, extras, column):
+    values = [None] * len(kinds)
+    for i, kind in enumerate(kinds):
+        if kind == FLOAT:
+            values[i] = numbers[i]
+        elif kind == INT:
+            values[i] = int(numbers[i])
+        elif kind == TRUE:
+            values[i] = True
+        elif kind == FALSE:
+            values[i] = False
+        elif kind == OTHER:
+            values[i] = extras[column, i]
+    return values
+
+def _shared_fluids(fluids, simulator):
+    """Use the fluids of `simulator` in place of equal fluids of a checkpoint, so devices keep sharing them"""
+    existing = {}
+    for node in simulator.devices.values() + simulator.sensors.values():
+        if node.fluid is not None:
+            existing.setdefault(_fluid_key(node.fluid), node.fluid)
+    return [existing.get(_fluid_key(fluid), fluid) for fluid in fluids]
+
+def _fluid_key(fluid):
+    return (type(fluid), fluid.fluid_type, fluid.ph, fluid.temperature, fluid.salinity, fluid.pressure, fluid.flowrate)
+
+def _little_endian(column):
+    if sys.byteorder == 'big':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column
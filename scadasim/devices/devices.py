@@ -1,26 +1,126 @@
 #!/usr/bin/env python
 
-import threading
 import logging
-import uuid
-from datetime import datetime
+import itertools
 import yaml
-import time
+from scadasim.scheduler import default_scheduler
+from scadasim.fluids import mix, mix_ph
 
 log = logging.getLogger('scadasim')
 
+# Integer ids shared by all devices
+_uids = itertools.count(1)
+
+# Fields of the devices holding fluid that describe what they hold, None when unknown.
+# Mixed by volume as fluid flows, see `Tank.mix_in()`
+COMPOSITION_FIELDS = ('ph', 'temperature', 'salinity')
+
+def reserve_uids(uid):
+    """Make sure devices created from now on get uids above `uid`, e.g. after unpickling devices"""
+    global _uids
+    _uids = itertools.count(max(uid + 1, next(_uids)))
+
 class InvalidDevice(Exception):
         """Exception thrown for bad device types
         """
         def __init__(self, message):
             super(InvalidDevice, self).__init__(message)
 
+class FlowVersion(object):
+    """Counters bumped whenever the connections or gate states of one graph of devices change.
+        Cached flow paths are rebuilt when the counters they were built with are out of date.
+        Connecting two graphs merges their versions, so a change only rebuilds the caches
+        of its own graph, not those of other graphs or of other simulations.
+    """
+    __slots__ = ('connections', 'states', 'merged_into')
+
+    def __init__(self):
+        self.connections = 0
+        self.states = 0
+        # Version of the graph this one was merged into
+        self.merged_into = None
+
+    def resolve(self):
+        """Version of the graph now, following merges"""
+        version = self
+        while version.merged_into is not None:
+            version = version.merged_into
+        return version
+
+    def merge(self, other):
+        """Make the graph of `other` share this version. Returns this version"""
+        if other is not self:
+            other.merged_into = self
+            # Counters only move forward, so caches built with either version are out of date
+            self.connections = max(self.connections, other.connections) + 1
+            self.states = max(self.states, other.states) + 1
+        return self
+
+def _state_changed(device):
+    if device.gated:
+        device.flow_version().states += 1
+
+class Field(object):
+    """Device attribute that lives on the device itself, or in the arrays of
+        a flow engine once the device has been bound to one
+        `on_change` is called with the device every time the attribute changes
+    """
+    def __init__(self, name, on_change=None):
+        self.name = name
+        self.attribute = '_' + name
+        self.on_change = on_change
+
+    def __get__(self, device, cls):
+        if device is None:
+            return self
+        if device.engine is not None:
+            return device.engine.get(self.name, device.engine_index)
+        return getattr(device, self.attribute)
+
+    def __set__(self, device, value):
+        changed = (device.observers or self.on_change) and self.__get__(device, None) != value
+        if device.engine is not None:
+            device.engine.set(self.name, device.engine_index, value)
+        else:
+            setattr(device, self.attribute, value)
+        if changed:
+            if self.on_change:
+                self.on_change(device)
+            if device.observers:
+                device.changed(self.name)
+
 # Devices
 class Device(yaml.YAMLObject):
     allowed_device_types = ['pump', 'valve', 'filter', 'tank', 'reservoir', 'sensor', 'chlorinator']
 
-    def __init__(self, device_type=None, fluid=None, label='', state=None, worker_frequency=1):
-        self.uid = str(uuid.uuid4())[:8]
+    # How fluid moves through this device when tracing flow paths
+    stores_fluid = False        # Source or destination of fluid, e.g. a tank
+    passes_upstream = False     # Lets a downstream device pull fluid through it
+    passes_downstream = False   # Lets an upstream device push fluid through it
+    gated = False               # Only passes fluid while `state` is True
+
+    # Devices only keep these attributes, to stay small in large simulations.
+    # Subclasses without __slots__ get a regular __dict__.
+    __slots__ = ('uid', 'device_type', 'label', 'inputs', 'outputs', '_fluid', '_state', 'active',
+                 'worker_frequency', 'speed', 'scheduler', 'engine', 'engine_index', 'observers', 'capacity',
+                 'profile', '_flow_version')
+
+    fluid = Field('fluid')
+    state = Field('state', on_change=_state_changed)
+
+    def __init__(self, device_type=None, fluid=None, label='', state=None, worker_frequency=1, capacity=None):
+        # Set when a flow engine stores this device's fields in its arrays
+        self.engine = None
+        self.engine_index = None
+        # Notified through `device_changed(device, name)` when a field changes
+        self.observers = ()
+        # Created on first use, see `flow_version()`
+        self._flow_version = None
+        self._state = None
+        # Stats counting the calls fluid makes to this device while profiled, see `profiler.Profiler`
+        self.profile = None
+
+        self.uid = next(_uids)
         self.device_type = device_type
         self.label = label
         self.inputs = {}
@@ -31,22 +131,46 @@ class Device(yaml.YAMLObject):
         self.worker_frequency = worker_frequency
         self.speed = 1
         self.state = state
+        # Most volume that can flow through the device per tick, None for no limit.
+        # Read when flow paths are traced and when a flow engine is compiled
+        self.capacity = capacity
+        # Drives the worker loop. The Simulator replaces this with its own scheduler
+        self.scheduler = default_scheduler
 
         if (not self.device_type) or (self.device_type not in self.allowed_device_types):
             raise InvalidDevice("\'%s\' in not a valid device type" % self.device_type)
 
         log.info("%s: Initialized" % self)
 
+    # Attributes tied to the running simulation, which are not pickled
+    transient = ('scheduler', 'engine', 'engine_index', 'profile')
+
     @classmethod
     def from_yaml(cls, loader, node):
         fields = loader.construct_mapping(node, deep=False)
         return cls(**fields)
 
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name not in self.transient and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name in self.transient:
+            setattr(self, name, None)
+        self.scheduler = default_scheduler
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def add_input(self, device):
         """Add the connected `device` to our inputs and add this device to the connected device's outputs
         """
         if device.uid not in self.inputs:
             self.inputs[device.uid] = device
+            self.flow_version().merge(device.flow_version()).connections += 1
             device.add_output(self)
             log.info("%s: Added input <- %s" % (self, device))
 
@@ -55,29 +179,75 @@ class Device(yaml.YAMLObject):
         """
         if device.uid not in self.outputs:
             self.outputs[device.uid] = device
+            self.flow_version().merge(device.flow_version()).connections += 1
             device.add_input(self)
             log.info("%s: Added output -> %s" % (self, device))
 
+    def remove_input(self, device):
+        """Disconnect `device` from our inputs and this device from its outputs
+        """
+        if device.uid in self.inputs:
+            del self.inputs[device.uid]
+            self.flow_version().connections += 1
+            device.remove_output(self)
+            log.info("%s: Removed input <- %s" % (self, device))
+
+    def remove_output(self, device):
+        """Disconnect `device` from our outputs and this device from its inputs
+        """
+        if device.uid in self.outputs:
+            del self.outputs[device.uid]
+            self.flow_version().connections += 1
+            device.remove_input(self)
+            log.info("%s: Removed output -> %s" % (self, device))
+
+    def flow_version(self):
+        """`FlowVersion` of the graph of connected devices this device is part of.
+            A graph split by removed connections keeps sharing its version
+        """
+        version = self._flow_version
+        if version is None:
+            version = self._flow_version = FlowVersion()
+        elif version.merged_into is not None:
+            version = self._flow_version = version.resolve()
+        return version
+
+    def add_observer(self, observer):
+        """Call `observer.device_changed(self, name)` whenever the volume, state or fluid
+            of this device changes, `name` being the field that changed
+        """
+        if not self.observers:
+            self.observers = []
+        if observer not in self.observers:
+            self.observers.append(observer)
+        if self.engine is not None:
+            self.engine.watch(self)
+
+    def remove_observer(self, observer):
+        if observer in self.observers:
+            self.observers.remove(observer)
+
+    def changed(self, name):
+        """Notify the observers that field `name` changed"""
+        for observer in self.observers:
+            observer.device_changed(self, name)
+
     def run(self):
         """Executed at atleast once and at regular intervals if `worker_frequency` is not None.
             Used to call worker method
         """
         if self.active:
-            log.debug("%s %s" % (self, datetime.now()))
             self.worker()
-        
+
             if self.worker_frequency:
-                # Calculate the next run time based on simulation speed and device frequency
-                delay = (-time.time()%(self.speed*self.worker_frequency))
-                t = threading.Timer(delay, self.run)
-                t.daemon = True
-                t.start()
+                # Let the scheduler work out the next run time based on simulation speed and device frequency
+                self.scheduler.schedule(self)
 
     def activate(self):
         """Set this device as active so the worker gets called"""
         if self.active == False:
             self.active = True
-            self.run()
+            self.scheduler.add(self)
         log.info("%s: Active" % self)
 
     def deactivate(self):
@@ -109,45 +279,137 @@ class Device(yaml.YAMLObject):
         """
         return 0
 
+    def receive(self, fluid, volume, source):
+        """Receive `volume` of `fluid` flowing from `source`, whose `ph`, `temperature` and
+            `salinity` give the composition of the fluid. `source` is a device or the fluid itself.
+            Override this to follow the composition, the default calls `input()`
+        """
+        return self.input(fluid, volume)
+
     def output(self):
         """Receive and process some fluid
             Override this with your own processing to perform when fluid is outputted
         """
         return 0
 
+    def pass_fluid(self, fluid):
+        """Called when `fluid` flows through this device along a cached flow path
+            Override this if a pass-through device needs to see the fluid, e.g. sensors
+        """
+        pass
+
+    def pass_stream(self, fluid, source):
+        """Called when `fluid` flows from `source` through this device along a cached flow path,
+            see `receive()`. Override this to see the composition, the default calls `pass_fluid()`
+        """
+        self.pass_fluid(fluid)
+
     def __repr__(self):
         return "[%s][%s][%s]" % (self.uid, self.device_type, self.label)
 
 
 class Pump(Device):
     yaml_tag = u'!pump'
+    passes_downstream = True
+    gated = True
+
+    __slots__ = ('_paths', '_paths_version', '_open_paths', '_open_paths_version', '_draws', '_outlet_capacities')
+    transient = Device.transient + __slots__
 
     def __init__(self, device_type='pump', state='off', **kwargs):
         state = bool(['off', 'on'].index(state))
+        self._paths = None
+        self._paths_version = None
+        self._open_paths = None
+        self._open_paths_version = None
+        # Volume drawn from each open source per run and capacity of each open outlet
+        self._draws = None
+        self._outlet_capacities = None
         super(Pump, self).__init__(device_type=device_type, state=state, **kwargs)
 
+    def flow_paths(self):
+        """Every path fluid can take through this pump as (upstream, downstream) lists
+            of (tank, receivers, gates, capacity, path), where receivers are the devices along the
+            path that see the fluid through `pass_fluid()`, capacity is the smallest capacity
+            along the path, None for no limit, and path every device the fluid passes through.
+            Traced once and reused until the connections change.
+        """
+        version = self.flow_version()
+        if self._paths_version != version.connections:
+            self._paths = tuple([(tank, [d for d in path if _sees_fluid(d)], [d for d in path if d.gated],
+                                  path_capacity(path), path)
+                                 for tank, path in trace(self)]
+                                for trace in (trace_upstream, trace_downstream))
+            self._paths_version = version.connections
+            self._open_paths_version = None
+        return self._paths
+
+    def open_flow_paths(self):
+        """The flow paths whose valves and pumps are all open/on, as (upstream, downstream)
+            lists of (tank, receivers, capacity, path).
+            Reused until a connection or the state of a valve or pump changes.
+        """
+        flow_version = self.flow_version()
+        version = (flow_version.connections, flow_version.states)
+        if self._open_paths_version != version:
+            upstream, downstream = self._open_paths = tuple(
+                [(tank, receivers, capacity, path) for tank, receivers, gates, capacity, path in paths
+                 if all(g.state for g in gates)]
+                for paths in self.flow_paths())
+            self._outlet_capacities = [capacity for tank, receivers, capacity, path in downstream]
+            # Up to one unit of volume from each source, as much as the pump and its outlets can take
+            limit = _least(self.capacity, _total(self._outlet_capacities))
+            self._draws = [_least(1, capacity) for tank, receivers, capacity, path in upstream]
+            if limit is not None:
+                self._draws = split_volume(limit, self._draws)
+            self._open_paths_version = version
+        return self._open_paths
+
     def worker(self):
         """Manipulate the fluid just as this device would in the real world
+            Draws up to one unit of volume from each source, as much as the capacity of the
+            pump and of its open outlets allow. When bound to a flow engine, the engine moves
+            the fluid instead
         """
-        if self.state:
-            for i in self.inputs:
-                self.inputs[i].output(self)
+        if self.state and self.engine is None:
+            upstream = self.open_flow_paths()[0]
+            for (source, receivers, capacity, path), volume in zip(upstream, self._draws):
+                for device in receivers:
+                    device.pass_stream(source.fluid, source)
+                if volume > 0:
+                    if self.profile is not None:
+                        # Pulled through them, as `output()` would have been called along a pull
+                        _count_passes(path, 'outputs')
+                    draw(source, self, volume)
 
     def input(self, fluid, volume=1):
+        return self.receive(fluid, volume, fluid)
+
+    def receive(self, fluid, volume, source):
+        """Push `volume` of `fluid` into the open outlets, split by their capacity.
+            Returns the volume they accepted, the rest stays with the source
+        """
+        accepted_volume = 0
         if self.state:
             self.fluid = fluid
-            for o in self.outputs:
-                # Send fluid to all outputs
-                accepted_volume = self.outputs[o].input(fluid, volume)
-            return accepted_volume
-        else:
-            return 0
+            downstream = self.open_flow_paths()[1]
+            shares = split_volume(_least(volume, self.capacity), self._outlet_capacities)
+            for (destination, receivers, capacity, path), share in zip(downstream, shares):
+                for device in receivers:
+                    device.pass_stream(fluid, source)
+                if share > 0:
+                    if self.profile is not None:
+                        # Pushed through them, as `receive()` would have been called along a push
+                        _count_passes(path, 'inputs')
+                    accepted_volume += deliver(destination, fluid, share, source) or 0
+        return accepted_volume
+
+    def pass_fluid(self, fluid):
+        self.fluid = fluid
 
     def output(self, to_device, volume=1):
-        if self.state:
-            return self.fluid
-        else:
-            return 0
+        """Pumps only push, fluid can't be pulled through them"""
+        return 0
 
     def turn_on(self):
         self.state = True
@@ -158,6 +420,11 @@ class Pump(Device):
 
 class Valve(Device):
     yaml_tag = u'!valve'
+    passes_upstream = True
+    passes_downstream = True
+    gated = True
+
+    __slots__ = ()
 
     def __init__(self, device_type='valve', state='closed', **kwargs):
         state = bool(['closed', 'open'].index(state))
@@ -170,57 +437,63 @@ class Valve(Device):
         self.state = False
 
     def output(self, to_device, volume=1):
-        """If the valve is open, pull `volume` amount from connected devices
-            TODO: Handle multiple inputs and outputs. Distributing the volume across
-            all based on valve capacity.
+        """If the valve is open, pull `volume` amount from connected devices,
+            split across them by their capacity
         """
         if self.state:
-            available_volume = 0
-            for i in self.inputs:
-                available_volume = self.inputs[i].output(self, volume=volume)
-            return available_volume
+            return pull(self, volume)
         else:
             #log.debug("%s closed" % self)
             return 0
 
     def input(self, fluid, volume=1):
-        """If the valve is open, pass `volume` amount of `fluid` to the connected devices
-            Normally used when pump's push fluid through.
+        """If the valve is open, pass `volume` amount of `fluid` to the connected devices,
+            split across them by their capacity. Normally used when pump's push fluid through.
         """
         if self.state:
-            accepted_volume = 0
-            for o in self.outputs:
-                # Send the fluid on to all outputs
-                #log.debug("%s sending fluid to %s" % (self, self.outputs[o]))
-                accepted_volume = self.outputs[o].input(fluid, volume)
-            return accepted_volume
+            return push(self, fluid, volume, fluid)
         else:
             return 0
 
 class Filter(Device):
     yaml_tag = u'!filter'
+    passes_upstream = True
+    passes_downstream = True
+
+    __slots__ = ()
 
     def __init__(self, device_type='filter', **kwargs):
         super(Filter, self).__init__(device_type=device_type, **kwargs)
 
     def output(self, to_device, volume=1):
-        available_volume = 0
-        for i in self.inputs:
-            available_volume = self.inputs[i].output(self, volume=volume)
-        return available_volume
+        return pull(self, volume)
 
     def input(self, fluid, volume=1):
-        accepted_volume = 0
-        for o in self.outputs:
-            accepted_volume = self.outputs[o].input(fluid, volume)
-        return accepted_volume
+        return push(self, fluid, volume, fluid)
 
 class Tank(Device):
     yaml_tag = u'!tank'
+    stores_fluid = True
+
+    __slots__ = ('_volume', '_ph', '_temperature', '_salinity', 'max_volume')
 
-    def __init__(self, volume=0, device_type='tank', **kwargs):
-    	self.volume = volume
+    volume = Field('volume')
+    # Composition of the contents, see `COMPOSITION_FIELDS`
+    ph = Field('ph')
+    temperature = Field('temperature')
+    salinity = Field('salinity')
+
+    def __init__(self, volume=0, device_type='tank', ph=None, temperature=None, salinity=None, max_volume=None,
+                 **kwargs):
         super(Tank, self).__init__(device_type=device_type, **kwargs)
+        self.volume = volume
+        # Fluid that would take the tank over `max_volume` is refused and stays upstream
+        self.max_volume = max_volume
+        # Unless given, the contents are made of the fluid of the tank
+        fluid = self.fluid
+        self.ph = ph if ph is not None else getattr(fluid, 'ph', None)
+        self.temperature = temperature if temperature is not None else getattr(fluid, 'temperature', None)
+        self.salinity = salinity if salinity is not None else getattr(fluid, 'salinity', None)
 
     def __increase_volume(self, volume):
         """Raise the tank's volume by `volume`"""
@@ -243,21 +516,52 @@ class Tank(Device):
         return volume
 
     def __update_fluid(self, new_context):
-    	self.fluid = new_context
+        """An empty tank takes the fluid that arrives, otherwise it keeps its fluid
+            and the arriving fluid only changes the composition
+        """
+        if self.fluid is None or self.volume <= 0:
+            self.fluid = new_context
 
     def input(self, fluid, volume=1):
         """Receive `volume` amount of `fluid`"""
+        return self.receive(fluid, volume, fluid)
+
+    def receive(self, fluid, volume, source):
+        """Receive `volume` amount of `fluid` with the composition of `source`,
+            as much as fits under `max_volume`
+        """
+        if self.max_volume is not None:
+            volume = min(volume, max(self.max_volume - self.volume, 0))
+        if volume <= 0:
+            return 0
         self.__update_fluid(fluid)
+        self.mix_in(volume, source)
         accepted_volume = self.__increase_volume(volume)
         return accepted_volume
 
+    def mix_in(self, volume, source):
+        """Mix `volume` of fluid with the composition of `source` into the contents.
+            Temperature and salinity are averaged by volume, pH through the net acidity
+        """
+        # More of the same leaves the contents as they are, the common case
+        ph = getattr(source, 'ph', None)
+        if ph != self.ph:
+            self.ph = mix_ph(self.ph, self.volume, ph, volume)
+        temperature = getattr(source, 'temperature', None)
+        if temperature != self.temperature:
+            self.temperature = mix(self.temperature, self.volume, temperature, volume)
+        salinity = getattr(source, 'salinity', None)
+        if salinity != self.salinity:
+            self.salinity = mix(self.salinity, self.volume, salinity, volume)
+
     def output(self, to_device, volume=1):
         """Send `volume` amount of fluid to connected device
             This verifies that the connected device accepts the amount of volume before
             we decrease our volume. e.g. full tank.
         """
-        accepted_volume = to_device.input(self.fluid, self.__check_volume(volume))
+        accepted_volume = deliver(to_device, self.fluid, self.__check_volume(volume), self)
         self.__decrease_volume(accepted_volume)
+        return accepted_volume
 
     def worker(self):
         """For debugging only. Used to display the tank's volume"""
@@ -266,25 +570,180 @@ class Tank(Device):
 class Reservoir(Tank):
     yaml_tag = u'!reservoir'
 
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(Reservoir, self).__init__(device_type='reservoir', **kwargs)
 
 class Chlorinator(Tank):
     yaml_tag = u'!chlorinator'
+    stores_fluid = False
+    passes_upstream = True
+    passes_downstream = True
+
+    __slots__ = ()
 
     def __init__(self, device_type='chlorinator', **kwargs):
         super(Chlorinator, self).__init__(device_type=device_type, **kwargs)
 
     def output(self, to_device, volume=1):
-        available_volume = 0
-        for i in self.inputs:
-            available_volume = self.inputs[i].output(self, volume=volume)
-        return available_volume
+        return pull(self, volume)
 
     def input(self, fluid, volume=1):
+        return self.receive(fluid, volume, fluid)
+
+    def receive(self, fluid, volume, source):
+        self.pass_stream(fluid, source)
+        return push(self, fluid, volume, source)
+
+    def pass_fluid(self, fluid):
         self.fluid = fluid
-        accepted_volume = 0
-        for o in self.outputs:
-            accepted_volume = self.outputs[o].input(fluid, volume)
-        return accepted_volume
 
+    def pass_stream(self, fluid, source):
+        """Nothing is held back, so the chlorinator shows the stream passing through it.
+            The streams it doses mix in the tanks downstream.
+        """
+        self.fluid = fluid
+        self.ph = getattr(source, 'ph', None)
+        self.temperature = getattr(source, 'temperature', None)
+        self.salinity = getattr(source, 'salinity', None)
+
+
+
+def split_volume(volume, capacities):
+    """Shares of `volume` for outlets of `capacities` (None for no limit), in proportion
+        to how much of it each of them can take. The shares add up to less than `volume`
+        when the outlets can't take it all
+    """
+    if len(capacities) == 1 and capacities[0] is None:
+        return [volume]
+    weights = [_least(volume, capacity) for capacity in capacities]
+    total = sum(weights)
+    if total <= volume:
+        return weights
+    return [volume * weight / float(total) for weight in weights]
+
+def path_capacity(path):
+    """Smallest capacity of the devices along `path`, None for no limit"""
+    capacities = [device.capacity for device in path if device.capacity is not None]
+    return min(capacities) if capacities else None
+
+def push(device, fluid, volume, source):
+    """Send `volume` of `fluid` from `source` on to the outputs of `device`, split by their
+        capacity. Returns the volume they accepted
+    """
+    outputs = device.outputs.values()
+    shares = split_volume(_least(volume, device.capacity), [output.capacity for output in outputs])
+    accepted_volume = 0
+    for output, share in zip(outputs, shares):
+        if share > 0:
+            accepted_volume += deliver(output, fluid, share, source) or 0
+    return accepted_volume
+
+def pull(device, volume):
+    """Pull `volume` through `device` from its inputs, split by their capacity.
+        Returns the volume they sent
+    """
+    inputs = device.inputs.values()
+    shares = split_volume(_least(volume, device.capacity), [i.capacity for i in inputs])
+    available_volume = 0
+    for i, share in zip(inputs, shares):
+        if share > 0:
+            available_volume += draw(i, device, share) or 0
+    return available_volume
+
+def deliver(device, fluid, volume, source):
+    """`device.receive(fluid, volume, source)`, counted while the device is profiled"""
+    if device.profile is not None:
+        device.profile.inputs += 1
+    return device.receive(fluid, volume, source)
+
+def draw(device, to_device, volume):
+    """`device.output(to_device, volume)`, counted while the device is profiled"""
+    if device.profile is not None:
+        device.profile.outputs += 1
+    return device.output(to_device, volume)
+
+def _count_passes(path, counter):
+    """Count fluid passing through the profiled devices along a cached flow path"""
+    for device in path:
+        stats = device.profile
+        if stats is not None:
+            setattr(stats, counter, getattr(stats, counter) + 1)
+
+def _least(volume, limit):
+    """`volume` capped at `limit`, None being no limit"""
+    if limit is None or (volume is not None and volume <= limit):
+        return volume
+    return limit
+
+def _total(capacities):
+    """Sum of `capacities`, None if any of them has no limit"""
+    if None in capacities:
+        return None
+    return sum(capacities)
+
+def trace_upstream(device):
+    """Find every device that `device` can pull fluid from.
+        Returns a list of (source, path) where `path` lists the devices the fluid
+        passes through on the way, starting next to the source.
+    """
+    return _trace(device, 'inputs', 'passes_upstream')
+
+def trace_downstream(device):
+    """Find every device that `device` can push fluid into.
+        Returns a list of (destination, path) where `path` lists the devices the fluid
+        passes through on the way, starting next to `device`.
+    """
+    return _trace(device, 'outputs', 'passes_downstream')
+
+def connected_devices(device):
+    """Every device connected to `device`, directly or through other devices, and `device`"""
+    seen = set([device])
+    stack = [device]
+    while stack:
+        node = stack.pop()
+        for connected in node.inputs.values() + node.outputs.values():
+            if connected not in seen:
+                seen.add(connected)
+                stack.append(connected)
+    return seen
+
+def gated_pumps(devices):
+    """{gate: [pumps]} of the valves and pumps among `devices`: the pumps whose flow paths
+        go through each of them, a pump being on its own paths
+    """
+    pumps = {}
+    for device in devices:
+        if device.device_type != 'pump':
+            continue
+        gates = set([device])
+        for paths in device.flow_paths():
+            for tank, receivers, path_gates, capacity, path in paths:
+                gates.update(path_gates)
+        for gate in gates:
+            pumps.setdefault(gate, []).append(device)
+    return pumps
+
+def _sees_fluid(device):
+    """True if `device` does anything with fluid passing through it"""
+    cls = type(device)
+    return cls.pass_fluid.__func__ is not Device.pass_fluid.__func__ or \
+        cls.pass_stream.__func__ is not Device.pass_stream.__func__
+
+def _trace(device, direction, passes):
+    paths = []
+    stack = [(device, [])]
+    while stack:
+        node, path = stack.pop()
+        for neighbour in getattr(node, direction).values():
+            if neighbour is device or neighbour in path:
+                # Loop in the connections
+                continue
+            if neighbour.stores_fluid:
+                paths.append((neighbour, path))
+            elif getattr(neighbour, passes):
+                stack.append((neighbour, path + [neighbour]))
+    if direction == 'inputs':
+        paths = [(source, path[::-1]) for source, path in paths]
+    return paths
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+
+import logging
+from scadasim.devices import trace_upstream, trace_downstream, path_capacity, COMPOSITION_FIELDS
+from scadasim.fluids import KW
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger('scadasim')
+
+
+class EngineUnavailable(Exception):
+        """Exception thrown when the optional dependencies of an engine are missing
+        """
+        def __init__(self, message):
+            super(EngineUnavailable, self).__init__(message)
+
+
+class VectorizedEngine(object):
+    """Move fluid for every pump at once using NumPy arrays.
+
+        The device graph is compiled into flow segments: pump <- source tank
+        (upstream) and pump -> destination tank (downstream), each with the gated
+        devices (valves, pumps) along the way. Every tick opens/closes all segments,
+        balances demand against the volume available in each source and against the
+        capacity of the pumps and segments, splits what each pump moves across its
+        outlets in proportion to their capacity, holds back what would overflow the
+        tanks and applies all transfers with a handful of array operations.
+
+        Tanks mix what they receive into the composition of their contents
+        (`COMPOSITION_FIELDS`, NaN in the arrays when unknown) and the devices along
+        a segment take the composition of the stream.
+
+        Once bound, the `volume`, `state`, `fluid` and composition of the devices are
+        stored in the engine arrays and the device attributes read and write through to them.
+    """
+
+    def __init__(self, devices, sensors=None, volume=1, worker_frequency=1):
+        if np is None:
+            raise EngineUnavailable("The vectorized engine requires numpy")
+
+        # Volume each pump moves per tick
+        self.volume_per_tick = volume
+        self.worker_frequency = worker_frequency
+        self.speed = 1
+        self.active = False
+        self.scheduler = None
+
+        self.nodes = list(devices.values()) + list((sensors or {}).values())
+        self.index = dict((node, i) for i, node in enumerate(self.nodes))
+        self.fluids = []
+        self.fluid_ids = {}
+
+        self.compile()
+        # Pumps that moved out of turn since the last tick, see `actuate()`
+        self.ahead = np.zeros(len(self.nodes), dtype=np.bool_)
+
+    def compile(self):
+        """Build the segment and gate arrays from the current connections"""
+        up_pump, up_source, up_gates, up_passes, up_capacity = [], [], [], [], []
+        down_pump, down_sink, down_gates, down_passes, down_capacity = [], [], [], [], []
+
+        for node in self.nodes:
+            if node.device_type != 'pump':
+                continue
+            for source, path in trace_upstream(node):
+                self._add_segment(len(up_pump), path, up_gates, up_passes)
+                up_pump.append(self.index[node])
+                up_source.append(self.index[source])
+                up_capacity.append(_limit(path_capacity(path)))
+            for sink, path in trace_downstream(node):
+                self._add_segment(len(down_pump), path, down_gates, down_passes)
+                down_pump.append(self.index[node])
+                down_sink.append(self.index[sink])
+                down_capacity.append(_limit(path_capacity(path)))
+
+        self.up_pump = np.array(up_pump, dtype=np.intp)
+        self.up_source = np.array(up_source, dtype=np.intp)
+        self.up_gates = np.array(up_gates, dtype=np.intp).reshape(-1, 2)
+        self.up_passes = np.array(up_passes, dtype=np.intp).reshape(-1, 2)
+        self.down_pump = np.array(down_pump, dtype=np.intp)
+        self.down_sink = np.array(down_sink, dtype=np.intp)
+        self.down_gates = np.array(down_gates, dtype=np.intp).reshape(-1, 2)
+        self.down_passes = np.array(down_passes, dtype=np.intp).reshape(-1, 2)
+        self.up_capacity = np.array(up_capacity, dtype=np.float64)
+        self.down_capacity = np.array(down_capacity, dtype=np.float64)
+        # Capacity of the pumps and room of the tanks, infinite for no limit
+        self.capacity = np.array([_limit(node.capacity) for node in self.nodes], dtype=np.float64)
+        self.max_volume = np.array([_limit(getattr(node, 'max_volume', None)) for node in self.nodes],
+                                   dtype=np.float64)
+        # Without any limit, the pumps draw a full tick worth and split it evenly
+        self.limited = not (np.isinf(self.up_capacity).all() and np.isinf(self.down_capacity).all() and
+                            np.isinf(self.capacity).all())
+        self.bounded = not np.isinf(self.max_volume).all()
+
+        log.info("Compiled %s upstream and %s downstream flow segments" % (len(up_pump), len(down_pump)))
+
+    def _add_segment(self, segment, path, gates, passes):
+        """Record the (segment, device) pairs of the gated and pass-through devices in `path`"""
+        for device in path:
+            passes.append((segment, self.index[device]))
+            if device.gated:
+                gates.append((segment, self.index[device]))
+
+    def bind(self):
+        """Move device fields into the engine arrays"""
+        n = len(self.nodes)
+        self.volume = np.zeros(n, dtype=np.float64)
+        self.state = np.zeros(n, dtype=np.bool_)
+        self.fluid = np.full(n, -1, dtype=np.intp)
+        # Only valve and pump states live in the arrays
+        self.gated = np.array([node.gated for node in self.nodes], dtype=np.bool_)
+        # Devices with observers to notify when a tick changes their volume or fluid
+        self.watched = np.array([i for i, node in enumerate(self.nodes) if node.observers], dtype=np.intp)
+
+        for name in COMPOSITION_FIELDS:
+            setattr(self, name, np.array([_number(getattr(node, name, None)) for node in self.nodes],
+                                         dtype=np.float64).reshape(n))
+
+        for i, node in enumerate(self.nodes):
+            self.volume[i] = getattr(node, 'volume', 0) or 0
+            self.state[i] = bool(node.state) and node.gated
+            self.fluid[i] = self.fluid_id(node.fluid)
+            node.engine_index = i
+            node.engine = self
+
+    def unbind(self):
+        """Copy the engine arrays back onto the devices"""
+        for i, node in enumerate(self.nodes):
+            node.engine = None
+            node.engine_index = None
+            node.fluid = self.get('fluid', i)
+            if node.stores_fluid:
+                node.volume = self.get('volume', i)
+            if node.gated:
+                node.state = self.get('state', i)
+            for name in COMPOSITION_FIELDS:
+                if hasattr(type(node), name):
+                    setattr(node, name, self.get(name, i))
+
+    def watch(self, device):
+        """Notify the observers of `device` about changes made by ticks"""
+        if device.engine_index not in self.watched:
+            self.watched = np.append(self.watched, device.engine_index)
+
+    def fluid_id(self, fluid):
+        """Index of `fluid` in the fluid table. -1 for no fluid"""
+        if fluid is None:
+            return -1
+        if id(fluid) not in self.fluid_ids:
+            self.fluid_ids[id(fluid)] = len(self.fluids)
+            self.fluids.append(fluid)
+        return self.fluid_ids[id(fluid)]
+
+    def get(self, name, index):
+        if name == 'fluid':
+            fluid_id = self.fluid[index]
+            return None if fluid_id < 0 else self.fluids[fluid_id]
+        if name == 'state':
+            if self.gated[index]:
+                return bool(self.state[index])
+            return self.nodes[index]._state
+        if name == 'volume':
+            return self.volume.item(index)
+        value = getattr(self, name).item(index)
+        return None if value != value else value
+
+    def set(self, name, index, value):
+        if name == 'fluid':
+            self.fluid[index] = self.fluid_id(value)
+        elif name == 'state':
+            if self.gated[index]:
+                self.state[index] = bool(value)
+            else:
+                self.nodes[index]._state = value
+        elif name == 'volume':
+            self.volume[index] = value
+        else:
+            getattr(self, name)[index] = _number(value)
+
+    def _open_segments(self, pumps, gates):
+        """Mask of segments whose pump is on and whose gates are all open"""
+        closed = np.bincount(gates[:, 0], weights=~self.state[gates[:, 1]], minlength=len(pumps))
+        return self.state[pumps] & (closed == 0)
+
+    def tick(self, pumps=None):
+        """Move one tick worth of fluid for every pump, or for the pumps in the `pumps` mask,
+            and notify the observers of the devices whose volume or fluid changed
+        """
+        watched = self.watched
+        volume, fluid = self.volume[watched], self.fluid[watched]
+        composition = [getattr(self, name)[watched] for name in COMPOSITION_FIELDS]
+
+        self.move(pumps)
+
+        for i in watched[self.volume[watched] != volume]:
+            self.nodes[i].changed('volume')
+        for i in watched[self.fluid[watched] != fluid]:
+            self.nodes[i].changed('fluid')
+        for name, before in zip(COMPOSITION_FIELDS, composition):
+            after = getattr(self, name)[watched]
+            for i in watched[(after != before) & ~(np.isnan(after) & np.isnan(before))]:
+                self.nodes[i].changed(name)
+
+    def move(self, pumps=None):
+        """Move one tick worth of fluid for every pump, or for the pumps in the `pumps` mask"""
+        n = len(self.nodes)
+        up_open = self._open_segments(self.up_pump, self.up_gates)
+        if pumps is not None:
+            up_open &= pumps[self.up_pump]
+        down_open = self._open_segments(self.down_pump, self.down_gates)
+
+        # Pumps only draw when they have somewhere to send the fluid, and only what their
+        # open outlets can take up to their own capacity
+        outlets = np.bincount(self.down_pump[down_open], minlength=n)
+        draw = np.where(up_open & (outlets[self.up_pump] > 0), float(self.volume_per_tick), 0.0)
+        if self.limited:
+            np.minimum(draw, self.up_capacity, out=draw)
+            outlet_capacity = np.bincount(self.down_pump[down_open], weights=self.down_capacity[down_open],
+                                          minlength=n)
+            limit = np.minimum(self.capacity, outlet_capacity)
+            draw *= _shares(np.bincount(self.up_pump, weights=draw, minlength=n), limit)[self.up_pump]
+
+        # Share each source between the pumps drawing from it
+        demand = np.bincount(self.up_source, weights=draw, minlength=n)
+        drawn = draw * _shares(demand, np.clip(self.volume, 0, None))[self.up_source]
+
+        # Split what each pump moved across its open outlets in proportion to their capacity,
+        # outlets without a limit count as able to take it all
+        throughput = np.bincount(self.up_pump, weights=drawn, minlength=n)
+        if self.limited:
+            weights = np.where(down_open, np.minimum(self.down_capacity, throughput[self.down_pump]), 0.0)
+            total = np.bincount(self.down_pump, weights=weights, minlength=n)
+            delivered = weights * _shares(total, throughput)[self.down_pump]
+        else:
+            delivered = np.where(down_open, throughput[self.down_pump] / np.maximum(outlets[self.down_pump], 1), 0.0)
+
+        # Tanks refuse what would take them over their max volume, it stays in the sources
+        held = self.volume.copy()
+        if self.bounded:
+            incoming = np.bincount(self.down_sink, weights=delivered, minlength=n)
+            accepted = delivered * _shares(incoming, np.clip(self.max_volume - held, 0, None))[self.down_sink]
+            refused = np.bincount(self.down_pump, weights=delivered - accepted, minlength=n)
+            if refused.any():
+                drawn *= 1 - _ratio(refused, throughput)[self.up_pump]
+            delivered = accepted
+
+        # Empty tanks take the fluid that arrives, the others keep theirs
+        empty = (held <= 0) | (self.fluid < 0)
+
+        self.volume -= np.bincount(self.up_source, weights=drawn, minlength=n)
+        self.volume += np.bincount(self.down_sink, weights=delivered, minlength=n)
+
+        # Carry the fluid along the segments that moved something
+        flowing = drawn > 0
+        self.fluid[self.up_pump[flowing]] = self.fluid[self.up_source[flowing]]
+        passes = self.up_passes[flowing[self.up_passes[:, 0]]]
+        self.fluid[passes[:, 1]] = self.fluid[self.up_source[passes[:, 0]]]
+        up_passes = passes
+
+        flowing = delivered > 0
+        sinks = self.down_sink[flowing]
+        filled = empty[sinks]
+        self.fluid[sinks[filled]] = self.fluid[self.down_pump[flowing][filled]]
+        passes = self.down_passes[flowing[self.down_passes[:, 0]]]
+        self.fluid[passes[:, 1]] = self.fluid[self.down_pump[passes[:, 0]]]
+
+        if len(up_passes) or flowing.any():
+            self.mix(drawn, delivered, held, up_passes, passes)
+
+    def mix(self, drawn, delivered, held, up_passes, down_passes):
+        """Mix the composition of the sources into the streams of the pumps, and of the
+            streams into the `held` volumes of the sinks. NaN values are unknown and left out
+        """
+        n = len(self.nodes)
+        drawing = drawn > 0
+        pumps = self.up_pump[drawing]
+        for name in COMPOSITION_FIELDS:
+            values = getattr(self, name)
+            if np.isnan(values).all():
+                continue
+            # pH mixes through the net acidity, see `fluids.mix_ph()`
+            to_linear, from_linear = (_acidity, _ph) if name == 'ph' else (_same, _same)
+
+            # Sources keep their composition and each pump carries what it drew: the value
+            # of its sources, or their mix where they don't agree
+            drawn_values = values[self.up_source]
+            known = drawing & ~np.isnan(drawn_values)
+            stream = np.full(n, np.nan)
+            stream[self.up_pump[known]] = drawn_values[known]
+            mixed = np.bincount(self.up_pump, weights=known & (drawn_values != stream[self.up_pump]), minlength=n) > 0
+            if mixed.any():
+                stream[mixed] = from_linear(_weighted(self.up_pump, drawn, to_linear(drawn_values), n)[mixed])
+            values[pumps] = stream[pumps]
+            values[up_passes[:, 1]] = values[self.up_source[up_passes[:, 0]]]
+            values[down_passes[:, 1]] = stream[self.down_pump[down_passes[:, 0]]]
+
+            # Sinks only change when something known and different arrived
+            added = stream[self.down_pump]
+            differs = (delivered > 0) & ~np.isnan(added) & (added != values[self.down_sink])
+            if not differs.any():
+                continue
+            sinks = np.unique(self.down_sink[differs])
+            kept = held[sinks]
+            kept[np.isnan(values[sinks]) | (kept < 0)] = 0.0
+            weights = np.concatenate((delivered, kept))
+            targets = np.concatenate((self.down_sink, sinks))
+            added = to_linear(np.concatenate((added, np.where(kept > 0, values[sinks], 0.0))))
+            values[sinks] = from_linear(_weighted(targets, weights, added, n)[sinks])
+
+    def actuate(self, pumps):
+        """Move one tick worth of fluid for the `pumps` (node indices) at once, out of turn.
+            They sit the next tick out, so they keep their rate. Pumps that already moved
+            out of turn since the last tick are left to the tick after.
+            Returns the indices of the pumps that moved
+        """
+        mask = np.zeros(len(self.nodes), dtype=np.bool_)
+        mask[pumps] = True
+        mask &= ~self.ahead
+        if not self.active or not mask.any():
+            return []
+        self.tick(mask)
+        self.ahead |= mask
+        return np.flatnonzero(mask).tolist()
+
+    def run(self):
+        """Executed by the scheduler every `worker_frequency`"""
+        if self.active:
+            if self.ahead.any():
+                # Pumps that moved out of turn sit this tick out
+                self.tick(~self.ahead)
+                self.ahead[:] = False
+            else:
+                self.tick()
+            self.scheduler.schedule(self)
+
+    def activate(self):
+        if not self.active:
+            self.active = True
+            self.scheduler.add(self)
+        log.info("%s: Active" % self)
+
+    def deactivate(self):
+        self.active = False
+        log.info("%s: Inactive" % self)
+
+    def __repr__(self):
+        return "[engine][vectorized][%s nodes]" % len(self.nodes)
+
+
+def _limit(capacity):
+    return np.inf if capacity is None else float(capacity)
+
+def _shares(wanted, available):
+    """Fraction of `wanted` that `available` covers, at most 1"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(wanted > available, available / wanted, 1.0)
+
+def _ratio(part, whole):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(whole > 0, part / whole, 0.0)
+
+def _number(value):
+    return np.nan if value is None else float(value)
+
+def _acidity(ph):
+    return 10.0 ** -ph - KW * 10.0 ** ph
+
+def _ph(acidity):
+    root = np.sqrt(acidity * acidity + 4 * KW)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hydrogen = np.where(acidity >= 0, (acidity + root) / 2, 2 * KW / (root - acidity))
+    return -np.log10(hydrogen)
+
+def _same(values):
+    return values
+
+def _weighted(targets, weights, added, n):
+    """Weighted mean of the `added` values at each of `targets`, NaN values left out.
+        NaN where nothing known was added
+    """
+    known = (weights > 0) & ~np.isnan(added)
+    amount = np.bincount(targets[known], weights=weights[known], minlength=n)
+    total = np.bincount(targets[known], weights=weights[known] * added[known], minlength=n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(amount > 0, total / amount, np.nan)
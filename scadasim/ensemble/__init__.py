@@ -0,0 +1 @@
+from ensemble import *
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import itertools
+import logging
+from scadasim.simulator import Simulator
+from scadasim.checkpoint import Checkpoint
+from scadasim.utils import load_simulation, pickle_simulation, unpickle_simulation
+
+log = logging.getLogger('scadasim')
+
+# Settings of the base config that would make the runs share files
+_skipped_settings = ('historian', 'shared_state', 'profiling')
+
+# Simulation and checkpoint the runs of a worker process start from, see `_init_worker()`
+_base = {}
+
+
+def sweep(axes):
+    """Variants for every combination of the values of `axes`, a {name: [values]} mapping.
+        Names with a dot are device or sensor fields set when the run starts, e.g.
+        'valve1.state' or 'tank1.volume'. Other names are sensors written at simulated
+        time t, their values are (t, value) pairs.
+        e.g. sweep({'valve1.state': [True, False], 'sensor4': [(60, False), (120, False)]})
+    """
+    names = sorted(axes)
+    variants = []
+    for values in itertools.product(*[axes[name] for name in names]):
+        variant = {'name': ','.join('%s=%s' % (name, value) for name, value in zip(names, values)),
+                   'fields': {}, 'writes': []}
+        for name, value in zip(names, values):
+            if '.' in name:
+                variant['fields'][name] = value
+            else:
+                time, value = value
+                variant['writes'].append((time, {name: value}))
+        variants.append(variant)
+    return variants
+
+def run_ensemble(path, variants, until, sensors=None, sample_every=None, processes=None,
+                 step_size=1, engine=None, checkpoint=None):
+    """Run every variant of the config at `path` in fixed-step mode until simulated time
+        `until`, across `processes` worker processes (default: one per CPU).
+
+        The config is parsed and wired once, and every run starts from a copy of it,
+        restored from `checkpoint` (a path or a `Checkpoint`) when given. A variant is a dict
+        with an optional 'name', 'fields' set when the run starts ({'valve1.state': False})
+        and 'writes' of sensors at simulated times ([(60, {'sensor4': False})]), see `sweep()`.
+
+        `sensors` (default: all) are sampled every `sample_every` simulated seconds and at
+        the end of the run. Returns {'names': [run names], 'final': {sensor: [value per run]},
+        'results': [result per run]}, runs in the order of `variants`
+    """
+    config, simulation = load_simulation(path)
+    simulation['settings'] = dict((key, value) for key, value in simulation['settings'].iteritems()
+                                  if key not in _skipped_settings)
+    if sensors is None:
+        sensors = sorted(simulation['sensors'])
+    if checkpoint is not None and not isinstance(checkpoint, Checkpoint):
+        checkpoint = Checkpoint.read(checkpoint)
+    data = pickle_simulation(simulation)
+    options = {'until': until, 'sensors': sensors, 'sample_every': sample_every,
+               'step_size': step_size, 'engine': engine}
+    tasks = [(index, variant, options) for index, variant in enumerate(variants)]
+
+    if processes == 1:
+        _init_worker(data, checkpoint)
+        results = map(_run_task, tasks)
+    else:
+        # Workers are forked, so they get the simulation without pickling it again
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(data, checkpoint))
+        try:
+            results = pool.map(_run_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    final = dict((label, [result.get('values', {}).get(label) for result in results]) for label in sensors)
+    return {'names': [result['name'] for result in results], 'final': final, 'results': results}
+
+def run_variant(simulation, variant, until, sensors, sample_every=None, step_size=1, engine=None, checkpoint=None):
+    """Run one variant (see `run_ensemble()`) of the built `simulation` in the current process.
+        Returns the result of the run
+    """
+    sim = Simulator(realtime=False, step_size=step_size, engine=engine)
+    sim.load(simulation)
+    if checkpoint is not None:
+        sim.restore(checkpoint)
+
+    for name, value in sorted(variant.get('fields', {}).iteritems()):
+        label, field = name.rsplit('.', 1)
+        setattr(sim.devices[label] if label in sim.devices else sim.sensors[label], field, value)
+    sim.publish_snapshot()
+
+    writes = {}
+    for time, values in variant.get('writes', []):
+        writes.setdefault(time, {}).update(values)
+    samples = set()
+    if sample_every:
+        samples.update(sim.now() + sample_every * i for i in range(int((until - sim.now()) / sample_every) + 1))
+    series = dict((label, []) for label in ['time'] + sensors)
+
+    for stop in sorted(set(writes) | samples | set([until])):
+        if stop > until:
+            break
+        sim.run_until(stop)
+        if stop in writes:
+            # Applied at the start of the tick running at `stop`
+            sim.write_sensors(writes[stop])
+        if stop in samples or stop == until:
+            now, values = sim.read_sensors(sensors=sensors)
+            series['time'].append(now)
+            for label, value in zip(sensors, values):
+                series[label].append(value)
+
+    return {'name': variant.get('name'), 'variant': variant, 'time': sim.now(), 'ticks': sim.snapshot.tick,
+            'values': dict(zip(sensors, sim.read_sensors(sensors=sensors)[1])), 'series': series}
+
+def _init_worker(data, checkpoint):
+    _base['data'] = data
+    _base['checkpoint'] = checkpoint
+
+def _run_task(task):
+    index, variant, options = task
+    name = variant.get('name') or 'variant%s' % index
+    try:
+        result = run_variant(unpickle_simulation(_base['data']), variant, checkpoint=_base['checkpoint'], **options)
+    except Exception as e:
+        log.exception("Run of %s failed" % name)
+        return {'name': name, 'variant': variant, 'error': '%s: %s' % (e.__class__.__name__, e)}
+    result['name'] = name
+    return result
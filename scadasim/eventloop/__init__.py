@@ -0,0 +1 @@
+from eventloop import *
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+import collections
+import threading
+import itertools
+import asyncore
+import logging
+import heapq
+import errno
+import fcntl
+import time
+import os
+
+log = logging.getLogger('scadasim')
+
+# Longest wait of one iteration, so `stop()` from a signal handler is noticed
+MAX_WAIT = 1.0
+
+
+class Timer(object):
+    """Callback queued by `EventLoop.call_later()`"""
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Task(object):
+    """Generator run as a coroutine by `EventLoop.spawn()`"""
+
+    def __init__(self, loop, generator):
+        self.loop = loop
+        self.generator = generator
+        self.done = False
+        self.error = None
+        self.timer = None
+
+    def step(self):
+        self.timer = None
+        try:
+            delay = next(self.generator)
+        except StopIteration:
+            self.done = True
+            return
+        except Exception as e:
+            log.exception("Task %r failed" % self.generator)
+            self.done = True
+            self.error = e
+            return
+        self.timer = self.loop.call_later(delay or 0, self.step)
+
+    def cancel(self):
+        """Stop the task where it is waiting"""
+        if self.timer:
+            self.timer.cancel()
+        self.generator.close()
+        self.done = True
+
+
+class _Waker(asyncore.file_dispatcher):
+    """Read end of a pipe in the socket map, written to wake the loop from other threads"""
+
+    def __init__(self, socket_map):
+        read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+        os.close(read_fd)
+        flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError as e:
+            # A full pipe wakes the loop anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+
+class EventLoop(object):
+    """Run the ticks of many realtime simulations, their socket services (binary and
+        modbus transports) and timed callbacks from one thread, the one calling `run_forever()`.
+
+        Simulators created with `loop=` register a `scheduler.LoopScheduler` here instead of
+        starting a scheduler thread, and their services share `socket_map`. Each iteration
+        waits on the sockets until the earliest tick or timer is due, then runs what is due.
+        Calls made from the loop never block, other threads hand work over with
+        `call_soon_threadsafe()`.
+    """
+
+    def __init__(self):
+        self.socket_map = {}
+        self.schedulers = []
+        self.running = False
+        # Thread running the loop
+        self.thread = None
+        self._timers = []
+        self._ready = collections.deque()
+        self._counter = itertools.count()
+        self._waker = _Waker(self.socket_map)
+
+    def time(self):
+        return time.time()
+
+    def add_scheduler(self, scheduler):
+        if scheduler not in self.schedulers:
+            self.schedulers.append(scheduler)
+        self.wake()
+
+    def remove_scheduler(self, scheduler):
+        if scheduler in self.schedulers:
+            self.schedulers.remove(scheduler)
+
+    def call_soon(self, callback, *args):
+        """Run `callback(*args)` at the next iteration"""
+        self._ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """`call_soon()` from any thread, e.g. sim.pause or sim.set_speed from a test orchestrator"""
+        self._ready.append((callback, args))
+        self.wake()
+
+    def call_later(self, delay, callback, *args):
+        """Run `callback(*args)` in `delay` seconds. Returns a `Timer` that can be cancelled"""
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        heapq.heappush(self._timers, (when, next(self._counter), timer))
+        self.wake()
+        return timer
+
+    def spawn(self, generator):
+        """Run `generator` as a coroutine: each value it yields is the number of seconds
+            to wait before it resumes (None: the next iteration). Returns its `Task`
+        """
+        task = Task(self, generator)
+        self.call_soon(task.step)
+        return task
+
+    def wake(self):
+        """Interrupt the wait of the loop when called from another thread"""
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            self._waker.wake()
+
+    def _timeout(self):
+        """Seconds until the earliest timer or tick is due"""
+        if self._ready:
+            return 0
+        due = [self._timers[0][0]] if self._timers else []
+        for scheduler in self.schedulers:
+            run_at = scheduler.next_run()
+            if run_at is not None:
+                due.append(run_at)
+        if not due:
+            return MAX_WAIT
+        return min(MAX_WAIT, max(0, min(due) - self.time()))
+
+    def run_once(self, timeout=None):
+        """Wait for socket events until something is due, but no longer than `timeout`
+            seconds, then run the ready callbacks, the due timers and the due ticks
+        """
+        wait = self._timeout()
+        if timeout is not None:
+            wait = max(0, min(wait, timeout))
+        asyncore.loop(timeout=wait, use_poll=True, map=self.socket_map, count=1)
+
+        # Callbacks queued by these callbacks wait for the next iteration
+        for _ in range(len(self._ready)):
+            callback, args = self._ready.popleft()
+            self._run(callback, args)
+
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            when, seq, timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self._run(timer.callback, timer.args)
+
+        for scheduler in list(self.schedulers):
+            scheduler.run_due(self.time())
+
+    def _run(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            log.exception("Callback %r failed" % callback)
+
+    def run_forever(self):
+        """Run until `stop()`"""
+        self._run_while(lambda: True)
+
+    def run_for(self, seconds):
+        """Run for `seconds` seconds, or until `stop()`"""
+        deadline = self.time() + seconds
+        self._run_while(lambda: self.time() < deadline, deadline)
+
+    def run_until_done(self, *tasks):
+        """Run until every one of `tasks` is done, or until `stop()`"""
+        self._run_while(lambda: not all(task.done for task in tasks))
+
+    def _run_while(self, condition, deadline=None):
+        self.running = True
+        self.thread = threading.current_thread()
+        try:
+            while self.running and condition():
+                self.run_once(None if deadline is None else deadline - self.time())
+        finally:
+            self.running = False
+            self.thread = None
+
+    def stop(self):
+        """Make `run_forever()` return after the current iteration. Safe from any thread"""
+        self.running = False
+        self.wake()
+
+    def close(self):
+        """Close the wake-up pipe. Simulators using the loop should be stopped first"""
+        self._waker.close()
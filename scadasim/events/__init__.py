@@ -0,0 +1 @@
+from events import *
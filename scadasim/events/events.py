@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+import collections
+import itertools
+import logging
+import random
+import heapq
+
+log = logging.getLogger('scadasim')
+
+# Parameters each kind of event requires
+KINDS = {
+    'override': ('value',),     # report or hold `value`
+    'drift': ('rate',),         # add `rate` per simulated second since the event started
+    'noise': ('stddev',),       # add gaussian noise of `stddev`
+    'freeze': (),               # report or hold the value of when the event started
+    'delay': ('seconds',),      # report the value of `seconds` ago, sensors only
+}
+
+
+class InvalidEvent(Exception):
+        """Exception thrown for events that can't be scheduled
+        """
+        def __init__(self, message):
+            super(InvalidEvent, self).__init__(message)
+
+
+class Event(object):
+    """Perturbation of the reading of a sensor, or of a field of a device, from
+        `start` until `end` (None: until cancelled) on the simulation clock
+    """
+    __slots__ = ('target', 'kind', 'field', 'start', 'end', 'value', 'rate', 'stddev', 'seconds',
+                 'seq', 'active', 'cancelled', 'applied_at', 'offset', 'history')
+
+    def __init__(self, target, kind, start, end=None, field=None, value=None, rate=None, stddev=None, seconds=None):
+        if kind not in KINDS:
+            raise InvalidEvent("Unknown event type %s, use one of %s" % (kind, ', '.join(sorted(KINDS))))
+        self.target = target
+        self.kind = kind
+        self.field = field
+        self.start = start
+        self.end = end
+        self.value = value
+        self.rate = rate
+        self.stddev = stddev
+        self.seconds = seconds
+        for name in KINDS[kind]:
+            if getattr(self, name) is None:
+                raise InvalidEvent("A %s event of %s needs a `%s`" % (kind, target, name))
+        self.seq = None
+        self.active = False
+        self.cancelled = False
+        self.applied_at = None
+        self.offset = 0
+        self.history = None
+
+    def perturb(self, value, now, rng):
+        """Reading reported for the `value` read at `now`"""
+        kind = self.kind
+        if kind == 'override':
+            return self.value
+        if kind == 'freeze':
+            if self.applied_at is None:
+                self.applied_at = now
+                self.value = value
+            return self.value
+        if kind == 'delay':
+            history = self.history
+            history.append((now, value))
+            while len(history) > 1 and history[1][0] <= now - self.seconds + 1e-9:
+                history.popleft()
+            return history[0][1]
+        if not _numeric(value):
+            return value
+        if kind == 'drift':
+            return value + self.rate * (now - self.start)
+        return value + rng.gauss(0, self.stddev)
+
+    def __repr__(self):
+        return "[event][%s][%s%s]" % (self.kind, self.target, '.%s' % self.field if self.field else '')
+
+
+class EventQueue(object):
+    """Apply scheduled events to the sensors and devices of a simulation at tick boundaries.
+
+        Events wait in a heap ordered by start time and active ones in a heap ordered by end
+        time, so each tick only looks at the events starting or ending and at the active ones,
+        however many are scheduled. Device events change the device field at the start of
+        each tick (see `before_tick()`), sensor events change the readings published in the
+        snapshot (see `perturb()`), which is what PLCs read, leaving the sensor itself alone.
+    """
+
+    def __init__(self, sensors, devices, seed=0):
+        self.sensors = sensors
+        self.devices = devices
+        self.random = random.Random(seed)
+        self.pending = []
+        self.ending = []
+        # Active events by sensor label, in start order, and active device events
+        self.sensor_events = {}
+        self.device_events = []
+        self.counter = itertools.count()
+
+    def schedule(self, event):
+        if event.target in self.sensors:
+            if event.field:
+                raise InvalidEvent("Events of sensor %s change its reading, not a field" % event.target)
+        elif event.target in self.devices:
+            if event.kind == 'delay':
+                raise InvalidEvent("Only sensor readings can be delayed, not device %s" % event.target)
+            if event.field is None:
+                event.field = 'volume' if self.devices[event.target].stores_fluid else 'state'
+            if not hasattr(type(self.devices[event.target]), event.field):
+                raise InvalidEvent("Device %s has no field %s" % (event.target, event.field))
+        else:
+            raise KeyError("Event of unknown sensor or device %s" % event.target)
+        if event.end is not None and event.end < event.start:
+            raise InvalidEvent("%s ends before it starts" % event)
+        event.seq = next(self.counter)
+        heapq.heappush(self.pending, (event.start, event.seq, event))
+        return event
+
+    def cancel(self, event):
+        """End `event` at the next tick, or drop it if it hasn't started"""
+        event.cancelled = True
+        if event.active:
+            heapq.heappush(self.ending, (None, event.seq, event))
+
+    def advance(self, now):
+        """Start and end the events due by `now`"""
+        now += 1e-9
+        pending = self.pending
+        while pending and pending[0][0] <= now:
+            start, seq, event = heapq.heappop(pending)
+            if not event.cancelled:
+                self._start(event)
+        ending = self.ending
+        while ending and (ending[0][0] is None or ending[0][0] <= now):
+            end, seq, event = heapq.heappop(ending)
+            if event.active:
+                self._end(event, now if end is None else end)
+
+    def _start(self, event):
+        event.active = True
+        if event.end is not None:
+            heapq.heappush(self.ending, (event.end, event.seq, event))
+        if event.target in self.sensors:
+            if event.kind == 'delay':
+                event.history = collections.deque()
+            self.sensor_events.setdefault(event.target, []).append(event)
+        else:
+            device = self.devices[event.target]
+            if event.kind == 'freeze':
+                event.value = getattr(device, event.field)
+            event.applied_at = event.start
+            self.device_events.append(event)
+        log.info("%s: Started" % event)
+
+    def _end(self, event, end):
+        event.active = False
+        if event.target in self.sensors:
+            events = self.sensor_events[event.target]
+            events.remove(event)
+            if not events:
+                del self.sensor_events[event.target]
+        else:
+            self.device_events.remove(event)
+            if event.kind == 'drift':
+                # Drift until the end, not until the last tick
+                self._drift(event, end)
+            elif event.offset:
+                device = self.devices[event.target]
+                setattr(device, event.field, getattr(device, event.field) - event.offset)
+                event.offset = 0
+        log.info("%s: Ended" % event)
+
+    def before_tick(self, now):
+        """Start and end the events due by `now` and apply the device events"""
+        self.advance(now)
+        for event in self.device_events:
+            device = self.devices[event.target]
+            kind = event.kind
+            if kind == 'override' or kind == 'freeze':
+                setattr(device, event.field, event.value)
+                continue
+            if kind == 'drift':
+                self._drift(event, now)
+                continue
+            value = getattr(device, event.field)
+            if _numeric(value):
+                # Noise replaces the noise of the previous tick, the field keeps its level
+                offset = self.random.gauss(0, event.stddev)
+                self._set(device, event.field, value + offset - event.offset)
+                event.offset = offset
+
+    def _drift(self, event, now):
+        device = self.devices[event.target]
+        value = getattr(device, event.field)
+        if _numeric(value):
+            self._set(device, event.field, value + event.rate * (now - event.applied_at))
+        event.applied_at = now
+
+    def _set(self, device, field, value):
+        if field == 'volume':
+            value = max(0, value)
+        setattr(device, field, value)
+
+    def hold(self):
+        """Apply the override and freeze events of devices again, e.g. after a write"""
+        for event in self.device_events:
+            if event.kind == 'override' or event.kind == 'freeze':
+                setattr(self.devices[event.target], event.field, event.value)
+
+    def perturb(self, now, values):
+        """Apply the active sensor events to the {label: value} readings in place.
+            Returns the labels changed
+        """
+        rng = self.random
+        for label, events in self.sensor_events.iteritems():
+            if label not in values:
+                # Removed by a reload
+                continue
+            value = values[label]
+            for event in events:
+                value = event.perturb(value, now, rng)
+            values[label] = value
+        return set(self.sensor_events)
+
+    def scheduled(self):
+        """Events waiting to start and active events"""
+        return sorted([event for start, seq, event in self.pending if not event.cancelled] +
+                      [event for events in self.sensor_events.values() for event in events] +
+                      self.device_events, key=lambda event: (event.start, event.seq))
+
+
+def parse_events(entries, origin=0):
+    """Events of the `events` section of a config. `at` and `duration` are in simulated
+        seconds, `at` counting from `origin`.
+        e.g. [{'target': 'tank1', 'type': 'drift', 'field': 'volume', 'rate': -0.5, 'at': 60, 'duration': 600}]
+    """
+    events = []
+    for entry in entries:
+        entry = dict(entry)
+        try:
+            target, kind = entry.pop('target'), entry.pop('type')
+        except KeyError as e:
+            raise InvalidEvent("Event %s has no %s" % (entry, e))
+        start = origin + entry.pop('at', 0)
+        duration = entry.pop('duration', None)
+        end = None if duration is None else start + duration
+        try:
+            events.append(Event(target, kind, start, end, **entry))
+        except TypeError:
+            raise InvalidEvent("Unknown parameters of the %s event of %s: %s" % (kind, target, ', '.join(sorted(entry))))
+    return events
+
+def _numeric(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
@@ -1,20 +1,30 @@
 #!/usr/bin/env python
 
 import random
-import uuid
+import itertools
+import math
 import yaml
 import logging
 
 log = logging.getLogger('scadasim')
 
+# Integer ids shared by all fluids
+_uids = itertools.count(1)
+
+# Ion product of water at 25C
+KW = 1e-14
+
 # Fluids
 class Fluid(yaml.YAMLObject):
     """Base class for all fluids
     """
     allowed_fluid_types = ['water', 'chlorine']
 
+    # Fluids are shared by every device holding them, so treat them as immutable
+    __slots__ = ('uid', 'fluid_type', 'ph', 'temperature', 'salinity', 'pressure', 'flowrate')
+
     def __init__(self, fluid_type=None, ph=None, temperature=None, salinity=None, pressure=None, flowrate=None):
-        self.uid = str(uuid.uuid4())[:8]
+        self.uid = next(_uids)
         self.fluid_type = fluid_type
         self.ph = ph   					# For later use
         self.temperature = temperature  # For later use
@@ -35,8 +45,16 @@ class Fluid(yaml.YAMLObject):
 
     @classmethod
     def from_yaml(cls, loader, node):
+        """Equal fluids of one loaded config are one shared instance. Each load builds
+            its own, so e.g. every config loaded gets its own random pH of water
+        """
         fields = loader.construct_mapping(node, deep=False)
-        return cls(**fields)
+        # The loader lives for one load
+        loaded = loader.__dict__.setdefault('fluids', {})
+        key = (cls, tuple(sorted(fields.items())))
+        if key not in loaded:
+            loaded[key] = cls(**fields)
+        return loaded[key]
 
     class InvalidFluid(Exception):
         """Exception handler for bad fluid types
@@ -47,6 +65,8 @@ class Fluid(yaml.YAMLObject):
 class Water(Fluid):
     yaml_tag = u'!water'
 
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(Water, self).__init__(fluid_type='water', **kwargs)
         self.ph = round(random.uniform(6.5, 8.0), 2)
@@ -54,7 +74,42 @@ class Water(Fluid):
 class Chlorine(Fluid):
     yaml_tag = u'!chlorine'
 
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(Chlorine, self).__init__(fluid_type='chlorine', **kwargs)
         self.ph = 5
 
+
+
+# Mixing
+def mix(value, volume, added, added_volume):
+    """Volume-weighted mean of `volume` of `value` and `added_volume` of `added`,
+        e.g. a temperature or a salinity. None is unknown and left out of the mean
+    """
+    if added is None or added_volume <= 0 or value == added:
+        return value
+    if value is None or volume <= 0:
+        return added
+    return (value * volume + added * added_volume) / float(volume + added_volume)
+
+def mix_ph(ph, volume, added, added_volume):
+    """pH of `volume` of a solution of pH `ph` mixed with `added_volume` of pH `added`.
+        Mixes the net acidity of both, as for strong acids and bases without buffering
+    """
+    if added is None or added_volume <= 0 or ph == added:
+        return ph
+    if ph is None or volume <= 0:
+        return added
+    return acidity_ph((acidity(ph) * volume + acidity(added) * added_volume) / float(volume + added_volume))
+
+def acidity(ph):
+    """Net strong acid concentration in mol/L of a solution of pH `ph`, negative for bases"""
+    return 10.0 ** -ph - KW * 10.0 ** ph
+
+def acidity_ph(acidity):
+    """pH of a solution of net strong acid concentration `acidity`"""
+    root = math.sqrt(acidity * acidity + 4 * KW)
+    # Pick the form without cancellation, the concentration of H+ is (acidity + root) / 2
+    hydrogen = (acidity + root) / 2 if acidity >= 0 else 2 * KW / (root - acidity)
+    return -math.log10(hydrogen)
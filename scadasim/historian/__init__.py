@@ -0,0 +1 @@
+from historian import *
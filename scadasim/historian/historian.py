@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+import threading
+import collections
+import logging
+import os
+from scadasim.utils import state_fields, numeric_value
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger('scadasim')
+
+
+class HistorianUnavailable(Exception):
+        """Exception thrown when numpy, which the historian requires, is missing
+        """
+        def __init__(self, message):
+            super(HistorianUnavailable, self).__init__(message)
+
+
+class HistorianMismatch(Exception):
+        """Exception thrown when a historian path holds ticks recorded with other columns
+        """
+        def __init__(self, message):
+            super(HistorianMismatch, self).__init__(message)
+
+
+def _numbers(values):
+    """Sensor and device values as a float64 array. Non-numeric values are NaN"""
+    try:
+        # None converts to NaN here as well
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array([numeric_value(value) for value in values], dtype=np.float64)
+
+
+class Historian(object):
+    """Record every sensor value, tank volume and valve/pump state of each tick.
+
+        Recording a tick only keeps references to the immutable sensor snapshot
+        and to a copy-on-write dict of device values, so it costs next to nothing
+        on the simulation loop. A background thread turns chunks of `chunk_size`
+        ticks into columns and appends them to `path`:
+
+            columns.txt             column names, one per line
+            index.txt               one "chunk start_time end_time" line per chunk
+            NNNNNNNN.times.npy      float64 time of each tick of the chunk
+            NNNNNNNN.values.npy     float64 (ticks, columns) values of the chunk
+    """
+
+    def __init__(self, simulator, path, chunk_size=1024):
+        if np is None:
+            raise HistorianUnavailable("The historian requires numpy")
+
+        self.simulator = simulator
+        self.path = path
+        self.chunk_size = chunk_size
+
+        self.sensors = sorted(simulator.sensors)
+        self.devices = state_fields(simulator.devices)
+        self.columns = self.sensors + ['%s.%s' % (device.label, name) for device, name in self.devices]
+        self.chunks = self._read_index()
+        if self.chunks and self._read_columns() != self.columns:
+            raise HistorianMismatch("%s holds ticks recorded with other columns, record to a new path" % path)
+
+        self.keys = [(device.label, name) for device, name in self.devices]
+        self.engine = simulator.engine
+        if self.engine:
+            # Device values are gathered straight from the engine arrays
+            self.gathers = []
+            for name in ('volume', 'state'):
+                positions = [i for i, (device, column) in enumerate(self.devices) if column == name]
+                indexes = [self.devices[i][0].engine_index for i in positions]
+                self.gathers.append((name, np.array(positions, dtype=np.intp), np.array(indexes, dtype=np.intp)))
+        else:
+            # Latest device values, replaced (not mutated) whenever a device changes
+            self.device_values = dict((key, getattr(device, key[1])) for key, (device, name) in zip(self.keys, self.devices))
+            self.changed_devices = set()
+            for device, name in self.devices:
+                device.add_observer(self)
+
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = True
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'columns.txt'), 'w') as stream:
+            stream.write(''.join('%s\n' % column for column in self.columns))
+
+        self.writer = threading.Thread(target=self._write_loop, name='scadasim-historian')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def device_changed(self, device, name):
+        self.changed_devices.add((device.label, name))
+
+    def record(self):
+        """Record the current tick. Called by the scheduler after the snapshot is published"""
+        if self.engine:
+            device_values = np.empty(len(self.devices))
+            for name, positions, indexes in self.gathers:
+                device_values[positions] = getattr(self.engine, name)[indexes]
+        else:
+            if self.changed_devices:
+                changed, self.changed_devices = self.changed_devices, set()
+                values = dict(self.device_values)
+                for key in changed:
+                    if key in values:
+                        values[key] = getattr(self.simulator.devices[key[0]], key[1])
+                self.device_values = values
+            device_values = self.device_values
+        snapshot = self.simulator.snapshot
+        self.pending.append((snapshot.time, snapshot.values, device_values))
+        if len(self.pending) >= self.chunk_size:
+            self.wakeup.set()
+
+    def flush(self):
+        """Write everything recorded so far"""
+        with self.lock:
+            while self.pending:
+                self._write_chunk()
+
+    def close(self):
+        """Flush and stop the writer thread"""
+        self.running = False
+        self.wakeup.set()
+        self.writer.join()
+        self.flush()
+        if not self.engine:
+            for device, name in self.devices:
+                device.remove_observer(self)
+
+    def _write_loop(self):
+        while self.running:
+            self.wakeup.wait(1)
+            self.wakeup.clear()
+            with self.lock:
+                while len(self.pending) >= self.chunk_size:
+                    self._write_chunk()
+
+    def _rows(self, ticks):
+        """Convert recorded ticks to (times, values) arrays"""
+        times = np.empty(len(ticks))
+        values = np.empty((len(ticks), len(self.columns)))
+        sensors = len(self.sensors)
+        previous = (None, None)
+        for i, (time, sensor_values, device_values) in enumerate(ticks):
+            times[i] = time
+            # Unchanged ticks share their values, so they are converted once
+            if sensor_values is not previous[0]:
+                values[i, :sensors] = _numbers([sensor_values[label] for label in self.sensors])
+            else:
+                values[i, :sensors] = values[i - 1, :sensors]
+            if device_values is not previous[1]:
+                if isinstance(device_values, dict):
+                    device_values = _numbers([device_values[key] for key in self.keys])
+                values[i, sensors:] = device_values
+            else:
+                values[i, sensors:] = values[i - 1, sensors:]
+            previous = (sensor_values, ticks[i][2])
+        return times, values
+
+    def _write_chunk(self):
+        ticks = [self.pending.popleft() for _ in range(min(self.chunk_size, len(self.pending)))]
+        times, values = self._rows(ticks)
+        chunk = len(self.chunks)
+        np.save(os.path.join(self.path, '%08d.times.npy' % chunk), times)
+        np.save(os.path.join(self.path, '%08d.values.npy' % chunk), values)
+        # The index line goes last, so readers only see complete chunks
+        with open(os.path.join(self.path, 'index.txt'), 'a') as stream:
+            stream.write('%d %r %r\n' % (chunk, times[0], times[-1]))
+        self.chunks.append((chunk, times[0], times[-1]))
+
+    def _read_columns(self):
+        with open(os.path.join(self.path, 'columns.txt')) as stream:
+            return [line.rstrip('\n') for line in stream]
+
+    def _read_index(self):
+        chunks = []
+        index = os.path.join(self.path, 'index.txt')
+        if os.path.exists(index):
+            with open(index) as stream:
+                for line in stream:
+                    chunk, start, end = line.split()
+                    chunks.append((int(chunk), float(start), float(end)))
+        return chunks
+
+    def query(self, start=None, end=None, columns=None):
+        """Recorded values with `start` <= time <= `end`, written or still pending.
+            Returns (times, values) where values has one column per name in `columns`
+            (default: all columns, in the order of `self.columns`)
+        """
+        # Keep the writer from moving ticks between the pending buffer and the files
+        with self.lock:
+            return query(self.path, start, end, columns, pending=self._rows(list(self.pending)))
+
+
+def query(path, start=None, end=None, columns=None, pending=None):
+    """Read the values recorded by a `Historian` in `path` with `start` <= time <= `end`.
+        Returns (times, values) where values has one column per name in `columns`
+        (default: all columns)
+    """
+    if np is None:
+        raise HistorianUnavailable("The historian requires numpy")
+
+    with open(os.path.join(path, 'columns.txt')) as stream:
+        names = [line.rstrip('\n') for line in stream]
+    selected = slice(None) if columns is None else [names.index(column) for column in columns]
+    start = float('-inf') if start is None else start
+    end = float('inf') if end is None else end
+
+    parts = []
+    index = os.path.join(path, 'index.txt')
+    if os.path.exists(index):
+        with open(index) as stream:
+            for line in stream:
+                chunk, chunk_start, chunk_end = line.split()
+                if float(chunk_end) < start or float(chunk_start) > end:
+                    continue
+                times = np.load(os.path.join(path, '%08d.times.npy' % int(chunk)))
+                values = np.load(os.path.join(path, '%08d.values.npy' % int(chunk)), mmap_mode='r')
+                parts.append((times, values))
+    if pending is not None:
+        parts.append(pending)
+
+    all_times, all_values = [], []
+    for times, values in parts:
+        mask = (times >= start) & (times <= end)
+        all_times.append(times[mask])
+        all_values.append(np.asarray(values[mask])[:, selected])
+
+    width = len(names) if columns is None else len(columns)
+    if not all_times:
+        return np.empty(0), np.empty((0, width))
+    return np.concatenate(all_times), np.concatenate(all_values).reshape(-1, width)
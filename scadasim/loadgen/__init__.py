@@ -0,0 +1 @@
+from loadgen import *
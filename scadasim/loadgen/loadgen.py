@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import threading
+import logging
+import random
+import time
+from scadasim import Simulator
+from scadasim.utils import parse_yml
+from scadasim.benchmark import percentiles
+from scadasim.rpc import BinaryRPCClient
+from scadasim.modbus import ModbusClient, READS, READ_LIMITS
+
+log = logging.getLogger('scadasim')
+
+PROTOCOLS = ('binary', 'modbus')
+
+# Register types PLCs can write: coils and holding registers
+WRITABLE = ('c', 'h')
+
+# Distinct error messages kept for the report
+MAX_MESSAGES = 10
+
+
+def plan(plcs, clients):
+    """Assign the PLCs of a `plcs` config section to `clients` virtual PLC clients, in turn,
+        so there are several clients per PLC, like HMIs, when there are more clients than PLCs.
+        Returns one dict per client: plc label, Modbus unit id and (label, register type,
+        data address) of each sensor
+    """
+    labels = sorted(plcs)
+    if not labels:
+        raise ValueError("The config has no PLCs to poll")
+    assignments = []
+    for index in range(clients):
+        label = labels[index % len(labels)]
+        sensors = plcs[label]['sensors']
+        assignments.append({
+            'index': index, 'plc': label, 'unit': plcs[label].get('slaveid', 1),
+            'sensors': sorted((sensor, sensors[sensor]['register_type'], sensors[sensor]['data_address'])
+                              for sensor in sensors)})
+    return assignments
+
+
+class VirtualPLC(object):
+    """Poll the sensors of one PLC every scan, like the scan cycle of a PLC.
+
+        A scan reads every sensor of the PLC: one bulk read over the binary protocol, one range
+        read per register type over Modbus. With probability `write_ratio` the scan then writes
+        one coil or holding register back with the value it just read, so the load doesn't
+        change the plant. Latencies are recorded per request in `latencies`.
+    """
+
+    def __init__(self, assignment, address, protocol='binary', write_ratio=0.1, seed=0):
+        self.plc = assignment['plc']
+        self.unit = assignment['unit']
+        self.sensors = assignment['sensors']
+        self.writable = [sensor for sensor in self.sensors if sensor[1] in WRITABLE]
+        self.address = address
+        self.protocol = protocol
+        self.write_ratio = write_ratio
+        self.random = random.Random(seed + assignment['index'])
+        self.client = None
+        self.values = {}
+        self.latencies = {'read': [], 'write': []}
+        self.errors = {'read': 0, 'write': 0, 'connect': 0}
+        self.messages = set()
+        self.scans = 0
+        self.overruns = 0
+
+        # Address ranges read over Modbus, one per register type
+        self.ranges = []
+        for register_type in sorted(set(sensor[1] for sensor in self.sensors)):
+            addresses = [sensor[2] for sensor in self.sensors if sensor[1] == register_type]
+            count = min(max(addresses) - min(addresses) + 1, READ_LIMITS[register_type])
+            self.ranges.append((register_type, min(addresses), count))
+
+    def connect(self):
+        if self.protocol == 'binary':
+            self.client = BinaryRPCClient(self.address)
+        else:
+            self.client = ModbusClient(self.address)
+
+    def close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+
+    def run(self, scan_rate, until):
+        """Scan `scan_rate` times per second until the time `until`. Scans that fall
+            behind are counted as overruns and the missed ones are skipped
+        """
+        interval = 1.0 / scan_rate
+        next_scan = time.time()
+        while next_scan < until:
+            self.scan()
+            next_scan += interval
+            delay = next_scan - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.overruns += 1
+                next_scan = time.time()
+        self.close()
+
+    def scan(self):
+        self.scans += 1
+        if self.client is None:
+            try:
+                self.connect()
+            except Exception as e:
+                self._failed('connect', e)
+                return
+        self.read()
+        if self.writable and self.random.random() < self.write_ratio:
+            self.write(self.random.choice(self.writable))
+
+    def read(self):
+        if self.protocol == 'binary':
+            self._call('read', self._read_binary)
+        else:
+            for register_type, address, count in self.ranges:
+                self._call('read', self._read_modbus, register_type, address, count)
+
+    def _read_binary(self):
+        values = self.client.read_sensors(self.plc)
+        self.values.update(zip([sensor[0] for sensor in self.sensors], values))
+
+    def _read_modbus(self, register_type, address, count):
+        for function, read_type in READS.items():
+            if read_type == register_type:
+                break
+        if register_type in 'cd':
+            values = self.client.read_bits(self.unit, function, address, count)
+        else:
+            values = self.client.read_registers(self.unit, function, address, count)
+        for label, sensor_type, sensor_address in self.sensors:
+            if sensor_type == register_type and address <= sensor_address < address + count:
+                self.values[label] = values[sensor_address - address]
+
+    def write(self, sensor):
+        label, register_type, address = sensor
+        value = self.values.get(label)
+        if value is None:
+            return
+        if self.protocol == 'binary':
+            self._call('write', self.client.write_sensor, self.plc, label, value)
+        elif register_type == 'c':
+            self._call('write', self.client.write_coil, self.unit, address, value)
+        else:
+            self._call('write', self.client.write_register, self.unit, address, value)
+
+    def _call(self, operation, function, *args):
+        started = time.time()
+        try:
+            function(*args)
+        except Exception as e:
+            self._failed(operation, e)
+            # The connection may be out of step with the server, start over
+            self.close()
+            return
+        self.latencies[operation].append(time.time() - started)
+
+    def _failed(self, operation, e):
+        self.errors[operation] += 1
+        if len(self.messages) < MAX_MESSAGES:
+            self.messages.add('%s: %s: %s' % (operation, e.__class__.__name__, e))
+
+    def result(self):
+        return {'latencies': self.latencies, 'errors': self.errors, 'messages': sorted(self.messages),
+                'scans': self.scans, 'overruns': self.overruns}
+
+
+def run_clients(assignments, address, protocol, scan_rate, write_ratio, seconds, seed=0):
+    """Run one virtual PLC per assignment, each in its own thread, for `seconds` seconds.
+        Returns their results
+    """
+    plcs = [VirtualPLC(assignment, address, protocol, write_ratio, seed) for assignment in assignments]
+    until = time.time() + seconds
+    threads = [threading.Thread(target=plc.run, args=(scan_rate, until), name='scadasim-plc%s' % i)
+               for i, plc in enumerate(plcs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [plc.result() for plc in plcs]
+
+def _run_clients(args):
+    return run_clients(*args)
+
+def serve(path, protocol='binary', engine=None):
+    """Start a realtime simulation of the config at `path` serving `protocol` on a free local port.
+        Returns (simulator, address)
+    """
+    sim = Simulator(engine=engine)
+    sim.load_yml(path)
+    sim.settings['transports'] = [protocol]
+    sim.settings[protocol] = {'host': '127.0.0.1', 'port': 0}
+    sim.start()
+    return sim, sim.services[0].address
+
+def run_load(path, clients=10, scan_rate=10, write_ratio=0.1, seconds=10, protocol='binary',
+             address=None, processes=None, engine=None, seed=0):
+    """Poll the PLCs of the config at `path` with `clients` virtual PLC clients (see `VirtualPLC`),
+        each scanning `scan_rate` times per second for `seconds` seconds, spread over `processes`
+        client processes (default: one per CPU).
+
+        Without `address`, the config is simulated in this process on a free local port, so the
+        whole run is local. Otherwise the simulation serving `protocol` at `address` is polled.
+        Returns a report, see `report()`
+    """
+    if protocol not in PROTOCOLS:
+        raise ValueError("Unknown protocol %s, use one of %s" % (protocol, ', '.join(PROTOCOLS)))
+    assignments = plan(parse_yml(path).get('plcs') or {}, clients)
+    sim = None
+    if address is None:
+        sim, address = serve(path, protocol, engine)
+    processes = min(processes or multiprocessing.cpu_count(), clients)
+    groups = [(assignments[i::processes], address, protocol, scan_rate, write_ratio, seconds, seed)
+              for i in range(processes)]
+    try:
+        started = time.time()
+        if processes == 1:
+            results = map(_run_clients, groups)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_run_clients, groups, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        elapsed = time.time() - started
+    finally:
+        if sim:
+            sim.pause()
+            sim.scheduler.stop()
+    result = report([result for group in results for result in group], elapsed)
+    result.update(protocol=protocol, clients=clients, scan_rate=scan_rate, write_ratio=write_ratio,
+                  processes=processes)
+    return result
+
+def report(results, seconds):
+    """Combine the results of the virtual PLCs of a run lasting `seconds` seconds: scans and
+        overruns, then for each operation the request count, requests per second, errors,
+        error rate and latency percentiles in milliseconds
+    """
+    operations = {}
+    for operation in ('read', 'write'):
+        latencies = [latency for result in results for latency in result['latencies'][operation]]
+        errors = sum(result['errors'][operation] for result in results)
+        requests = len(latencies) + errors
+        operations[operation] = {
+            'requests': requests, 'per_s': len(latencies) / seconds, 'errors': errors,
+            'error_rate': errors / float(requests) if requests else 0.0,
+            'latency_ms': dict((key, value * 1000) for key, value in percentiles(latencies).items())
+            if latencies else {}}
+    requests = sum(operation['requests'] for operation in operations.values())
+    errors = sum(operation['errors'] for operation in operations.values())
+    connect_errors = sum(result['errors']['connect'] for result in results)
+    messages = sorted(set(message for result in results for message in result['messages']))
+    return {'seconds': seconds, 'scans': sum(result['scans'] for result in results),
+            'overruns': sum(result['overruns'] for result in results),
+            'requests_per_s': (requests - errors) / seconds, 'connect_errors': connect_errors,
+            'error_rate': (errors + connect_errors) / float(requests + connect_errors) if requests else 1.0,
+            'operations': operations, 'messages': messages[:MAX_MESSAGES]}
+
+def check(result, max_error_rate=0.0, max_p99_ms=None):
+    """Failed release gates of a `run_load()` report, as messages. Empty when it passes"""
+    failures = []
+    if result['error_rate'] > max_error_rate:
+        failures.append("Error rate %.4f is above %.4f" % (result['error_rate'], max_error_rate))
+    if max_p99_ms is not None:
+        for operation, stats in sorted(result['operations'].items()):
+            p99 = stats['latency_ms'].get('p99')
+            if p99 is not None and p99 > max_p99_ms:
+                failures.append("%s p99 latency %.2f ms is above %.2f ms" % (operation, p99, max_p99_ms))
+    return failures
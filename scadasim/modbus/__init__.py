@@ -0,0 +1 @@
+from modbus import *
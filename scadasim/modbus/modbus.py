@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+import asyncore
+import socket
+import struct
+import logging
+from scadasim.rpc import SocketService
+
+log = logging.getLogger('scadasim')
+
+READ_COILS = 1
+READ_DISCRETE_INPUTS = 2
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+WRITE_SINGLE_COIL = 5
+WRITE_SINGLE_REGISTER = 6
+WRITE_MULTIPLE_COILS = 15
+WRITE_MULTIPLE_REGISTERS = 16
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+SLAVE_DEVICE_FAILURE = 4
+GATEWAY_TARGET_FAILED = 11
+
+# Register type of the `plcs` config read by each function code
+READS = {READ_COILS: 'c', READ_DISCRETE_INPUTS: 'd', READ_HOLDING_REGISTERS: 'h', READ_INPUT_REGISTERS: 'i'}
+# Most values a single read may return
+READ_LIMITS = {'c': 2000, 'd': 2000, 'h': 125, 'i': 125}
+# Size of the address space of each register type
+ADDRESSES = 0x10000
+
+_mbap = struct.Struct('!HHHB')
+_range = struct.Struct('!BHH')
+
+
+class ModbusError(Exception):
+        """Modbus exception response. `code` is the Modbus exception code
+        """
+        def __init__(self, code, message=''):
+            self.code = code
+            super(ModbusError, self).__init__(message or "Modbus exception %s" % code)
+
+
+def to_register(value):
+    """Clamp a sensor value to an unsigned 16 bit register"""
+    if value is None:
+        return 0
+    return max(0, min(0xffff, int(round(value))))
+
+def pack_bits(bits):
+    data = bytearray((len(bits) + 7) // 8)
+    for i, bit in enumerate(bits):
+        if bit:
+            data[i // 8] |= 1 << (i % 8)
+    return str(data)
+
+def unpack_bits(data, count):
+    data = bytearray(data)
+    return [bool(data[i // 8] & (1 << (i % 8))) for i in range(count)]
+
+
+class _ModbusChannel(asyncore.dispatcher):
+    """One Modbus/TCP client connection. Requests are answered in order."""
+
+    def __init__(self, service, sock, socket_map):
+        asyncore.dispatcher.__init__(self, sock, map=socket_map)
+        self.service = service
+        self.inbuf = ''
+        self.outbuf = ''
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self.inbuf += data
+        while len(self.inbuf) >= _mbap.size:
+            transaction, protocol, length, unit = _mbap.unpack_from(self.inbuf)
+            # `length` counts the unit id and the PDU
+            end = _mbap.size - 1 + length
+            if len(self.inbuf) < end:
+                break
+            pdu, self.inbuf = self.inbuf[_mbap.size:end], self.inbuf[end:]
+            if protocol != 0:
+                continue
+            response = self.service.handle(unit, pdu)
+            self.outbuf += _mbap.pack(transaction, 0, len(response) + 1, unit) + response
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        log.exception("Modbus connection failed")
+        self.close()
+
+
+class ModbusServer(SocketService):
+    """Modbus/TCP front-end for the `plcs` section of the config.
+
+        Each PLC answers on its `slaveid` unit id. Its sensors are mapped to the
+        coils (c), discrete inputs (d), holding registers (h) and input
+        registers (i) at their `data_address`. Range reads and writes touch
+        every sensor of the range in one pass, all within the same tick.
+        Unmapped addresses read as 0.
+    """
+    channel = _ModbusChannel
+
+    def __init__(self, simulator, host="0.0.0.0", port=5020, path=None, loop=None):
+        super(ModbusServer, self).__init__(simulator, host=host, port=port, path=path, loop=loop)
+        self.load_plcs(simulator.plcs)
+
+    def load_plcs(self, plcs):
+        """Build the {unit id: {register type: {address: sensor label}}} tables"""
+        self.units = {}
+        for plc in plcs.values():
+            tables = self.units.setdefault(plc['slaveid'], {'c': {}, 'd': {}, 'h': {}, 'i': {}})
+            for label, sensor in plc['sensors'].items():
+                tables[sensor['register_type']][sensor['data_address']] = label
+
+    def handle(self, unit, pdu):
+        """Answer one request PDU"""
+        function = ord(pdu[0]) if pdu else 0
+        try:
+            if unit not in self.units:
+                raise ModbusError(GATEWAY_TARGET_FAILED)
+            return self.dispatch(self.units[unit], function, pdu)
+        except ModbusError as e:
+            return struct.pack('!BB', (function | 0x80) & 0xff, e.code)
+        except (struct.error, IndexError):
+            return struct.pack('!BB', (function | 0x80) & 0xff, ILLEGAL_DATA_VALUE)
+        except Exception:
+            # e.g. a sensor reading that doesn't fit a register, the connection stays usable
+            log.exception("Modbus request %s of unit %s failed" % (function, unit))
+            return struct.pack('!BB', (function | 0x80) & 0xff, SLAVE_DEVICE_FAILURE)
+
+    def dispatch(self, tables, function, pdu):
+        if function in READS:
+            register_type = READS[function]
+            function, address, count = _range.unpack_from(pdu)
+            values = self.read(tables[register_type], address, count, READ_LIMITS[register_type])
+            if register_type in 'cd':
+                data = pack_bits(values)
+            else:
+                data = struct.pack('!%sH' % count, *[to_register(v) for v in values])
+            return struct.pack('!BB', function, len(data)) + data
+
+        if function == WRITE_SINGLE_COIL:
+            function, address, value = _range.unpack_from(pdu)
+            if value not in (0x0000, 0xff00):
+                raise ModbusError(ILLEGAL_DATA_VALUE)
+            self.write(tables['c'], address, [value == 0xff00])
+            return pdu[:_range.size]
+
+        if function == WRITE_SINGLE_REGISTER:
+            function, address, value = _range.unpack_from(pdu)
+            self.write(tables['h'], address, [value])
+            return pdu[:_range.size]
+
+        if function in (WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS):
+            function, address, count = _range.unpack_from(pdu)
+            data = pdu[_range.size + 1:]
+            if function == WRITE_MULTIPLE_COILS:
+                values = unpack_bits(data, count)
+                self.write(tables['c'], address, values)
+            else:
+                values = struct.unpack_from('!%sH' % count, data)
+                self.write(tables['h'], address, values)
+            return pdu[:_range.size]
+
+        raise ModbusError(ILLEGAL_FUNCTION)
+
+    def read(self, table, address, count, limit):
+        if not 1 <= count <= limit:
+            raise ModbusError(ILLEGAL_DATA_VALUE)
+        if address + count > ADDRESSES:
+            raise ModbusError(ILLEGAL_DATA_ADDRESS)
+        addresses = range(address, address + count)
+        mapped = [a for a in addresses if a in table]
+        timestamp, values = self.simulator.read_sensors(sensors=[table[a] for a in mapped])
+        values = dict(zip(mapped, values))
+        return [values.get(a, 0) for a in addresses]
+
+    def write(self, table, address, values):
+        if address + len(values) > ADDRESSES:
+            raise ModbusError(ILLEGAL_DATA_ADDRESS)
+        addresses = range(address, address + len(values))
+        if any(a not in table for a in addresses):
+            raise ModbusError(ILLEGAL_DATA_ADDRESS)
+        self.simulator.write_sensors(dict((table[a], v) for a, v in zip(addresses, values)))
+
+
+class ModbusClient(object):
+    """Minimal blocking Modbus/TCP client, e.g. for tests and load generation"""
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.transaction = 0
+
+    def call(self, unit, pdu):
+        """Send one request PDU and return the response PDU"""
+        self.transaction = (self.transaction + 1) & 0xffff
+        self.sock.sendall(_mbap.pack(self.transaction, 0, len(pdu) + 1, unit) + pdu)
+        transaction, protocol, length, unit = _mbap.unpack(self._recv(_mbap.size))
+        response = self._recv(length - 1)
+        if ord(response[0]) & 0x80:
+            raise ModbusError(ord(response[1]))
+        return response
+
+    def _recv(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ModbusError(GATEWAY_TARGET_FAILED, "Connection closed")
+            data += chunk
+        return data
+
+    def read_bits(self, unit, function, address, count):
+        response = self.call(unit, _range.pack(function, address, count))
+        return unpack_bits(response[2:], count)
+
+    def read_registers(self, unit, function, address, count):
+        response = self.call(unit, _range.pack(function, address, count))
+        return list(struct.unpack_from('!%sH' % count, response, 2))
+
+    def read_coils(self, unit, address, count=1):
+        return self.read_bits(unit, READ_COILS, address, count)
+
+    def read_discrete_inputs(self, unit, address, count=1):
+        return self.read_bits(unit, READ_DISCRETE_INPUTS, address, count)
+
+    def read_holding_registers(self, unit, address, count=1):
+        return self.read_registers(unit, READ_HOLDING_REGISTERS, address, count)
+
+    def read_input_registers(self, unit, address, count=1):
+        return self.read_registers(unit, READ_INPUT_REGISTERS, address, count)
+
+    def write_coil(self, unit, address, value):
+        self.call(unit, _range.pack(WRITE_SINGLE_COIL, address, 0xff00 if value else 0))
+
+    def write_register(self, unit, address, value):
+        self.call(unit, _range.pack(WRITE_SINGLE_REGISTER, address, value))
+
+    def write_coils(self, unit, address, values):
+        data = pack_bits(values)
+        self.call(unit, _range.pack(WRITE_MULTIPLE_COILS, address, len(values)) + chr(len(data)) + data)
+
+    def write_registers(self, unit, address, values):
+        data = struct.pack('!%sH' % len(values), *values)
+        self.call(unit, _range.pack(WRITE_MULTIPLE_REGISTERS, address, len(values)) + chr(len(data)) + data)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import threading
+import select
+import logging
+
+log = logging.getLogger('scadasim')
+
+
+class Partitions(object):
+    """Run the partitions of a simulation (see `utils.find_partitions`) in `processes`
+        worker processes, so independent parts of the plant don't share a GIL.
+
+        Workers are forked once the simulation is built, so they inherit the devices
+        without parsing the config again. Each worker runs a `Simulator` over its share
+        of the devices and sends the sensor values that changed back to `simulator`,
+        where they are merged into its snapshot at tick boundaries. Sensor writes are
+        forwarded to the worker owning the sensor.
+    """
+
+    def __init__(self, simulator, simulation, processes):
+        self.simulator = simulator
+        self.realtime = simulator.realtime
+        self.lock = threading.Lock()
+
+        # Spread the partitions over the processes, largest first onto the least loaded
+        shares = [[] for _ in range(min(processes, len(simulation['partitions'])))]
+        for labels in simulation['partitions']:
+            min(shares, key=len).extend(labels)
+
+        self.workers = []
+        self.owners = {}
+        for share in shares:
+            command_reader, command_writer = multiprocessing.Pipe(duplex=False)
+            update_reader, update_writer = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_worker, name='scadasim-partition',
+                                              args=(simulator, simulation, share, command_reader, update_writer))
+            process.daemon = True
+            process.start()
+            # The worker owns these ends now
+            command_reader.close()
+            update_writer.close()
+            worker = len(self.workers)
+            self.workers.append((process, command_writer, update_reader))
+            for label in share:
+                if label in simulation['sensors']:
+                    self.owners[label] = worker
+
+        log.info("Running %s partitions in %s processes" % (len(simulation['partitions']), len(shares)))
+
+        # Every worker starts by sending all of its sensor values
+        for process, commands, updates in self.workers:
+            self.merge(updates.recv())
+
+        self.receiver = None
+        if self.realtime:
+            self.receiver = threading.Thread(target=self._receive, name='scadasim-partitions')
+            self.receiver.daemon = True
+            self.receiver.start()
+
+    def merge(self, update):
+        """Merge the (time, tick, values) sent by a worker into the snapshot of the simulator"""
+        with self.lock:
+            self.simulator.merge_snapshot(*update)
+
+    def _receive(self):
+        connections = dict((updates.fileno(), updates) for process, commands, updates in self.workers)
+        while connections:
+            ready, _, _ = select.select(list(connections), [], [])
+            for fileno in ready:
+                try:
+                    self.merge(connections[fileno].recv())
+                except EOFError:
+                    del connections[fileno]
+
+    def send(self, *command):
+        for process, commands, updates in self.workers:
+            commands.send(command)
+
+    def write_sensors(self, values):
+        """Forward the {label: value} writes to the workers owning the sensors"""
+        batches = {}
+        for label, value in values.iteritems():
+            batches.setdefault(self.owners[label], {})[label] = value
+        for worker, batch in batches.iteritems():
+            self.workers[worker][1].send(('write_sensors', batch))
+
+    def step(self, steps):
+        """Step every worker `steps` fixed steps and merge their results"""
+        self.send('step', steps)
+        for process, commands, updates in self.workers:
+            self.merge(updates.recv())
+
+    def close(self):
+        """Stop the worker processes"""
+        self.send('stop')
+        for process, commands, updates in self.workers:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.workers = []
+        if self.receiver:
+            self.receiver.join(5)
+
+
+class _PartitionWorker(object):
+    """Worker process side: collect the sensor values that changed and send them to the parent"""
+
+    def __init__(self, simulator, updates):
+        self.simulator = simulator
+        self.updates = updates
+        self.changed = set()
+        for sensor in simulator.sensors.values():
+            sensor.add_observer(self)
+
+    def device_changed(self, sensor, name):
+        self.changed.add(sensor.label)
+
+    def collect(self):
+        """Called by the scheduler after the snapshot is published"""
+        if self.simulator.realtime:
+            self.send()
+
+    def send(self):
+        snapshot = self.simulator.snapshot
+        changed, self.changed = self.changed, set()
+        changed.update(self.simulator.polled_sensors)
+        self.updates.send((snapshot.time, snapshot.tick, dict((label, snapshot.values[label]) for label in changed)))
+
+
+def _run_worker(parent, simulation, labels, commands, updates):
+    labels = set(labels)
+    # Recording and sharing the state is left to the parent
+    settings = dict((key, value) for key, value in simulation['settings'].iteritems()
+                    if key not in ('historian', 'shared_state'))
+    simulator = type(parent)(realtime=parent.realtime, step_size=parent.step_size, engine=parent.engine_type)
+    simulator.load({
+        'settings': settings,
+        'devices': dict((label, d) for label, d in simulation['devices'].iteritems() if label in labels),
+        'sensors': dict((label, s) for label, s in simulation['sensors'].iteritems() if label in labels),
+        'plcs': {},
+        'partitions': [sorted(labels)]})
+    worker = _PartitionWorker(simulator, updates)
+    simulator.scheduler.after_tick.append(worker.collect)
+
+    snapshot = simulator.snapshot
+    updates.send((snapshot.time, snapshot.tick, snapshot.values))
+
+    try:
+        while True:
+            command = commands.recv()
+            if command[0] == 'stop':
+                break
+            getattr(simulator, command[0])(*command[1:])
+            if command[0] == 'step':
+                worker.send()
+    except (EOFError, KeyboardInterrupt):
+        pass
+    simulator.deactivate()
+    simulator.scheduler.stop()
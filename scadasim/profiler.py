@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import collections
+import logging
+import json
+import time
+import os
+
+log = logging.getLogger('scadasim')
+
+
+class DeviceStats(object):
+    """Timings of one device. Times are in seconds"""
+    __slots__ = ('calls', 'total', 'max', 'lag_max', 'inputs', 'outputs')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lag_max = 0.0
+        self.inputs = 0
+        self.outputs = 0
+
+    def report(self):
+        return {'calls': self.calls, 'total_s': self.total, 'max_s': self.max,
+                'mean_s': self.total / self.calls if self.calls else 0.0,
+                'lag_max_s': self.lag_max, 'inputs': self.inputs, 'outputs': self.outputs}
+
+
+class Profiler(object):
+    """Record per-device run counts and times, `receive()`/`output()` fan-out and scheduler lag.
+
+        The scheduler hands each tick to `run()` while a profiler is set, so nothing is
+        measured, or paid for, when profiling is off. Fan-out is counted for the devices given
+        to `instrument()`, until `restore()`, through the `profile` stats each of them points to
+        (see `devices.deliver()` and `devices.draw()`), so simulations profiled in the same
+        process don't count each other's devices. Devices a pump reaches through its cached
+        flow paths, e.g. the valves between it and a tank, count as if the fluid had been
+        pushed or pulled through them.
+        Fluid reaches devices through `receive()`, which calls `input()` unless overridden.
+        Writes actuated at once (see `Simulator.set_actuation()`) are timed by `actuated()`.
+    """
+
+    def __init__(self):
+        self.devices = collections.defaultdict(DeviceStats)
+        self.instrumented = []
+        self.reset()
+
+    def reset(self):
+        self.devices.clear()
+        for device in self.instrumented:
+            device.profile = self.devices[device]
+        self.ticks = 0
+        self.tick_total = 0.0
+        self.tick_max = 0.0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.actuations = 0
+        self.actuation_total = 0.0
+        self.actuation_max = 0.0
+        self.actuated_pumps = 0
+        self.started = time.time()
+
+    def run(self, scheduler, due):
+        """Run the `due` devices of one tick of `scheduler`, timing each of them"""
+        tick_started = time.time()
+        lag = max(0.0, scheduler.now() - scheduler.due_at)
+        self.ticks += 1
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+
+        devices = self.devices
+        started = tick_started
+        for device in due:
+            try:
+                device.run()
+            except Exception:
+                log.exception("%s: worker failed" % device)
+            # One clock read per device: each device starts when the previous one finished
+            finished = time.time()
+            elapsed = finished - started
+            stats = devices[device]
+            stats.calls += 1
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+            # Late by the lag of the tick plus the devices that ran before it
+            if lag + started - tick_started > stats.lag_max:
+                stats.lag_max = lag + started - tick_started
+            started = finished
+
+        duration = started - tick_started
+        self.tick_total += duration
+        self.tick_max = max(self.tick_max, duration)
+
+    def actuated(self, latency, pumps):
+        """Record a write actuated at once: `latency` seconds from the write to the published
+            snapshot, moving the fluid of `pumps` pumps
+        """
+        self.actuations += 1
+        self.actuation_total += latency
+        self.actuation_max = max(self.actuation_max, latency)
+        self.actuated_pumps += pumps
+
+    def instrument(self, devices):
+        """Count the `receive()` and `output()` calls each of `devices` receives"""
+        for device in devices:
+            device.profile = self.devices[device]
+            self.instrumented.append(device)
+
+    def restore(self):
+        """Stop counting the calls to the devices given to `instrument()`"""
+        for device in self.instrumented:
+            device.profile = None
+        self.instrumented = []
+
+    def report(self, top=None):
+        """Profile as a dict. `top` limits the devices to the ones with the most run time"""
+        devices = sorted(self.devices.items(), key=lambda item: -item[1].total)
+        if top:
+            devices = devices[:top]
+        return {
+            'seconds': time.time() - self.started,
+            'ticks': {'count': self.ticks, 'total_s': self.tick_total, 'max_s': self.tick_max,
+                      'mean_s': self.tick_total / self.ticks if self.ticks else 0.0},
+            'lag': {'max_s': self.lag_max, 'mean_s': self.lag_total / self.ticks if self.ticks else 0.0},
+            'actuation': {'count': self.actuations, 'max_s': self.actuation_max, 'pumps': self.actuated_pumps,
+                          'mean_s': self.actuation_total / self.actuations if self.actuations else 0.0},
+            'devices': dict((_label(device), stats.report()) for device, stats in devices)}
+
+
+class ProfileDump(object):
+    """After-tick hook writing the report of `profiler` every `interval` seconds,
+        as JSON to `path` or to the log
+    """
+
+    def __init__(self, profiler, interval, path=None, top=None):
+        self.profiler = profiler
+        self.interval = interval
+        self.path = path
+        self.top = top
+        self.next_dump = time.time() + interval
+
+    def __call__(self):
+        if time.time() >= self.next_dump:
+            self.next_dump = time.time() + self.interval
+            self.dump()
+
+    def dump(self):
+        report = json.dumps(self.profiler.report(self.top), sort_keys=True)
+        if not self.path:
+            log.info("Profile: %s" % report)
+            return
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as stream:
+            stream.write(report)
+        os.rename(tmp_path, self.path)
+
+
+def _label(device):
+    return getattr(device, 'label', None) or repr(device)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+import threading
+import itertools
+import asyncore
+import socket
+import struct
+import logging
+import os
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+
+log = logging.getLogger('scadasim')
+
+
+class BulkRPCServer(threading.Thread):
+    """XML-RPC service reading and writing many sensors per call.
+
+        Every call is answered from a single simulation tick and returns
+        [timestamp, values] so PLCs and HMIs can poll all of their points in
+        one round trip instead of one per point.
+    """
+
+    def __init__(self, simulator, rpc_ip="0.0.0.0", rpc_port=8001):
+        super(BulkRPCServer, self).__init__(name='scadasim-bulkrpc')
+        self.daemon = True
+        self.simulator = simulator
+        self.server = SimpleXMLRPCServer((rpc_ip, rpc_port), logRequests=False, allow_none=True)
+        self.server.register_function(self.plc_sensors)
+        self.server.register_function(self.read_sensors)
+        self.server.register_function(self.write_sensors)
+        self.server.register_function(self.profile)
+        self.server.register_function(self.set_profiling)
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def plc_sensors(self, plc):
+        """Sensor labels of `plc` in the order `read_sensors(plc)` returns them"""
+        return self.simulator.plc_sensors(plc)
+
+    def read_sensors(self, plc=None, sensors=None):
+        """Read `sensors`, or every sensor of `plc`"""
+        return self.simulator.read_sensors(plc=plc, sensors=sensors)
+
+    def write_sensors(self, values):
+        """Write a {sensor label: value} mapping"""
+        return self.simulator.write_sensors(values)
+
+    def profile(self, top=None):
+        """Per-device timings, fan-out and scheduler lag. Empty while profiling is off"""
+        return self.simulator.profile(top=top)
+
+    def set_profiling(self, enabled):
+        """Turn profiling on or off"""
+        if enabled:
+            self.simulator.enable_profiling()
+        else:
+            self.simulator.disable_profiling()
+        return True
+
+    def run(self):
+        log.info("Bulk RPC service listening on %s:%s" % self.address)
+        self.server.serve_forever()
+
+    def stop_server(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Binary protocol
+#
+# Every message is a frame: a 4 byte big-endian length followed by the payload.
+# Requests:  u8 opcode, u32 request id, body
+# Responses: u8 status, u32 request id, f64 timestamp, u16 count, `count` values
+#            or u8 status (ERROR), u32 request id, str message
+# Strings are a u16 length followed by UTF-8 bytes. Values are a one byte tag
+# followed by the packed value.
+
+READ_SENSOR = 1     # str plc, str sensor
+WRITE_SENSOR = 2    # str plc, str sensor, value
+READ_SENSORS = 3    # str plc, u16 count, `count` str sensors (none: every sensor of plc)
+WRITE_SENSORS = 4   # u16 count, `count` (str sensor, value)
+
+OK = 0
+ERROR = 1
+
+_length = struct.Struct('!I')
+_request = struct.Struct('!BI')
+_response = struct.Struct('!BIdH')
+_count = struct.Struct('!H')
+_values = {'?': struct.Struct('!?'), 'q': struct.Struct('!q'), 'd': struct.Struct('!d')}
+
+
+class ProtocolError(Exception):
+        """Exception thrown for malformed frames or failed remote calls
+        """
+        def __init__(self, message):
+            super(ProtocolError, self).__init__(message)
+
+
+def pack_str(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return _count.pack(len(value)) + value
+
+def unpack_str(data, offset):
+    length, = _count.unpack_from(data, offset)
+    offset += _count.size
+    return data[offset:offset + length], offset + length
+
+def pack_value(value):
+    if value is None:
+        return 'N'
+    if isinstance(value, bool):
+        return '?' + _values['?'].pack(value)
+    if isinstance(value, (int, long)):
+        return 'q' + _values['q'].pack(value)
+    if isinstance(value, float):
+        return 'd' + _values['d'].pack(value)
+    if isinstance(value, basestring):
+        return 's' + pack_str(value)
+    # e.g. the fluid reported by pass-through sensors
+    return 's' + pack_str(str(value))
+
+def unpack_value(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == 'N':
+        return None, offset
+    if tag == 's':
+        return unpack_str(data, offset)
+    if tag not in _values:
+        raise ProtocolError("Unknown value tag %r" % tag)
+    return _values[tag].unpack_from(data, offset)[0], offset + _values[tag].size
+
+def frame(payload):
+    return _length.pack(len(payload)) + payload
+
+
+class _BinaryChannel(asyncore.dispatcher):
+    """One persistent client connection. Requests are answered in order."""
+
+    def __init__(self, service, sock, socket_map):
+        asyncore.dispatcher.__init__(self, sock, map=socket_map)
+        self.service = service
+        self.inbuf = ''
+        self.outbuf = ''
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self.inbuf += data
+        while len(self.inbuf) >= _length.size:
+            length, = _length.unpack_from(self.inbuf)
+            end = _length.size + length
+            if len(self.inbuf) < end:
+                break
+            payload, self.inbuf = self.inbuf[_length.size:end], self.inbuf[end:]
+            self.outbuf += frame(self.service.handle(payload))
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        log.exception("Binary RPC connection failed")
+        self.close()
+
+
+class SocketListener(asyncore.dispatcher):
+    """Accept TCP or Unix socket connections on an asyncore map and hand each one
+        to a new `channel(service, sock, socket_map)`
+    """
+
+    def __init__(self, service, channel, family, address, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.service = service
+        self.channel = channel
+        self.socket_map = socket_map
+        self.create_socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, address = pair
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.channel(self.service, sock, self.socket_map)
+
+
+class SocketService(threading.Thread):
+    """Serve `channel` connections on TCP `host`:`port`, or on the Unix socket `path`.
+
+        All connections are multiplexed by one asyncore loop running in this
+        thread, so there is no thread per client. With `loop` (an `eventloop.EventLoop`)
+        the connections are served by that loop instead and no thread is started.
+    """
+    channel = None
+
+    def __init__(self, simulator, host="0.0.0.0", port=0, path=None, loop=None):
+        super(SocketService, self).__init__(name='scadasim-%s' % self.__class__.__name__.lower())
+        self.daemon = True
+        self.simulator = simulator
+        self.path = path
+        self.loop = loop
+        self.socket_map = loop.socket_map if loop else {}
+        self.stopped = False
+        if path:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.listener = SocketListener(self, self.channel, socket.AF_UNIX, path, self.socket_map)
+        else:
+            self.listener = SocketListener(self, self.channel, socket.AF_INET, (host, port), self.socket_map)
+
+    @property
+    def address(self):
+        return self.listener.socket.getsockname()
+
+    def start(self):
+        if self.loop is None:
+            super(SocketService, self).start()
+        else:
+            # The listener is already in the socket map of the loop
+            log.info("%s listening on %s" % (self.__class__.__name__, self.address))
+
+    def run(self):
+        log.info("%s listening on %s" % (self.__class__.__name__, self.address))
+        while not self.stopped:
+            asyncore.loop(timeout=0.1, use_poll=True, map=self.socket_map, count=1)
+
+    def stop_server(self):
+        self.stopped = True
+        if self.is_alive():
+            self.join()
+        # The map of a loop holds the connections of other services too
+        for channel in self.socket_map.values():
+            if getattr(channel, 'service', None) is self:
+                channel.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class BinaryRPCServer(SocketService):
+    """Serve read_sensor/write_sensor and their bulk variants over persistent
+        TCP or Unix socket connections using length-prefixed binary frames.
+        Requests may be pipelined.
+    """
+    channel = _BinaryChannel
+
+    def __init__(self, simulator, host="0.0.0.0", port=8002, path=None, loop=None):
+        super(BinaryRPCServer, self).__init__(simulator, host=host, port=port, path=path, loop=loop)
+
+    def handle(self, payload):
+        """Answer one request payload"""
+        request_id = 0
+        try:
+            opcode, request_id = _request.unpack_from(payload)
+            timestamp, values = self.dispatch(opcode, payload, _request.size)
+            return _response.pack(OK, request_id, timestamp, len(values)) + ''.join(pack_value(v) for v in values)
+        except Exception as e:
+            log.debug("Binary RPC request failed: %r" % e)
+            return struct.pack('!BI', ERROR, request_id) + pack_str("%s: %s" % (e.__class__.__name__, e))
+
+    def dispatch(self, opcode, data, offset):
+        simulator = self.simulator
+        if opcode == READ_SENSOR:
+            plc, offset = unpack_str(data, offset)
+            sensor, offset = unpack_str(data, offset)
+            timestamp, value = simulator.read_sensor(plc, sensor)
+            return timestamp, [value]
+        if opcode == WRITE_SENSOR:
+            plc, offset = unpack_str(data, offset)
+            sensor, offset = unpack_str(data, offset)
+            value, offset = unpack_value(data, offset)
+            timestamp, result = simulator.write_sensor(plc, sensor, value)
+            return timestamp, [result]
+        if opcode == READ_SENSORS:
+            plc, offset = unpack_str(data, offset)
+            count, = _count.unpack_from(data, offset)
+            offset += _count.size
+            sensors = []
+            for _ in range(count):
+                sensor, offset = unpack_str(data, offset)
+                sensors.append(sensor)
+            return simulator.read_sensors(plc=plc or None, sensors=sensors or None)
+        if opcode == WRITE_SENSORS:
+            count, = _count.unpack_from(data, offset)
+            offset += _count.size
+            values = {}
+            for _ in range(count):
+                sensor, offset = unpack_str(data, offset)
+                values[sensor], offset = unpack_value(data, offset)
+            return simulator.write_sensors(values)
+        raise ProtocolError("Unknown opcode %s" % opcode)
+
+
+class BinaryRPCClient(object):
+    """Blocking client for `BinaryRPCServer` over one persistent connection.
+        `address` is a (host, port) tuple or the path of a Unix socket.
+    """
+
+    def __init__(self, address):
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(address)
+        self.request_ids = itertools.count(1)
+        self.timestamp = None
+
+    def call(self, opcode, body):
+        """Send one request and return the list of values in the response"""
+        request_id = next(self.request_ids) & 0xffffffff
+        self.sock.sendall(frame(_request.pack(opcode, request_id) + body))
+        data = self._recv(_length.unpack(self._recv(_length.size))[0])
+        status, response_id = _request.unpack_from(data)
+        if response_id != request_id:
+            raise ProtocolError("Response %s does not match request %s" % (response_id, request_id))
+        if status != OK:
+            raise ProtocolError(unpack_str(data, _request.size)[0])
+        status, response_id, self.timestamp, count = _response.unpack_from(data)
+        values = []
+        offset = _response.size
+        for _ in range(count):
+            value, offset = unpack_value(data, offset)
+            values.append(value)
+        return values
+
+    def _recv(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ProtocolError("Connection closed")
+            data += chunk
+        return data
+
+    def read_sensor(self, plc, sensor):
+        return self.call(READ_SENSOR, pack_str(plc) + pack_str(sensor))[0]
+
+    def write_sensor(self, plc, sensor, value):
+        return self.call(WRITE_SENSOR, pack_str(plc) + pack_str(sensor) + pack_value(value))[0]
+
+    def read_sensors(self, plc=None, sensors=None):
+        sensors = sensors or []
+        return self.call(READ_SENSORS, pack_str(plc or '') + _count.pack(len(sensors)) + ''.join(pack_str(s) for s in sensors))
+
+    def write_sensors(self, values):
+        return self.call(WRITE_SENSORS, _count.pack(len(values)) + ''.join(pack_str(s) + pack_value(v) for s, v in sorted(values.items())))
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+import threading
+import itertools
+import heapq
+import logging
+import time
+
+log = logging.getLogger('scadasim')
+
+
+class Scheduler(object):
+    """Drive the `run()` method of every active device from a single thread.
+
+        Devices are kept in a heap ordered by their next run time, so the cost
+        of each tick does not depend on how many devices are being simulated.
+        Devices that are due at the same time run together as one tick while
+        holding `lock`. Hold `lock` to see the simulation between ticks.
+        The callables in `before_tick` and `after_tick` run at every tick boundary.
+        While `profiler` is set, ticks are run and timed by it (see `profiler.Profiler`).
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.ticks = 0
+        self.before_tick = []
+        self.after_tick = []
+        self.profiler = None
+        # Time the current tick was due
+        self.due_at = 0
+        self._queue = []
+        self._pending = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        # Next run of the devices that ran out of turn, see `run_now()`
+        self._early = {}
+        self._thread = None
+        self.running = False
+
+    def now(self):
+        return time.time()
+
+    def add(self, device):
+        """Run `device` now and keep it scheduled while it is active"""
+        self.start()
+        with self.lock:
+            device.run()
+
+    def schedule(self, device):
+        """Queue the next run of `device` based on its `speed` and `worker_frequency`
+        """
+        period = device.speed * device.worker_frequency
+        now = self.now()
+        # Align runs to multiples of the period, as the old Timer loop did
+        self._push(device, now + (-now % period))
+
+    def queue(self, runs):
+        """Queue the (device, run time) `runs` at once, replacing the queued runs of the devices"""
+        with self._condition:
+            for device, run_at in runs:
+                seq = next(self._counter)
+                self._pending[id(device)] = seq
+                self._queue.append((run_at, self._rank(device), seq, device))
+            heapq.heapify(self._queue)
+            self._condition.notify()
+
+    def _rank(self, device):
+        return 0
+
+    def run_now(self, devices):
+        """Run the workers of the active `devices` at once, out of turn. The run takes the
+            place of the next run of each device, so it keeps its rate. A device runs out of
+            turn once per period at most, later calls leave it to its next run.
+            Returns the devices that ran
+        """
+        ran = []
+        with self.lock:
+            now = self.now()
+            for device in devices:
+                if not device.active:
+                    continue
+                period = device.speed * device.worker_frequency
+                next_run = now + (-now % period)
+                if self._early.get(device, 0) > next_run + period / 2.0:
+                    continue
+                try:
+                    device.worker()
+                except Exception:
+                    log.exception("%s: worker failed" % device)
+                self._early[device] = next_run + period
+                self._push(device, next_run + period, self._rank(device))
+                ran.append(device)
+        return ran
+
+    def queued(self):
+        """{device: run time} of every queued run"""
+        with self._condition:
+            return dict((device, run_at) for run_at, rank, seq, device in self._queue
+                        if self._pending.get(id(device)) == seq)
+
+    def clear(self):
+        """Drop every queued run"""
+        with self._condition:
+            self._queue = []
+            self._pending = {}
+
+    def _push(self, device, run_at, rank=0):
+        with self._condition:
+            seq = next(self._counter)
+            # Only the most recent entry of a device is valid. Older ones are skipped.
+            self._pending[id(device)] = seq
+            heapq.heappush(self._queue, (run_at, rank, seq, device))
+            self._condition.notify()
+
+    def start(self):
+        """Start the scheduler thread if it isn't already running"""
+        with self._condition:
+            if self.running:
+                return
+            self.running = True
+            self._thread = threading.Thread(target=self._loop, name='scadasim-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop the scheduler thread. Queued runs are dropped"""
+        with self._condition:
+            self.running = False
+            self._queue = []
+            self._pending = {}
+            self._condition.notify()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _pop_due(self, now):
+        """Remove and return every queued device due at `now`, in run order"""
+        due = []
+        if self._queue:
+            self.due_at = self._queue[0][0]
+        while self._queue and self._queue[0][0] <= now:
+            run_at, rank, seq, device = heapq.heappop(self._queue)
+            if self._pending.get(id(device)) == seq:
+                del self._pending[id(device)]
+                due.append(device)
+        return due
+
+    def _next_tick(self):
+        """Block until the earliest queued device is due and return all devices due by then"""
+        with self._condition:
+            while self.running:
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                delay = self._queue[0][0] - self.now()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                due = self._pop_due(self.now())
+                if due:
+                    return due
+        return []
+
+    def _loop(self):
+        while self.running:
+            due = self._next_tick()
+            with self.lock:
+                self._tick(due)
+
+    def _tick(self, due):
+        """Run the `due` devices as one tick"""
+        for hook in self.before_tick:
+            try:
+                hook()
+            except Exception:
+                log.exception("%r: tick hook failed" % hook)
+        if self.profiler is None:
+            for device in due:
+                try:
+                    device.run()
+                except Exception:
+                    log.exception("%s: worker failed" % device)
+        else:
+            self.profiler.run(self, due)
+        self.ticks += 1
+        for hook in self.after_tick:
+            try:
+                hook()
+            except Exception:
+                log.exception("%r: tick hook failed" % hook)
+
+
+class LoopScheduler(Scheduler):
+    """Run devices against the wall clock from an `eventloop.EventLoop` instead of a thread.
+
+        The loop waits until `next_run()` and calls `run_due()`, so many schedulers,
+        one per simulation, share the thread running the loop.
+    """
+
+    def __init__(self, loop):
+        super(LoopScheduler, self).__init__()
+        self.loop = loop
+
+    def start(self):
+        """Register with the loop if not already running"""
+        with self._condition:
+            if self.running:
+                return
+            self.running = True
+        self.loop.add_scheduler(self)
+
+    def stop(self):
+        """Leave the loop. Queued runs are dropped"""
+        with self._condition:
+            self.running = False
+            self._queue = []
+            self._pending = {}
+        self.loop.remove_scheduler(self)
+
+    def _push(self, device, run_at, rank=0):
+        super(LoopScheduler, self)._push(device, run_at, rank)
+        # The loop may be waiting past this run
+        self.loop.wake()
+
+    def next_run(self):
+        """Time the earliest queued run is due, None when nothing is queued"""
+        with self._condition:
+            return self._queue[0][0] if self._queue else None
+
+    def run_due(self, now):
+        """Run the devices due at `now` as one tick"""
+        with self._condition:
+            due = self._pop_due(now)
+        if due:
+            with self.lock:
+                self._tick(due)
+
+
+class FixedStepScheduler(Scheduler):
+    """Run devices against a virtual clock that advances in fixed steps.
+
+        Nothing waits on the wall clock. Each step runs every device that is due,
+        in the order given by `order` (device -> rank), then advances the clock
+        by `step_size` simulated seconds. Runs are fully deterministic.
+    """
+
+    def __init__(self, step_size=1, order=None):
+        super(FixedStepScheduler, self).__init__()
+        self.step_size = step_size
+        self.ticks = 0
+        self.order = order or {}
+
+    def now(self):
+        return self.ticks * self.step_size
+
+    def add(self, device):
+        """Queue `device` to run on the current step"""
+        self._push(device, self.now(), self.order.get(device, len(self.order)))
+
+    def schedule(self, device):
+        """Queue the next run of `device` `worker_frequency` simulated seconds from now"""
+        self._push(device, self.now() + device.worker_frequency, self.order.get(device, len(self.order)))
+
+    def _rank(self, device):
+        return self.order.get(device, len(self.order))
+
+    def start(self):
+        """The clock only moves through `step()`, so there is no thread to start"""
+        self.running = True
+
+    def step(self, steps=1):
+        """Run `steps` fixed steps as fast as possible"""
+        for _ in range(steps):
+            with self.lock:
+                # Tolerate float drift when comparing run times against the clock
+                self._tick(self._pop_due(self.now() + 1e-9))
+
+    def run_until(self, t):
+        """Step until the clock reaches simulated time `t`"""
+        while self.now() < t:
+            self.step()
+
+
+default_scheduler = Scheduler()
@@ -1,36 +1,40 @@
 #!/usr/bin/env python
 
-from scadasim.devices import Device
+from scadasim.devices import Device, Field, push, pull
 import logging
 
 log = logging.getLogger('scadasim')
 
 # Sensors
 class Sensor(Device):
-    def __init__(self, worker_frequency=1, **kwargs):
-        self.fluid = None
+    passes_upstream = True
+    passes_downstream = True
+    # The sensor calls `changed()` whenever its reading changes, so there is no need to poll it.
+    # Set to False for custom sensors whose reading has to be polled every tick.
+    change_driven = True
+
+    __slots__ = ('device_to_monitor',)
+
+    def __init__(self, worker_frequency=None, **kwargs):
         self.device_to_monitor = None
-        super(Sensor, self).__init__(device_type="sensor", worker_frequency=worker_frequency, **kwargs)
+        super(Sensor, self).__init__(device_type="sensor", worker_frequency=_frequency(self, worker_frequency),
+                                     **kwargs)
 
     def output(self, to_device, volume):
         """Output used for pass-through sensors.
-            If a connected device requests output, pass it upstream to the next device
+            If a connected device requests output, pass it upstream to the next devices
         """
-        available_volume = 0
-        for i in self.inputs:
-            available_volume = self.inputs[i].output(self, volume=volume)
-        return available_volume
+        return pull(self, volume)
 
     def input(self, fluid, volume):
         """When fluid comes in, store the fluid context, and pass it downstream to all connected devices
         """
         self.fluid = fluid
-        accepted_volume = 0
-        for o in self.outputs:
-            # Send the fluid on to all outputs
-            #log.debug("%s sending fluid to %s" % (self, self.outputs[o]))
-            accepted_volume = self.outputs[o].input(fluid, volume)
-        return accepted_volume
+        return push(self, fluid, volume, fluid)
+
+    def pass_fluid(self, fluid):
+        """Record the fluid flowing through pass-through sensors"""
+        self.fluid = fluid
 
     def worker(self):
         """Do something at `worker_frequency` rate
@@ -38,9 +42,15 @@ class Sensor(Device):
         pass
 
     def monitor_device(self, device):
-        """Attach to a device
+        """Attach to a device and follow its changes
         """
         self.device_to_monitor = device
+        device.add_observer(self)
+
+    def device_changed(self, device, name):
+        """Called when a field of the monitored device changes
+        """
+        pass
 
     def read_sensor(self):
         """ Report sensor value
@@ -57,22 +67,39 @@ class Sensor(Device):
 class pHSensor(Sensor):
     yaml_tag = u'!ph'
 
-    def __init__(self, connected_to=None, **kwargs):
-        self.ph = None
+    __slots__ = ('_ph',)
+
+    # pH of the monitored tank, or of the last fluid that passed through
+    ph = Field('ph')
+
+    def __init__(self, connected_to=None, worker_frequency=None, **kwargs):
         self.device_to_monitor = connected_to
-        super(Sensor, self).__init__(device_type="sensor", **kwargs)
+        super(Sensor, self).__init__(device_type="sensor", worker_frequency=_frequency(self, worker_frequency),
+                                     **kwargs)
+        self.ph = None
+
+    def monitor_device(self, device):
+        super(pHSensor, self).monitor_device(device)
+        self.ph = getattr(device, 'ph', None)
+
+    def device_changed(self, device, name):
+        if name == 'ph':
+            # Notifies the observers of the sensor when the reading changes
+            self.ph = device.ph
+
+    def pass_stream(self, fluid, source):
+        self.fluid = fluid
+        self.ph = getattr(source, 'ph', None)
 
     def input(self, fluid, volume):
         """When fluid comes in, store the fluid context, and pass it downstream to all connected devices
         """
+        self.fluid = fluid
         self.ph = fluid.ph
 
-        log.debug("ph: ", self.ph)
-        
-        accepted_volume = 0
-        for o in self.outputs:
-            accepted_volume = self.outputs[o].input(fluid, volume)
-        return accepted_volume
+        log.debug("ph: %s" % self.ph)
+
+        return push(self, fluid, volume, fluid)
 
     def read_sensor(self):
         """ Report sensor value
@@ -82,9 +109,16 @@ class pHSensor(Sensor):
 class StateSensor(Sensor):
     yaml_tag = u'!state'
 
-    def __init__(self, connected_to=None, **kwargs):
+    __slots__ = ()
+
+    def __init__(self, connected_to=None, worker_frequency=None, **kwargs):
         self.device_to_monitor = connected_to
-        super(Sensor, self).__init__(device_type="sensor", **kwargs)
+        super(Sensor, self).__init__(device_type="sensor", worker_frequency=_frequency(self, worker_frequency),
+                                     **kwargs)
+
+    def device_changed(self, device, name):
+        if name == 'state':
+            self.changed('state')
 
     def read_sensor(self):
         """ Report device state
@@ -95,16 +129,29 @@ class StateSensor(Sensor):
         """ set device state
         """
         if state is not None:
-            self.device_to_monitor.write_state(state)
-        
+            return self.device_to_monitor.write_state(state)
+        return False
+
 
 class VolumeSensor(Sensor):
     yaml_tag = u'!volume'
 
-    def __init__(self, connected_to=None, worker_frequency=1, **kwargs):
+    __slots__ = ('volume',)
+
+    def __init__(self, connected_to=None, worker_frequency=None, **kwargs):
         self.volume = 0
         self.device_to_monitor = connected_to
-        super(Sensor, self).__init__(device_type="sensor", **kwargs)
+        super(Sensor, self).__init__(device_type="sensor", worker_frequency=_frequency(self, worker_frequency),
+                                     **kwargs)
+
+    def monitor_device(self, device):
+        super(VolumeSensor, self).monitor_device(device)
+        self.volume = device.volume
+
+    def device_changed(self, device, name):
+        if name == 'volume':
+            self.volume = device.volume
+            self.changed('volume')
 
     def worker(self):
         """Get the volume of `device_to_monitor`
@@ -115,3 +162,12 @@ class VolumeSensor(Sensor):
         """ Report sensor value
         """
         return self.volume
+
+
+def _frequency(sensor, worker_frequency):
+    """Change-driven sensors follow their device, so they need no worker loop unless given
+        a `worker_frequency`. Polled sensors run every second by default
+    """
+    if worker_frequency is None and not sensor.change_driven:
+        return 1
+    return worker_frequency
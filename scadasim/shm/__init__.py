@@ -0,0 +1 @@
+from shm import *
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+import mmap
+import struct
+import time
+import os
+import logging
+from scadasim.utils import state_fields, numeric_value
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger('scadasim')
+
+MAGIC = 'SCADASIM'
+VERSION = 1
+
+# Layout of the segment, all little-endian:
+#   header      magic, version, slot count, size of the labels block, offset of the values,
+#               sequence counter, time and tick of the last published tick
+#   labels      slot labels separated by newlines
+#   values      one float64 per slot, NaN for non-numeric values
+# The sequence counter is odd while a tick is being published.
+_header = struct.Struct('<8sIIIIQdQ')
+_seq = struct.Struct('<Q')
+_clock = struct.Struct('<dQ')
+_value = struct.Struct('<d')
+SEQ_OFFSET = 24
+CLOCK_OFFSET = 32
+
+
+class SharedStateError(Exception):
+        """Exception thrown when a file isn't a shared state segment of a supported version
+        """
+        def __init__(self, message):
+            super(SharedStateError, self).__init__(message)
+
+
+class SharedState(object):
+    """Publish every sensor value, tank volume and valve/pump state into a memory-mapped
+        file at `path` (e.g. under /dev/shm) at the end of each tick, and after the writes
+        actuated at once (see `Simulator.set_actuation()`), so local processes can read them
+        without any RPC. See `SharedStateReader`.
+
+        Slots are the sensor labels followed by `<device label>.volume` and
+        `<device label>.state`, in label order. Only the slots that changed are
+        rewritten each tick.
+    """
+
+    def __init__(self, simulator, path):
+        self.simulator = simulator
+        self.path = path
+
+        sensors = sorted(simulator.sensors)
+        self.fields = state_fields(simulator.devices)
+        self.labels = sensors + ['%s.%s' % (device.label, name) for device, name in self.fields]
+        self.slots = dict((label, slot) for slot, label in enumerate(self.labels))
+        self.sensor_count = len(sensors)
+        self.polled = [self.slots[label] for label in simulator.polled_sensors]
+
+        labels = '\n'.join(self.labels)
+        self.values_offset = (_header.size + len(labels) + 7) // 8 * 8
+        size = self.values_offset + _value.size * len(self.labels)
+
+        # Build the segment aside and move it in place, so readers never map a partial file
+        # and readers of a previous segment keep their mapping
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w+b') as stream:
+            stream.truncate(size)
+            self.mm = mmap.mmap(stream.fileno(), size)
+        _header.pack_into(self.mm, 0, MAGIC, VERSION, len(self.labels), len(labels), self.values_offset, 0, 0, 0)
+        self.mm[_header.size:_header.size + len(labels)] = labels
+        self.seq = 0
+
+        for sensor in simulator.sensors.values():
+            sensor.add_observer(self)
+        self.engine = simulator.engine
+        if self.engine:
+            # Device slots are copied straight from the engine arrays
+            offset = self.values_offset + _value.size * self.sensor_count
+            self.device_values = np.frombuffer(self.mm, dtype='<f8', count=len(self.fields), offset=offset)
+            self.gathers = []
+            for name in ('volume', 'state'):
+                positions = [i for i, (device, column) in enumerate(self.fields) if column == name]
+                indexes = [self.fields[i][0].engine_index for i in positions]
+                self.gathers.append((name, np.array(positions, dtype=np.intp), np.array(indexes, dtype=np.intp)))
+        else:
+            for device, name in self.fields:
+                device.add_observer(self)
+
+        # Sensors perturbed by events in the last tick, written again once the events end
+        self.perturbed = set()
+        self.dirty = set(range(len(self.labels)))
+        self.publish()
+        os.rename(tmp_path, path)
+
+    def device_changed(self, device, name):
+        if device.device_type == 'sensor':
+            self.dirty.add(self.slots[device.label])
+        else:
+            slot = self.slots.get('%s.%s' % (device.label, name))
+            if slot is not None:
+                self.dirty.add(slot)
+
+    def publish(self):
+        """Write the values of the current tick. Called after the snapshot is published"""
+        snapshot = self.simulator.snapshot
+        dirty, self.dirty = self.dirty, set()
+        dirty.update(self.polled)
+        perturbed, self.perturbed = self.perturbed, set(self.simulator.perturbed)
+        for label in perturbed | self.perturbed:
+            slot = self.slots.get(label)
+            if slot is not None:
+                dirty.add(slot)
+        mm = self.mm
+
+        _seq.pack_into(mm, SEQ_OFFSET, self.seq + 1)
+        for slot in dirty:
+            if slot < self.sensor_count:
+                value = snapshot.values[self.labels[slot]]
+            elif self.engine:
+                continue
+            else:
+                device, name = self.fields[slot - self.sensor_count]
+                value = getattr(device, name)
+            _value.pack_into(mm, self.values_offset + _value.size * slot, numeric_value(value))
+        if self.engine:
+            for name, positions, indexes in self.gathers:
+                self.device_values[positions] = getattr(self.engine, name)[indexes]
+        _clock.pack_into(mm, CLOCK_OFFSET, snapshot.time, snapshot.tick)
+        self.seq += 2
+        _seq.pack_into(mm, SEQ_OFFSET, self.seq)
+
+    def close(self):
+        for sensor in self.simulator.sensors.values():
+            sensor.remove_observer(self)
+        if self.engine:
+            del self.device_values
+        else:
+            for device, name in self.fields:
+                device.remove_observer(self)
+        self.mm.close()
+
+
+class SharedStateReader(object):
+    """Read a segment published by `SharedState`.
+        The segment is replaced when the simulator reloads its config, reopen it then.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as stream:
+            self.mm = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, labels_size, self.values_offset = _header.unpack_from(self.mm)[:5]
+        if magic != MAGIC or version != VERSION:
+            raise SharedStateError("%s is not a version %s scadasim shared state segment" % (path, VERSION))
+        self.labels = self.mm[_header.size:_header.size + labels_size].split('\n')
+        self.slots = dict((label, slot) for slot, label in enumerate(self.labels))
+        self._values = struct.Struct('<%sd' % count)
+
+    def read(self, labels=None):
+        """Read `labels` (default: every slot), all from the same tick.
+            Returns [time, tick, values] with values in the order of the labels.
+        """
+        offsets = None
+        if labels is not None:
+            offsets = [self.values_offset + _value.size * self.slots[label] for label in labels]
+        mm = self.mm
+        while True:
+            seq = _seq.unpack_from(mm, SEQ_OFFSET)[0]
+            if seq & 1:
+                # A tick is being published
+                time.sleep(0)
+                continue
+            if offsets is None:
+                values = list(self._values.unpack_from(mm, self.values_offset))
+            else:
+                values = [_value.unpack_from(mm, offset)[0] for offset in offsets]
+            now, tick = _clock.unpack_from(mm, CLOCK_OFFSET)
+            if _seq.unpack_from(mm, SEQ_OFFSET)[0] == seq:
+                return [now, tick, values]
+
+    def read_value(self, label):
+        """Read one slot. Returns [time, value]"""
+        now, tick, values = self.read([label])
+        return [now, values[0]]
+
+    def close(self):
+        self.mm.close()
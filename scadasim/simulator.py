@@ -1,6 +1,21 @@
 import threading
-from scadasim.utils import parse_yml, build_simulation
+import collections
+from scadasim.utils import load_simulation, topological_order, state_fields, add_plc
+from scadasim.utils import diff_configs, construct_node
+from scadasim.scheduler import Scheduler, FixedStepScheduler, LoopScheduler
+from scadasim.engine import VectorizedEngine
+from scadasim.rpc import BulkRPCServer, BinaryRPCServer
+from scadasim.modbus import ModbusServer
+from scadasim.historian import Historian
+from scadasim.shm import SharedState
+from scadasim.checkpoint import Checkpoint, write_checkpoint
+from scadasim.partition import Partitions
+from scadasim.profiler import Profiler, ProfileDump
+from scadasim.devices import connected_devices, gated_pumps
+from scadasim.events import Event, EventQueue, parse_events
 import sys
+import math
+import time
 import SimpleXMLRPCServer
 import logging
 from plcrpcservice import PLCRPCServer
@@ -10,81 +25,863 @@ log = logging.getLogger('scadasim')
 log.setLevel(logging.WARN)
 
 
+class InvalidMode(Exception):
+        """Exception thrown when an operation isn't supported by the simulation mode
+        """
+        def __init__(self, message):
+            super(InvalidMode, self).__init__(message)
+
+# Immutable sensor values published at the end of a tick
+Snapshot = collections.namedtuple('Snapshot', ['time', 'tick', 'values'])
+
+
 class Simulator(object):
 
-    def __init__(self, debug=0):
+    engines = {'vectorized': VectorizedEngine}
+    transports = {'xmlrpc': '_xmlrpc_services', 'binary': '_binary_services', 'modbus': '_modbus_services'}
+
+    def __init__(self, debug=0, realtime=True, step_size=1, engine=None, cache_dir=None, processes=None, loop=None):
+        """`realtime`: Tie the simulation clock to the wall clock.
+                When False the clock only advances through `step()` and `run_until()`,
+                `step_size` simulated seconds at a time, as fast as the CPU allows.
+            `engine`: Name of an optional flow engine that moves the fluid for all
+                pumps at once instead of each pump's worker, e.g. 'vectorized'
+            `cache_dir`: Directory keeping compiled copies of loaded configs, so reloading
+                an unchanged config skips parsing and wiring the devices
+            `processes`: Run the independent parts of the plant (see `utils.find_partitions`)
+                in up to `processes` worker processes. Sensors are read and written through
+                the snapshot and the PLC services of this process.
+            `loop`: `scadasim.eventloop.EventLoop` running the ticks and the PLC services
+                (binary and modbus transports) of this simulation in the thread running the
+                loop, alongside other simulations sharing it. `stop()` then returns instead
+                of exiting the process.
+        """
+        if loop and processes > 1:
+            raise InvalidMode("A simulation on an event loop runs in a single process")
         self.path_to_yaml_config = None
         self.config = None
+        # Text of the loaded config, compared against by `reload()`
+        self.config_data = None
+        self.active = False
         self.settings = None
         self.devices = None
         self.sensors = None
         self.plcs = None
+        self.cache_dir = cache_dir
+        self.engine_type = engine
+        self.engine = None
+        self.realtime = realtime
+        self.step_size = step_size
+        self.processes = processes
+        self.partitions = None
+        self.profiler = None
+        self.historian = None
+        self.shared_state = None
+        self.loop = loop
 
         if debug == 1:
             log.setLevel(logging.INFO)
         if debug >= 2:
             log.setLevel(logging.DEBUG)
 
-        self.plcservice = PLCRPCServer(rpc_ip="0.0.0.0", rpc_port=8000)
+        # Single scheduler driving every device and sensor worker
+        if realtime and loop:
+            self.scheduler = LoopScheduler(loop)
+        elif realtime:
+            self.scheduler = Scheduler()
+        else:
+            self.scheduler = FixedStepScheduler(step_size=step_size)
+
+        self.plcservice = None
+        self.bulkservice = None
+        self.services = []
+
+        # Latest published sensor values and the writes waiting for the next tick
+        self.snapshot = None
+        self.pending_writes = collections.deque()
+        # Sensors whose reading changed since the last snapshot
+        self.changed_sensors = set()
+        # Scheduled perturbations of sensors and devices, and the sensors they perturbed in the snapshot
+        self.events = None
+        self.perturbed = set()
+        # Apply sensor writes at once instead of at the next tick, see `set_actuation()`
+        self.immediate = False
+        # Pumps gated by each valve and pump, per graph of connected devices, see `gated_pumps()`
+        self._gated_pumps = {}
+        # Simulated seconds, scheduler time and speed of the last change of speed, see `simulation_time()`
+        self._clock = (0.0, self.scheduler.now(), 1)
 
     def load_yml(self, path_to_yaml_config):
         """Read and parse YAML configuration file into simulator devices
         """
         self.path_to_yaml_config = path_to_yaml_config
-        self.config = parse_yml(path_to_yaml_config)
-        simulation = build_simulation(self.config)
+        self.config, simulation = load_simulation(path_to_yaml_config, cache_dir=self.cache_dir)
+        with open(path_to_yaml_config, 'rb') as stream:
+            self.config_data = stream.read()
+        self.load(simulation)
+
+    def load(self, simulation):
+        """Set up the simulation built by `utils.build_simulation()`"""
+        if self.partitions:
+            self.partitions.close()
+            self.partitions = None
+        self.disable_profiling()
+        if self.historian:
+            self.historian.close()
+            self.historian = None
+        if self.shared_state:
+            self.shared_state.close()
+            self.shared_state = None
+
         self.settings = simulation['settings']
         self.devices = simulation['devices']
         self.sensors = simulation['sensors']
         self.plcs = simulation['plcs']
+        self.snapshot = None
+        self.events = None
+        self.perturbed = set()
+        self._gated_pumps = {}
+
+        if self.processes > 1:
+            self.partitions = Partitions(self, simulation, self.processes)
+        else:
+            self._load_devices()
+        self._bind_plc_sensors()
+        if simulation.get('events'):
+            self.schedule_events(simulation['events'])
+
+        if 'historian' in self.settings:
+            self.record(**self.settings['historian'])
+        if 'shared_state' in self.settings:
+            self.share_state(**self.settings['shared_state'])
+        if 'profiling' in self.settings:
+            self.enable_profiling(**self.settings['profiling'])
 
         self.set_speed(self.settings['speed'])
+        self.set_actuation(self.settings.get('actuation', 'tick'))
+
+    def _load_devices(self):
+        """Drive the devices and sensors from the scheduler of this process"""
+        for device in self.devices.values() + self.sensors.values():
+            device.scheduler = self.scheduler
+        self.scheduler.order = topological_order(self.devices, self.sensors)
+
+        if self.engine_type:
+            self.engine = self.engines[self.engine_type](self.devices, self.sensors)
+            self.engine.bind()
+            self.engine.scheduler = self.scheduler
+            # Move the fluid before any sensor or device worker looks at it
+            self.scheduler.order[self.engine] = -1
+
+        for sensor in self.sensors.values():
+            sensor.add_observer(self)
+        self.polled_sensors = [label for label, sensor in self.sensors.iteritems() if not sensor.change_driven]
+
+        self.scheduler.before_tick = [self.apply_writes]
+        self.scheduler.after_tick = [self.publish_snapshot]
+        self.publish_snapshot()
+
+    def activate(self):
+        """Activate all devices and sensors so their workers get scheduled"""
+        self.active = True
+        if self.partitions:
+            self.partitions.send('activate')
+            return
 
-    def start(self):
-        """Start the simulation"""
         for device in self.devices.values():
             device.activate()
 
         for sensor in self.sensors.values():
             sensor.activate()
 
-        for plc in self.plcs:
-            for sensor in self.plcs[plc]['sensors']:
-                self.plcs[plc]['sensors'][sensor][
-                    'read_sensor'] = self.sensors[sensor].read_sensor
-                self.plcs[plc]['sensors'][sensor][
-                    'write_sensor'] = self.sensors[sensor].write_sensor
-        self.plcservice.loadPLCs(self.plcs)
-        self.plcservice.start()
+        if self.engine:
+            self.engine.activate()
+
+    def deactivate(self):
+        """Deactivate all devices and sensors"""
+        self.active = False
+        if self.partitions:
+            self.partitions.send('deactivate')
+            return
 
-    def pause(self):
-        """Pause the simulation"""
         for device in self.devices.values():
             device.deactivate()
 
         for sensor in self.sensors.values():
             sensor.deactivate()
 
-        self.plcservice.stop_server()
-        self.plcservice.join()
+        if self.engine:
+            self.engine.deactivate()
+
+    def start(self):
+        """Start the simulation and the PLC services of each transport in `settings['transports']`
+            Available transports: xmlrpc (default), binary, modbus.
+            Only binary and modbus can run on an event loop.
+        """
+        self.activate()
+
+        for transport in self.settings.get('transports', ['xmlrpc']):
+            services = getattr(self, self.transports[transport])()
+            for service in services:
+                service.start()
+            self.services.extend(services)
+
+    def _xmlrpc_services(self):
+        """Per-point PLC service on port 8000 and the bulk service on `bulk_rpc_port`"""
+        if self.loop:
+            raise InvalidMode("The xmlrpc transport runs in threads, use the binary or modbus transport on an event loop")
+        self.plcservice = PLCRPCServer(rpc_ip="0.0.0.0", rpc_port=8000)
+        self.plcservice.loadPLCs(self.plcs)
+
+        self.bulkservice = BulkRPCServer(self, rpc_ip="0.0.0.0", rpc_port=self.settings.get('bulk_rpc_port', 8001))
+        return [self.plcservice, self.bulkservice]
+
+    def enable_profiling(self, dump_interval=None, dump_path=None, top=None):
+        """Record per-device run counts and times, input()/output() fan-out and scheduler lag.
+            With `dump_interval`, the report (see `profile()`) is written every `dump_interval`
+            seconds as JSON to `dump_path`, or to the log. Also enabled by `settings['profiling']`,
+            e.g. {'dump_interval': 60, 'dump_path': '/tmp/scadasim-profile.json', 'top': 20}
+        """
+        self._check_single_process()
+        with self.scheduler.lock:
+            self.disable_profiling()
+            self.profiler = Profiler()
+            self.profiler.instrument(self.devices.values() + self.sensors.values())
+            if dump_interval:
+                self.scheduler.after_tick.append(ProfileDump(self.profiler, dump_interval, dump_path, top))
+            self.scheduler.profiler = self.profiler
+
+    def disable_profiling(self):
+        with self.scheduler.lock:
+            if not self.profiler:
+                return
+            self.scheduler.profiler = None
+            self.scheduler.after_tick = [hook for hook in self.scheduler.after_tick if not isinstance(hook, ProfileDump)]
+            self.profiler.restore()
+            self.profiler = None
+
+    def profile(self, top=None):
+        """Profile recorded since profiling was enabled, as a dict with the `ticks` count and
+            durations, the scheduler `lag` and the timings of the `devices` by label.
+            `top` limits the devices to the ones with the most run time.
+            Empty while profiling is off.
+        """
+        with self.scheduler.lock:
+            if not self.profiler:
+                return {}
+            return self.profiler.report(top)
+
+    def _bind_plc_sensors(self):
+        """Point the read_sensor and write_sensor callables of the PLC sensors to the simulation.
+            Reads come from the latest snapshot, like every other transport, and writes are
+            queued for the next tick, sent to the worker processes or actuated at once.
+        """
+        for plc in self.plcs:
+            for sensor in self.plcs[plc]['sensors']:
+                if self.partitions:
+                    # The sensors live in the worker processes
+                    write_sensor = self._partitioned_writer(sensor)
+                elif self.immediate:
+                    write_sensor = self._actuated_sensor(sensor)
+                else:
+                    write_sensor = self._queued_writer(sensor)
+                self.plcs[plc]['sensors'][sensor]['read_sensor'] = self._snapshot_reader(sensor)
+                self.plcs[plc]['sensors'][sensor]['write_sensor'] = write_sensor
+
+    def _snapshot_reader(self, label):
+        """read_sensor callable reading a sensor from the latest snapshot"""
+        def read_sensor():
+            return self.snapshot.values[label]
+
+        return read_sensor
+
+    def _queued_writer(self, label):
+        """write_sensor callable queueing the writes of a sensor for the next tick"""
+        def write_sensor(value):
+            self.pending_writes.append([(label, value)])
+            return True
+
+        return write_sensor
+
+    def _partitioned_writer(self, label):
+        """write_sensor callable for a sensor of a worker process"""
+        def write_sensor(value):
+            self.partitions.write_sensors({label: value})
+            return True
+
+        return write_sensor
+
+    def _actuated_sensor(self, label):
+        """write_sensor callable actuating the writes of a sensor at once"""
+        def write_sensor(value):
+            self.actuate({label: value})
+            return True
+
+        return write_sensor
+
+    def _binary_services(self):
+        """Binary protocol over persistent connections, configured by `settings['binary']`
+            e.g. {'host': '0.0.0.0', 'port': 8002} or {'path': '/tmp/scadasim.sock'}
+        """
+        return [BinaryRPCServer(self, loop=self.loop, **self.settings.get('binary', {}))]
+
+    def _modbus_services(self):
+        """Modbus/TCP server for the `plcs` section, configured by `settings['modbus']`
+            e.g. {'host': '0.0.0.0', 'port': 502}
+        """
+        return [ModbusServer(self, loop=self.loop, **self.settings.get('modbus', {}))]
+
+    def pause(self):
+        """Pause the simulation"""
+        self.deactivate()
+
+        for service in self.services:
+            service.stop_server()
+            # Services of an event loop have no thread
+            if service.is_alive():
+                service.join()
+        self.services = []
+        self.plcservice = None
+        self.bulkservice = None
 
     def stop(self):
-        """Stop and destroy the simulation"""
+        """Stop and destroy the simulation. Exits the process unless running on an event loop"""
         self.pause()
-        sys.exit(0)
+        self.scheduler.stop()
+        if self.partitions:
+            self.partitions.close()
+        if self.historian:
+            self.historian.close()
+        if self.shared_state:
+            self.shared_state.close()
+        if not self.loop:
+            sys.exit(0)
+
+    def record(self, path, chunk_size=1024):
+        """Record every sensor value, tank volume and device state of each tick
+            into the historian at `path`. Also enabled by `settings['historian']`,
+            e.g. {'path': '/var/lib/scadasim/history', 'chunk_size': 1024}
+            Returns the `Historian`, see `Historian.query()`
+        """
+        self._check_single_process()
+        with self.scheduler.lock:
+            if self.historian:
+                self.scheduler.after_tick.remove(self.historian.record)
+                self.historian.close()
+                self.historian = None
+            self.historian = Historian(self, path, chunk_size=chunk_size)
+            self.scheduler.after_tick.append(self.historian.record)
+        return self.historian
+
+    def share_state(self, path):
+        """Publish every sensor value, tank volume and device state into a memory-mapped
+            file at `path` at the end of each tick, for local processes to read without RPC.
+            Also enabled by `settings['shared_state']`, e.g. {'path': '/dev/shm/scadasim'}
+            Returns the `SharedState`, see `scadasim.shm.SharedStateReader`
+        """
+        self._check_single_process()
+        with self.scheduler.lock:
+            if self.shared_state:
+                self.scheduler.after_tick.remove(self.shared_state.publish)
+                self.shared_state.close()
+            self.shared_state = SharedState(self, path)
+            self.scheduler.after_tick.append(self.shared_state.publish)
+        return self.shared_state
+
+    def checkpoint(self, path):
+        """Save the state of the simulation into a binary checkpoint at `path`:
+            tank volumes and compositions, device states, fluids, sensor values, PLC registration
+            flags and the clock. See `restore()`
+        """
+        self._check_single_process()
+        write_checkpoint(self, path)
+
+    def restore(self, checkpoint):
+        """Restore the state saved by `checkpoint()` into this simulation, loaded from the
+            same config. `checkpoint` is a path, or a `scadasim.checkpoint.Checkpoint` read
+            once to fork many runs from it
+        """
+        self._check_single_process()
+        if not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint.read(checkpoint)
+        checkpoint.apply(self)
 
     def set_speed(self, speed):
         """Increase/Decrease the speed of the simulation
             default: 1/second
         """
+        self._clock = (self.simulation_time(), self.scheduler.now(), speed)
+
         for device in self.devices.values():
             device.speed = speed
 
         for sensor in self.sensors.values():
             sensor.speed = speed
 
+        if self.engine:
+            self.engine.speed = speed
+
+        if self.partitions:
+            self.partitions.send('set_speed', speed)
+
+    def plc_sensors(self, plc):
+        """Sensor labels of `plc` ordered by register type and data address"""
+        sensors = self.plcs[plc]['sensors']
+        return sorted(sensors, key=lambda s: (sensors[s]['register_type'], sensors[s]['data_address'], s))
+
+    def publish_snapshot(self):
+        """Capture the sensor values into a new immutable snapshot.
+            Called by the scheduler at the end of each tick. Only sensors that changed
+            since the last snapshot are read again. Readers pick up the latest snapshot
+            without locking.
+        """
+        if self.snapshot is None:
+            values = dict((label, sensor.read_sensor()) for label, sensor in self.sensors.iteritems())
+        else:
+            changed, self.changed_sensors = self.changed_sensors, set()
+            changed.update(self.polled_sensors)
+            # Perturbed readings are read again
+            changed.update(self.perturbed)
+            values = self.snapshot.values
+            if changed:
+                values = dict(values)
+                for label in changed:
+                    values[label] = self.sensors[label].read_sensor()
+        self.perturbed = set()
+        if self.events and self.events.sensor_events:
+            if self.snapshot is not None and values is self.snapshot.values:
+                values = dict(values)
+            self.perturbed = self.events.perturb(self.simulation_time(), values)
+        self.snapshot = Snapshot(self.now(), self.scheduler.ticks, values)
+
+    def merge_snapshot(self, now, tick, values):
+        """Publish a snapshot with the {label: value} `values` sent by a worker process
+            replacing the values of the latest snapshot
+        """
+        snapshot = self.snapshot
+        if snapshot is not None:
+            merged = dict(snapshot.values)
+            merged.update(values)
+            values = merged
+            tick = max(tick, snapshot.tick)
+        self.snapshot = Snapshot(now, tick, values)
+
+    def device_changed(self, sensor, name):
+        """Called by sensors when their reading changes"""
+        self.changed_sensors.add(sensor.label)
+
+    def apply_writes(self):
+        """Apply the queued sensor writes. Called by the scheduler at the start of each tick"""
+        while self.pending_writes:
+            for label, value in self.pending_writes.popleft():
+                if label not in self.sensors:
+                    # Removed by a reload since the write was queued
+                    log.warning("Dropped the write of removed sensor %s" % label)
+                    continue
+                self.sensors[label].write_sensor(value)
+
+    def inject(self, target, kind, at=0, duration=None, field=None, **params):
+        """Schedule a perturbation of the sensor or device `target`, starting `at` simulated
+            seconds from now and lasting `duration` seconds (default: until cancelled).
+            `kind` is one of:
+                override: report, or hold the device `field` at, `value`
+                drift: add `rate` per simulated second, e.g. a tank leak
+                noise: add gaussian noise of `stddev`
+                freeze: report, or hold the device `field` at, the value of when the event
+                    started, e.g. a stuck valve
+                delay: report the reading of `seconds` ago, sensors only
+            Sensor events change the readings PLCs see, device events the device `field`
+            (default: volume of tanks, state of the other devices). Events are applied at tick
+            boundaries, see `scadasim.events.EventQueue`. Returns the `Event`, see `cancel_event()`
+        """
+        start = self.simulation_time() + at
+        event = Event(target, kind, start, None if duration is None else start + duration, field=field, **params)
+        return self._schedule([event])[0]
+
+    def schedule_events(self, entries):
+        """Schedule the events of an `events` config section, `at` counting from now.
+            e.g. [{'target': 'tank1', 'type': 'drift', 'rate': -0.5, 'at': 60, 'duration': 600}]
+            Returns the events
+        """
+        return self._schedule(parse_events(entries, self.simulation_time()))
+
+    def cancel_event(self, event):
+        """End `event` at the next tick, or drop it if it hasn't started"""
+        with self.scheduler.lock:
+            self.events.cancel(event)
+
+    def _schedule(self, events):
+        self._check_single_process()
+        with self.scheduler.lock:
+            if self.events is None:
+                self.events = EventQueue(self.sensors, self.devices)
+                self.scheduler.before_tick.append(self._apply_events)
+            for event in events:
+                self.events.schedule(event)
+        return events
+
+    def _apply_events(self):
+        """Called by the scheduler at the start of each tick, after the writes are applied"""
+        self.events.before_tick(self.simulation_time())
+
+    def set_actuation(self, mode):
+        """'tick' (default): sensor writes are queued and applied at the start of the next tick.
+            'immediate': writes are applied as they arrive, and the pumps whose flow paths go
+            through the valves and pumps they changed run at once, before the write returns.
+            Only those pumps run, each in place of its next run so it keeps its rate, and once
+            per period at most. The snapshot, and the shared state if any, are published right
+            after, so PLCs and local readers see the effect of their write downstream without
+            waiting for a tick. Also set by `settings['actuation']`. The latency of each write
+            is reported by `profile()`.
+            Requires a realtime simulation in a single process.
+        """
+        self._check_actuation(mode)
+        immediate = mode == 'immediate'
+        if immediate != self.immediate:
+            self.immediate = immediate
+            # The per-point PLC service writes through the PLC sensors
+            self._bind_plc_sensors()
+
+    def _check_actuation(self, mode):
+        if mode not in ('tick', 'immediate'):
+            raise ValueError("Unknown actuation mode %s" % mode)
+        if mode == 'immediate':
+            if self.partitions:
+                raise InvalidMode("Writes to a partitioned simulation are applied by the worker processes")
+            if not self.realtime:
+                raise InvalidMode("A fixed-step simulation applies writes at the current simulated time already")
+
+    def actuate(self, values):
+        """Apply the {label: value} sensor writes now and run the pumps whose flow paths they
+            changed, see `set_actuation()`. Returns the pumps that ran
+        """
+        started = time.time()
+        with self.scheduler.lock:
+            # Writes queued before keep their order
+            self.apply_writes()
+            devices = [self.sensors[label].device_to_monitor for label in sorted(values)]
+            states = [device.state if device else None for device in devices]
+            for label in sorted(values):
+                self.sensors[label].write_sensor(values[label])
+            if self.events:
+                # Stuck and overridden devices ignore the writes
+                self.events.hold()
+
+            changed = set(device for device, state in zip(devices, states) if device and device.state != state)
+            pumps = set()
+            for device in changed:
+                pumps.update(self.gated_pumps(device))
+            ran = []
+            if pumps:
+                order = self.scheduler.order
+                pumps = sorted(pumps, key=lambda pump: order.get(pump, len(order)))
+                if self.engine:
+                    ran = [self.engine.nodes[i] for i in self.engine.actuate([pump.engine_index for pump in pumps])]
+                else:
+                    ran = self.scheduler.run_now(pumps)
+            self.publish_snapshot()
+            if self.shared_state:
+                self.shared_state.publish()
+            if self.profiler:
+                self.profiler.actuated(time.time() - started, len(ran))
+        return ran
+
+    def gated_pumps(self, device):
+        """Pumps whose flow paths go through the valve or pump `device`. Found for the whole
+            graph of devices connected to it, again once its connections change
+        """
+        version = device.flow_version()
+        connections, gated = self._gated_pumps.get(version, (None, None))
+        if connections != version.connections:
+            gated = gated_pumps(connected_devices(device))
+            self._gated_pumps[version] = (version.connections, gated)
+        return gated.get(device, ())
+
+    def read_sensor(self, plc, sensor):
+        """Read one sensor of `plc` from the latest snapshot. Returns [timestamp, value]"""
+        self._check_plc_sensor(plc, sensor)
+        snapshot = self.snapshot
+        return [snapshot.time, snapshot.values[sensor]]
+
+    def write_sensor(self, plc, sensor, value):
+        """Queue a write of one sensor of `plc` for the next tick, or apply it at once with
+            immediate actuation (see `set_actuation()`). Returns [timestamp, queued]
+        """
+        self._check_plc_sensor(plc, sensor)
+        if self.partitions:
+            self.partitions.write_sensors({sensor: value})
+        elif self.immediate:
+            self.actuate({sensor: value})
+        else:
+            self.pending_writes.append([(sensor, value)])
+        return [self.snapshot.time, True]
+
+    def _check_plc_sensor(self, plc, sensor):
+        if sensor not in self.plcs[plc]['sensors']:
+            raise KeyError("%s is not a sensor of %s" % (sensor, plc))
+
+    def read_sensors(self, plc=None, sensors=None):
+        """Read many sensors at once: `sensors` labels, or every sensor of `plc`.
+            All values come from the same snapshot.
+            Returns [timestamp, values] with values in the order of the labels.
+        """
+        if sensors is None:
+            sensors = self.plc_sensors(plc)
+        snapshot = self.snapshot
+        return [snapshot.time, [snapshot.values[label] for label in sensors]]
+
+    def write_sensors(self, values):
+        """Queue writes of many sensors from a {label: value} mapping.
+            All writes are applied together at the start of the next tick, or at once with
+            immediate actuation (see `set_actuation()`).
+            Returns [timestamp, queued] with one entry per label in sorted order.
+        """
+        labels = sorted(values)
+        for label in labels:
+            if label not in self.sensors:
+                raise KeyError("Unknown sensor %s" % label)
+        if self.partitions:
+            self.partitions.write_sensors(values)
+        elif self.immediate:
+            self.actuate(values)
+        else:
+            # Queued as one batch so a tick never applies only part of it
+            self.pending_writes.append([(label, values[label]) for label in labels])
+        return [self.snapshot.time, [True] * len(labels)]
+
+    def now(self):
+        """Current simulation time in seconds"""
+        return self.scheduler.now()
+
+    def simulation_time(self):
+        """Simulated seconds events are scheduled on. The same as `now()` in fixed-step mode.
+            In realtime mode a device runs every `speed * worker_frequency` seconds, so each
+            wall-clock second counts for 1/speed simulated seconds, at the speed set then.
+        """
+        if not self.realtime:
+            return self.now()
+        elapsed, since, speed = self._clock
+        return elapsed + (self.scheduler.now() - since) / float(speed)
+
+    def step(self, steps=1):
+        """Advance a fixed-step simulation by `steps` steps"""
+        self._check_fixed_step()
+        if not self.active:
+            self.activate()
+        if self.partitions:
+            self.partitions.step(steps)
+            # Keep the clock of this process in line with the workers
+            self.scheduler.ticks += steps
+        else:
+            self.scheduler.step(steps)
+
+    def run_until(self, t):
+        """Advance a fixed-step simulation until its clock reaches `t` seconds"""
+        self._check_fixed_step()
+        if not self.active:
+            self.activate()
+        if self.partitions:
+            steps = int(math.ceil((t - self.now()) / float(self.step_size) - 1e-9))
+            if steps > 0:
+                self.step(steps)
+        else:
+            self.scheduler.run_until(t)
+
+    def _check_single_process(self):
+        if self.partitions:
+            raise InvalidMode("The devices of a partitioned simulation live in the worker processes")
+
+    def _check_fixed_step(self):
+        if not isinstance(self.scheduler, FixedStepScheduler):
+            raise InvalidMode("Stepping requires a Simulator created with realtime=False")
+
+    def reload(self, path_to_yaml_config=None):
+        """Apply the changes made to the config (default: the loaded one) to the running simulation.
+            Only the devices, sensors, connections and PLCs that changed are rebuilt. Everything
+            else keeps its state, and the PLC services keep running with their connections.
+            Changed devices and sensors are rebuilt, so they start from their configured state.
+            Returns the labels that were added, removed and changed in each section
+        """
+        self._check_single_process()
+        path_to_yaml_config = path_to_yaml_config or self.path_to_yaml_config
+        with open(path_to_yaml_config, 'rb') as stream:
+            data = stream.read()
+        changes, new = diff_configs(self.config_data, data)
+        devices, sensors, plcs = changes['devices'], changes['sensors'], changes['plcs']
+        built_devices = _build(new['devices'], devices['added'] + devices['changed'])
+        built_sensors = _build(new['sensors'], sensors['added'] + sensors['changed'])
+        built_plcs = dict((label, construct_node(new['plcs'][label])) for label in plcs['added'] + plcs['changed'])
+        added_connections = set(changes['connections']['added'])
+        removed_connections = set(changes['connections']['removed'])
+        structural = built_devices or built_sensors or devices['removed'] or sensors['removed'] or \
+            added_connections or removed_connections
+        if changes['settings']:
+            settings = construct_node(new['settings'])
+            self._check_actuation(settings.get('actuation', 'tick'))
+
+        with self.scheduler.lock:
+            all_devices = dict(self.devices)
+            all_devices.update(built_devices)
+            for label in devices['removed']:
+                del all_devices[label]
+            all_sensors = set(self.sensors) - set(sensors['removed']) | set(built_sensors)
+            # Check the references up front so a broken config changes nothing
+            for source, destination in added_connections:
+                for label in (source, destination):
+                    if label not in all_devices:
+                        raise KeyError("Connection to unknown device %s" % label)
+            for label in devices['removed']:
+                for source, destination in _connections(self.devices[label]):
+                    if (source, destination) not in removed_connections:
+                        raise KeyError("Removed device %s is still connected" % label)
+            monitors = [(sensor.label, sensor.device_to_monitor) for sensor in built_sensors.values()]
+            if devices['removed']:
+                monitors += [(label, sensor.device_to_monitor.label) for label, sensor in self.sensors.iteritems()
+                             if label not in built_sensors and label not in sensors['removed']]
+            for label, device in monitors:
+                if device not in all_devices:
+                    raise KeyError("Sensor %s monitors unknown device %s" % (label, device))
+            readers = built_plcs.items()
+            if sensors['removed']:
+                readers += [(label, plc) for label, plc in self.plcs.iteritems()
+                            if label not in built_plcs and label not in plcs['removed']]
+            for label, plc in readers:
+                for sensor in plc['sensors']:
+                    if sensor not in all_sensors:
+                        raise KeyError("PLC %s reads unknown sensor %s" % (label, sensor))
+
+            if structural and self.historian:
+                columns = sorted(all_sensors)
+                columns += ['%s.%s' % (device.label, name) for device, name in state_fields(all_devices)]
+                if columns != self.historian.columns:
+                    raise InvalidMode("The changes would change the columns recorded by the historian, restart instead")
+
+            if structural:
+                self._apply_structure(devices, sensors, built_devices, built_sensors,
+                                      added_connections, removed_connections)
+
+            if built_plcs or plcs['removed'] or built_sensors:
+                for label in plcs['removed']:
+                    del self.plcs[label]
+                for label, plc in built_plcs.iteritems():
+                    add_plc(plc, self.sensors)
+                    self.plcs[label] = plc
+                self._bind_plc_sensors()
+                for service in self.services:
+                    if hasattr(service, 'load_plcs'):
+                        service.load_plcs(self.plcs)
+                if self.plcservice:
+                    self.plcservice.loadPLCs(self.plcs)
+
+            if changes['settings']:
+                self.settings = settings
+                self.set_speed(self.settings['speed'])
+                self.set_actuation(self.settings.get('actuation', 'tick'))
+
+        self.path_to_yaml_config = path_to_yaml_config
+        self.config_data = data
+        log.info("Reloaded %s: %s" % (path_to_yaml_config, changes))
+        return changes
+
+    def _apply_structure(self, devices, sensors, built_devices, built_sensors,
+                         added_connections, removed_connections):
+        """Swap the changed devices and sensors and rewire the changed connections"""
+        replaced = []
+        for label in sensors['removed'] + sensors['changed']:
+            sensor = self.sensors.pop(label)
+            if label in built_sensors:
+                replaced.append((sensor, built_sensors[label]))
+            sensor.deactivate()
+            sensor.remove_observer(self)
+            sensor.device_to_monitor.remove_observer(sensor)
+
+        # Rebuilt devices get the connections of the device they replace
+        connect = set(added_connections)
+        for label in devices['changed']:
+            connect.update(_connections(self.devices[label]))
+        connect -= removed_connections
+
+        for label in devices['removed'] + devices['changed']:
+            device = self.devices.pop(label)
+            if label in built_devices:
+                replaced.append((device, built_devices[label]))
+            device.deactivate()
+            for connected in device.inputs.values():
+                device.remove_input(connected)
+            for connected in device.outputs.values():
+                device.remove_output(connected)
+
+        for label, device in built_devices.iteritems():
+            device.scheduler = self.scheduler
+            self.devices[label] = device
+        for source, destination in removed_connections:
+            if source in self.devices and destination in self.devices:
+                self.devices[source].remove_output(self.devices[destination])
+        for source, destination in connect:
+            self.devices[source].add_output(self.devices[destination])
+
+        # Sensors of rebuilt devices follow the new device
+        monitoring = [sensor for sensor in self.sensors.values() if sensor.device_to_monitor.label in built_devices]
+        for sensor in monitoring:
+            sensor.monitor_device(self.devices[sensor.device_to_monitor.label])
+        for label, sensor in built_sensors.iteritems():
+            sensor.monitor_device(self.devices[sensor.device_to_monitor])
+            sensor.scheduler = self.scheduler
+            sensor.add_observer(self)
+            self.sensors[label] = sensor
+        self.polled_sensors = [label for label, sensor in self.sensors.iteritems() if not sensor.change_driven]
+
+        if added_connections or removed_connections or devices['added'] or devices['removed'] or \
+                sensors['added'] or sensors['removed']:
+            self.scheduler.order = topological_order(self.devices, self.sensors)
+        else:
+            # Same graph, the rebuilt devices take the rank of the ones they replace
+            for old, new in replaced:
+                self.scheduler.order[new] = self.scheduler.order.pop(old)
+        if self.engine:
+            # Segments change with the connections, so the engine is compiled again
+            self.engine.deactivate()
+            self.engine.unbind()
+            self.engine = self.engines[self.engine_type](self.devices, self.sensors)
+            self.engine.bind()
+            self.engine.scheduler = self.scheduler
+            self.scheduler.order[self.engine] = -1
+        if self.profiler:
+            self.profiler.instrument(built_devices.values() + built_sensors.values())
+
+        values = dict(self.snapshot.values)
+        for label in sensors['removed']:
+            del values[label]
+        for sensor in monitoring + built_sensors.values():
+            values[sensor.label] = sensor.read_sensor()
+        self.snapshot = Snapshot(self.now(), self.scheduler.ticks, values)
+
+        # Both follow the new devices, and the new engine arrays
+        if self.historian:
+            self.record(self.historian.path, self.historian.chunk_size)
+        if self.shared_state:
+            self.share_state(self.shared_state.path)
+        # Versions of graphs merged by the new connections are left behind
+        self._gated_pumps = {}
+        if self.active:
+            for device in built_devices.values() + built_sensors.values():
+                device.activate()
+            if self.engine:
+                self.engine.activate()
+
     def restart(self):
         """Stop and reload the simulation from the original config"""
         self.pause()
         self.load_yml(self.path_to_yaml_config)
         self.start()
+
+
+def _build(nodes, labels):
+    """{label: object} of the `nodes` with `labels`"""
+    built = (construct_node(nodes[label]) for label in labels)
+    return dict((obj.label, obj) for obj in built)
+
+def _connections(device):
+    """(source label, destination label) of every connection of `device`"""
+    return [(connected.label, device.label) for connected in device.inputs.values()] + \
+        [(device.label, connected.label) for connected in device.outputs.values()]
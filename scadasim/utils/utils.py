@@ -1,15 +1,106 @@
 import yaml
+import os
+import re
+import hashlib
+import logging
+import cPickle as pickle
 
 from scadasim.fluids import *
 from scadasim.devices import *
 from scadasim.sensors import *
 
+log = logging.getLogger('scadasim')
+
+# Use the libyaml C loader when PyYAML was built with it
+Loader = getattr(yaml, 'CLoader', yaml.Loader)
+
+# Lines of a block style config, see `split_config()`. Matching from the newline is much
+# faster than re.M on large configs
+_line_start = re.compile(r'\n[^\s#-]')
+_section = re.compile(r'([A-Za-z_]\w*)\s*:(\s|$)')
+_entry = re.compile(r'^( *)[^ \r\n#]', re.M)
+_entries = {}
+# YAML features left to the parser: anchors, aliases and document markers
+_unsplittable = re.compile(r'(^|[\s\[{,:-])[&*][^\s]|^(---|\.\.\.)', re.M)
+
+# Bump whenever the pickled layout of devices, sensors or fluids changes
+CACHE_VERSION = 8
+
+def register_yaml_tags(loader=Loader):
+    """Register the YAML tags of every device, sensor and fluid class with `loader`.
+        Classes only register themselves with the pure-Python loader.
+    """
+    classes = yaml.YAMLObject.__subclasses__()
+    while classes:
+        cls = classes.pop()
+        classes.extend(cls.__subclasses__())
+        if cls.yaml_tag and cls.yaml_tag not in loader.yaml_constructors:
+            loader.add_constructor(cls.yaml_tag, cls.from_yaml)
+
 def parse_yml(path_to_yml_file):
     config = None
     with open(path_to_yml_file, 'r') as stream:
-        config = yaml.load(stream)
+        config = load_yml_string(stream.read())
     return config
 
+def load_yml_string(data):
+    register_yaml_tags()
+    return yaml.load(data, Loader=Loader)
+
+def load_simulation(path_to_yml_file, cache_dir=None):
+    """Parse and build the simulation in `path_to_yml_file`.
+        With `cache_dir`, the result is pickled there keyed by the hash of the file,
+        and an unchanged file is loaded from the pickle without parsing or wiring.
+        Returns (config, simulation)
+    """
+    with open(path_to_yml_file, 'rb') as stream:
+        data = stream.read()
+
+    cache_file = None
+    if cache_dir:
+        key = hashlib.sha1('%s:%s' % (CACHE_VERSION, data)).hexdigest()
+        cache_file = os.path.join(cache_dir, '%s.pickle' % key)
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as stream:
+                    config, simulation = pickle.load(stream)
+                _reserve_loaded_uids(simulation)
+                return config, simulation
+            except Exception as e:
+                log.warning("Ignoring unreadable simulation cache %s: %s" % (cache_file, e))
+
+    config = load_yml_string(data)
+    simulation = build_simulation(config)
+
+    if cache_file:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temporary file first so readers never see a partial cache
+        temp_file = '%s.%s.tmp' % (cache_file, os.getpid())
+        with open(temp_file, 'wb') as stream:
+            pickle.dump((config, simulation), stream, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_file, cache_file)
+
+    return config, simulation
+
+def pickle_simulation(simulation):
+    """Serialize a simulation built by `build_simulation()`, e.g. to build copies of it
+        without parsing and wiring the config again. See `unpickle_simulation()`
+    """
+    return pickle.dumps(simulation, pickle.HIGHEST_PROTOCOL)
+
+def unpickle_simulation(data):
+    """New copy of the simulation serialized by `pickle_simulation()`"""
+    simulation = pickle.loads(data)
+    _reserve_loaded_uids(simulation)
+    return simulation
+
+def _reserve_loaded_uids(simulation):
+    """Keep new devices from reusing the uids of the loaded devices"""
+    uids = [device.uid for device in simulation['devices'].values() + simulation['sensors'].values()]
+    if uids:
+        reserve_uids(max(uids))
+
 def build_simulation(config):
     settings = config['settings']
     devices = {}
@@ -29,6 +120,11 @@ def build_simulation(config):
             for dev_input in connections['inputs']:
                 devices[device_label].add_input(devices[dev_input])
 
+    # Trace the flow paths of every pump once, up front
+    for device in devices.values():
+        if isinstance(device, Pump):
+            device.flow_paths()
+
     # process sensors
     for sensor in config['sensors']:
         device_to_monitor = devices[sensor.device_to_monitor]
@@ -36,13 +132,243 @@ def build_simulation(config):
         sensors[sensor.label] = sensor
 
     # process PLCs
-    plcs = config['plcs']
+    plcs = config.get('plcs', {})
     for plc in plcs:
-        # Add registered state so we can tell if the PLC has communicated with the sensors
-        plcs[plc]['registered'] = False
-        # Add all sensor.read_sensor connections to each plc
-        for sensor in plcs[plc]['sensors']:
-            plcs[plc]['sensors'][sensor]['value'] = 0
-            plcs[plc]['sensors'][sensor]['read_sensor'] = sensors[sensor].read_sensor
-
-    return {'settings': settings, 'devices': devices, 'sensors': sensors, 'plcs': plcs}
+        add_plc(plcs[plc], sensors)
+
+    partitions = find_partitions(devices, sensors, settings.get('zones'))
+
+    return {'settings': settings, 'devices': devices, 'sensors': sensors, 'plcs': plcs, 'partitions': partitions,
+            'events': config.get('events') or []}
+
+def add_plc(plc, sensors):
+    """Prepare the config of one PLC for the simulation.
+        The read_sensor callables are bound by the `Simulator`, so built simulations can be pickled
+    """
+    # Add registered state so we can tell if the PLC has communicated with the sensors
+    plc['registered'] = False
+    for sensor in plc['sensors']:
+        if sensor not in sensors:
+            raise KeyError("PLC sensor %s is not a sensor of the simulation" % sensor)
+        plc['sensors'][sensor]['value'] = 0
+
+def find_partitions(devices, sensors, zones=None):
+    """Split the simulation into partitions that can run independently of each other:
+        the weakly connected components of the device graph, each sensor going with the
+        device it monitors. `zones` ({zone: [device labels]}) keeps the components of a
+        zone together. Components are never split, so zones can't cut a connection.
+        Returns lists of sorted labels, largest first
+    """
+    parents = dict((label, label) for label in devices.keys() + sensors.keys())
+
+    def find(label):
+        while parents[label] != label:
+            parents[label] = parents[parents[label]]
+            label = parents[label]
+        return label
+
+    def union(a, b):
+        if a in parents and b in parents:
+            parents[find(a)] = find(b)
+
+    for device in devices.values():
+        for connected in device.inputs.values() + device.outputs.values():
+            union(device.label, connected.label)
+    for sensor in sensors.values():
+        if sensor.device_to_monitor is not None:
+            union(sensor.label, sensor.device_to_monitor.label)
+    for labels in (zones or {}).values():
+        for label in labels[1:]:
+            union(labels[0], label)
+
+    partitions = {}
+    for label in parents:
+        partitions.setdefault(find(label), []).append(label)
+    return sorted((sorted(labels) for labels in partitions.values()), key=lambda labels: (-len(labels), labels[0]))
+
+def topological_order(devices, sensors):
+    """Rank devices upstream to downstream following their connections.
+        Sensors are ranked after all devices so they observe the results of each step.
+        Devices that are part of a loop are ranked in label order after the rest.
+        Returns a dict of device -> rank
+    """
+    nodes = sorted(devices.values(), key=lambda d: d.label) + sorted(sensors.values(), key=lambda s: s.label)
+    in_degree = dict((node, len(node.inputs)) for node in nodes)
+    ready = [node for node in nodes if not in_degree[node]]
+    ordered = []
+
+    while ready:
+        node = ready.pop(0)
+        ordered.append(node)
+        for uid in sorted(node.outputs, key=lambda uid: node.outputs[uid].label):
+            output = node.outputs[uid]
+            if output in in_degree:
+                in_degree[output] -= 1
+                if not in_degree[output]:
+                    ready.append(output)
+
+    seen = set(ordered)
+    ordered += [node for node in nodes if node not in seen]
+    ordered.sort(key=lambda node: node.device_type == 'sensor')
+    return dict((node, rank) for rank, node in enumerate(ordered))
+
+def state_fields(devices):
+    """(device, field) pairs of the device state published outside the simulation:
+        the volume of each tank and the state of each valve and pump, in label order
+    """
+    fields = []
+    for label in sorted(devices):
+        device = devices[label]
+        if device.stores_fluid:
+            fields.append((device, 'volume'))
+        if device.gated:
+            fields.append((device, 'state'))
+    return fields
+
+def numeric_value(value):
+    """Sensor and device values as floats. Anything non-numeric is NaN"""
+    if value is None or not isinstance(value, (bool, int, long, float)):
+        return float('nan')
+    return float(value)
+
+def compose_config(data):
+    """Index the YAML config `data` without building any object, for comparing configs.
+        Returns {'settings': node, 'devices': {label: node}, 'sensors': {label: node},
+        'plcs': {label: node}, 'connections': set of (source label, destination label)}
+        See `node_signature()` and `construct_node()`
+    """
+    register_yaml_tags()
+    root = yaml.compose(data, Loader=Loader)
+    index = _empty_index()
+    for key, node in root.value:
+        _index_section(key.value, node, index)
+    return index
+
+def split_config(data):
+    """Split a block style YAML config into {section: text} by its top level keys.
+        Returns None when the layout isn't understood (anchors, several documents...)
+    """
+    if ('&' in data or '*' in data or '---' in data) and _unsplittable.search(data):
+        return None
+    starts = [match.start() + 1 for match in _line_start.finditer(data)]
+    if data[:1] not in ('', ' ', '\t', '\r', '\n', '#', '-'):
+        starts.insert(0, 0)
+    sections = {}
+    for start, end in zip(starts, starts[1:] + [len(data)]):
+        match = _section.match(data, start)
+        if not match or match.group(1) in sections:
+            return None
+        sections[match.group(1)] = data[start:end]
+    return sections
+
+def split_section(text):
+    """Split the text of a section into its header and the text of each of its entries,
+        a device, sensor, PLC or connection
+    """
+    header_end = text.find('\n') + 1 or len(text)
+    first = _entry.search(text, header_end)
+    if not first:
+        return text, []
+    pattern = _entries.get(len(first.group(1)))
+    if pattern is None:
+        pattern = _entries[len(first.group(1))] = re.compile(r'\n {%s}[^ \r\n#]' % len(first.group(1)))
+    starts = [first.start()] + [match.start() + 1 for match in pattern.finditer(text, first.start())]
+    return text[:starts[0]], [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])]
+
+def diff_configs(old_data, new_data):
+    """Compare the YAML configs `old_data` and `new_data`.
+        Returns (changes, nodes): the labels added, removed and changed in each section,
+        the (source, destination) connections added and removed and whether the settings
+        changed, plus the `compose_config()` index of the new config, which holds at least
+        the added and changed entries, and the settings when they changed.
+        Only the entries whose text changed are parsed when both configs are block style,
+        so a small edit of a large config is cheap.
+    """
+    old_sections, new_sections = split_config(old_data), split_config(new_data)
+    if old_sections is None or new_sections is None:
+        old, new = compose_config(old_data), compose_config(new_data)
+        unchanged = {}
+    else:
+        register_yaml_tags()
+        old, new = _empty_index(), _empty_index()
+        unchanged = {}
+        for name in set(old_sections) | set(new_sections):
+            old_text, new_text = old_sections.get(name), new_sections.get(name)
+            if old_text == new_text:
+                continue
+            old_header, old_entries = split_section(old_text) if old_text else (None, [])
+            new_header, new_entries = split_section(new_text) if new_text else (None, [])
+            common = set()
+            if old_header == new_header and name != 'settings':
+                common = set(old_entries).intersection(new_entries)
+            unchanged[name] = (new_header, common)
+            for header, entries, index in ((old_header, old_entries, old), (new_header, new_entries, new)):
+                if header:
+                    _index_section(name, _compose_section(header, [entry for entry in entries if entry not in common]), index)
+
+    changes = {'settings': node_signature(old['settings']) != node_signature(new['settings'])}
+    for section in ('devices', 'sensors', 'plcs'):
+        old_nodes, new_nodes = old[section], new[section]
+        changed = [label for label in new_nodes
+                   if label in old_nodes and node_signature(new_nodes[label]) != node_signature(old_nodes[label])]
+        changes[section] = {'added': sorted(set(new_nodes) - set(old_nodes)),
+                            'removed': sorted(set(old_nodes) - set(new_nodes)), 'changed': sorted(changed)}
+
+    added = new['connections'] - old['connections']
+    removed = old['connections'] - new['connections']
+    if removed and 'connections' in unchanged:
+        # A connection can be declared twice, as an output and as an input
+        header, entries = unchanged['connections']
+        declaring = [entry for entry in entries if any(source in entry and destination in entry
+                                                       for source, destination in removed)]
+        if declaring:
+            index = _empty_index()
+            _index_section('connections', _compose_section(header, declaring), index)
+            removed -= index['connections']
+    changes['connections'] = {'added': sorted(added), 'removed': sorted(removed)}
+    return changes, new
+
+def _empty_index():
+    return {'settings': None, 'devices': {}, 'sensors': {}, 'plcs': {}, 'connections': set()}
+
+def _compose_section(header, entries):
+    """Node of the section with `header` holding only `entries`"""
+    root = yaml.compose(header + ''.join(entries), Loader=Loader)
+    return root.value[0][1]
+
+def _index_section(name, node, index):
+    """Add the top level section `name` of a config to a `compose_config()` index"""
+    if name == 'settings':
+        index['settings'] = node
+    elif name in ('devices', 'sensors') and isinstance(node, yaml.SequenceNode):
+        for entry in node.value:
+            fields = dict((key.value, value) for key, value in entry.value)
+            index[name][fields['label'].value] = entry
+    elif name == 'plcs' and isinstance(node, yaml.MappingNode):
+        for key, entry in node.value:
+            index['plcs'][key.value] = entry
+    elif name == 'connections' and isinstance(node, yaml.MappingNode):
+        # Walked rather than constructed, it is the bulk of a large config
+        for label, connections in node.value:
+            for key, targets in connections.value:
+                if not isinstance(targets, yaml.SequenceNode):
+                    continue
+                for target in targets.value:
+                    if key.value == 'outputs':
+                        index['connections'].add((label.value, target.value))
+                    elif key.value == 'inputs':
+                        index['connections'].add((target.value, label.value))
+
+def node_signature(node):
+    """Hashable summary of a YAML node. Nodes with equal signatures build equal objects"""
+    if node is None:
+        return None
+    if isinstance(node, yaml.ScalarNode):
+        return (node.tag, node.value)
+    if isinstance(node, yaml.SequenceNode):
+        return (node.tag, tuple(node_signature(child) for child in node.value))
+    return (node.tag, tuple(sorted((node_signature(key), node_signature(value)) for key, value in node.value)))
+
+def construct_node(node):
+    """Build the object described by a YAML node of `compose_config()`"""
+    return Loader('').construct_document(node)
@@ -7,6 +7,7 @@ setup(name='scadasim',
       author='sintax1',
       author_email='sintax@obscurepacket.org',
       license='MIT',
-      packages=['scadasim', 'scadasim.devices', 'scadasim.fluids', 'scadasim.devices', 'scadasim.sensors', 'scadasim.utils', 'tests'],
+      packages=['scadasim', 'scadasim.devices', 'scadasim.fluids', 'scadasim.devices', 'scadasim.sensors', 'scadasim.utils', 'scadasim.engine', 'scadasim.rpc', 'scadasim.modbus', 'scadasim.historian', 'scadasim.shm', 'scadasim.checkpoint', 'scadasim.ensemble', 'scadasim.benchmark', 'scadasim.eventloop', 'scadasim.loadgen', 'scadasim.events', 'tests'],
+      extras_require={'vectorized': ['numpy'], 'historian': ['numpy']},
       zip_safe=False)
 
@@ -0,0 +1,29 @@
+import os
+
+from scadasim import benchmark
+from scadasim.benchmark import generate, run_benchmark, run_suite, percentiles
+from scadasim.utils import load_yml_string, build_simulation
+
+def test_generators():
+    for shape, devices, partitions in [('chain', 31, 1), ('tree', 31, 1), ('mesh', 58, 1), ('plcs', 40, 10)]:
+        simulation = build_simulation(load_yml_string(generate(shape, 10)))
+        assert len(simulation['devices']) == devices
+        assert len(simulation['partitions']) == partitions
+        assert sum(len(plc['sensors']) for plc in simulation['plcs'].values()) == len(simulation['sensors'])
+
+def test_run_benchmark(tmpdir):
+    path = tmpdir.join('chain.yml')
+    path.write(generate('chain', 5))
+    result = run_benchmark(str(path), ticks=5, rpc_seconds=0.1)
+    assert result['devices'] == 16
+    assert result['ticks_per_s'] > 0
+    assert result['rpc']['reads_per_s'] > 0
+    assert set(result['tick_latency_ms']) == set(['p50', 'p90', 'p99', 'max'])
+
+def test_crashed_case(monkeypatch):
+    # The case process dies without sending a result
+    monkeypatch.setattr(benchmark.benchmark, 'run_case', lambda *case: os._exit(3))
+    assert run_suite(['chain'], [5])['results'] == [{'shape': 'chain', 'size': 5, 'error': 'exit code 3'}]
+
+def test_percentiles():
+    assert percentiles(range(1, 101)) == {'p50': 50, 'p90': 90, 'p99': 99, 'max': 100}
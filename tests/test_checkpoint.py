@@ -0,0 +1,48 @@
+import pytest
+
+from scadasim import Simulator
+from scadasim.checkpoint import Checkpoint, CheckpointError
+
+@pytest.mark.parametrize('engine', [None, 'vectorized'])
+def test_checkpoint(tmpdir, engine):
+    if engine:
+        pytest.importorskip('numpy')
+    path = str(tmpdir.join('plant.ckp'))
+    sim = Simulator(realtime=False, engine=engine)
+    sim.load_yml('tests/test_water_plant.yml')
+    sim.run_until(10)
+    sim.write_sensors({'sensor4': False})
+    sim.plcs = {'plc1': {'registered': True, 'sensors': {}}}
+    sim.checkpoint(path)
+    sim.run_until(20)
+
+    # Forks of the checkpoint carry on exactly like the original run
+    checkpoint = Checkpoint.read(path)
+    for _ in range(2):
+        fork = Simulator(realtime=False, engine=engine)
+        fork.load_yml('tests/test_water_plant.yml')
+        fork.plcs = {'plc1': {'registered': False, 'sensors': {}}}
+        fork.restore(checkpoint)
+        assert fork.now() == 10
+        assert fork.devices['tank1'].volume == 10
+        assert fork.read_sensors(sensors=['sensor1', 'sensor4']) == [10, [990, True]]
+        assert fork.plcs['plc1']['registered']
+        assert fork.devices['reservoir1'].fluid.ph == sim.devices['reservoir1'].fluid.ph
+        assert fork.devices['tank1'].ph == sim.devices['reservoir1'].ph
+
+        fork.run_until(20)
+        assert fork.snapshot == sim.snapshot
+        assert fork.devices['tank1'].volume == sim.devices['tank1'].volume
+
+def test_checkpoint_step_size(tmpdir):
+    path = str(tmpdir.join('plant.ckp'))
+    sim = Simulator(realtime=False)
+    sim.load_yml('tests/test_water_plant.yml')
+    sim.checkpoint(path)
+
+    other = Simulator(realtime=False, step_size=2)
+    other.load_yml('tests/test_water_plant.yml')
+    with pytest.raises(CheckpointError):
+        other.restore(path)
+    with pytest.raises(CheckpointError):
+        other.restore('tests/test_water_plant.yml')
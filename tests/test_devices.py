@@ -1,5 +1,7 @@
+import pytest
+from scadasim import Simulator
 from scadasim.fluids import Water
-from scadasim.devices import Valve, Pump, Tank, Reservoir
+from scadasim.devices import Valve, Pump, Tank, Reservoir, split_volume
 
 import time
 
@@ -36,3 +38,129 @@ def test_devices():
     pump1.worker_frequency=None
 
     assert reservoir1.fluid == tank2.fluid
+
+def test_flow_paths():
+    water = Water()
+    reservoir1 = Reservoir(label="Reservoir1", fluid=water, volume=100)
+    tank2 = Tank(label="Tank2")
+    tank3 = Tank(label="Tank3")
+    pump1 = Pump(label="Pump1", state='on')
+    valve1 = Valve(label="Valve1", state='open')
+
+    reservoir1.add_output(pump1)
+    pump1.add_output(valve1)
+    valve1.add_output(tank2)
+
+    pump1.worker()
+    assert tank2.volume == 1
+
+    # Closing the valve invalidates the cached paths
+    valve1.write_state(False)
+    pump1.worker()
+    assert tank2.volume == 1
+    assert reservoir1.volume == 99
+
+    # So does adding a connection
+    pump1.add_output(tank3)
+    pump1.worker()
+    assert tank3.volume == 1
+    assert tank3.fluid is water
+
+def test_flow_versions():
+    valve1 = Valve(label="Valve1", state='open')
+    pump1 = Pump(label="Pump1")
+    valve2 = Valve(label="Valve2", state='open')
+    valve1.add_output(pump1)
+    version = pump1.flow_version()
+    assert valve1.flow_version() is version
+
+    # Only changes of a gate of the same graph count
+    states = version.states
+    valve1.write_state(True)
+    valve2.write_state(False)
+    assert version.states == states
+    valve1.write_state(False)
+    assert version.states == states + 1
+
+    # Connecting the graphs merges their versions, out of date for the caches of both
+    connections = version.connections
+    pump1.add_output(valve2)
+    assert valve2.flow_version() is pump1.flow_version()
+    assert pump1.flow_version().connections > connections
+
+def test_split_volume():
+    assert split_volume(1, [None, None]) == [0.5, 0.5]
+    assert split_volume(1, [3, None]) == [0.5, 0.5]
+    assert split_volume(1, [0.75, 0.5]) == [0.6, 0.4]
+    assert split_volume(1, [0.25, 0.25]) == [0.25, 0.25]
+    assert split_volume(1, [None]) == [1]
+
+    # Pushing through a valve splits the volume instead of copying it into every output
+    valve = Valve(state='open')
+    tanks = [Tank(), Tank(max_volume=0.2)]
+    for tank in tanks:
+        valve.add_output(tank)
+    assert valve.input(Water(), 1) == 0.7
+    assert sorted(tank.volume for tank in tanks) == [0.2, 0.5]
+
+@pytest.mark.parametrize('engine', [None, 'vectorized'])
+def test_capacities(tmpdir, engine):
+    if engine:
+        pytest.importorskip('numpy')
+    path = tmpdir.join('manifold.yml')
+    path.write("""
+settings:
+  speed: 1
+
+devices:
+  - !reservoir
+    label: reservoir1
+    volume: 100
+    fluid: !water {}
+  - !pump
+    label: pump1
+    state: 'on'
+  - !valve
+    label: valve1
+    state: 'open'
+    capacity: 0.75
+  - !valve
+    label: valve2
+    state: 'open'
+    capacity: 0.25
+  - !tank
+    label: tank1
+  - !tank
+    label: tank2
+    max_volume: 2
+
+connections:
+  reservoir1:
+    outputs:
+     - pump1
+  pump1:
+    outputs:
+     - valve1
+     - valve2
+  valve1:
+    outputs:
+     - tank1
+  valve2:
+    outputs:
+     - tank2
+
+sensors:
+  - !volume
+    label: tank2sensor
+    connected_to: tank2
+""")
+    sim = Simulator(realtime=False, engine=engine)
+    sim.load_yml(str(path))
+    sim.run_until(12)
+
+    reservoir, tank1, tank2 = [sim.devices[label] for label in ('reservoir1', 'tank1', 'tank2')]
+    ticks = tank1.volume / 0.75
+    assert ticks >= 10 and abs(ticks - round(ticks)) < 1e-9
+    # tank2 is full, what it refuses stays in the reservoir
+    assert abs(tank2.volume - 2) < 1e-9
+    assert abs(reservoir.volume + tank1.volume + tank2.volume - 100) < 1e-9
@@ -0,0 +1,21 @@
+import pytest
+pytest.importorskip('numpy')
+
+from scadasim import Simulator
+
+def test_vectorized_engine():
+    sims = [Simulator(realtime=False), Simulator(realtime=False, engine='vectorized')]
+
+    for sim in sims:
+        sim.load_yml('default_config.yml')
+        sim.run_until(20)
+        sim.devices['valve1'].write_state(False)
+        sim.run_until(30)
+
+    # Pumps move fluid simultaneously in the engine, so compare once the flow has settled
+    plain, vectorized = sims
+    for label in ['reservoir1', 'chlorinator', 'municipaltank', 'chlorinetank']:
+        assert plain.devices[label].volume == vectorized.devices[label].volume
+
+    assert vectorized.devices['municipaltank'].fluid is vectorized.devices['reservoir1'].fluid
+    assert vectorized.sensors['valve1sensor'].read_sensor() is False
@@ -0,0 +1,33 @@
+from scadasim import Simulator
+from scadasim.ensemble import sweep, run_ensemble
+
+def test_sweep():
+    variants = sweep({'valve2.state': [True, False], 'sensor4': [(5, False)]})
+    assert [variant['name'] for variant in variants] == ['sensor4=(5, False),valve2.state=True',
+                                                         'sensor4=(5, False),valve2.state=False']
+    assert variants[1]['fields'] == {'valve2.state': False}
+    assert variants[1]['writes'] == [(5, {'sensor4': False})]
+
+def test_run_ensemble(tmpdir):
+    variants = [{'name': 'open'},
+                {'name': 'closed', 'fields': {'valve2.state': False}},
+                {'name': 'closing', 'writes': [(5, {'sensor4': False})]},
+                {'name': 'broken', 'fields': {'valve9.state': False}}]
+    for processes in (1, 2):
+        ensemble = run_ensemble('tests/test_water_plant.yml', variants, until=10, sensors=['sensor2', 'sensor4'],
+                                sample_every=5, processes=processes)
+        assert ensemble['names'] == ['open', 'closed', 'closing', 'broken']
+        assert ensemble['final']['sensor2'] == [10, 0, 5, None]
+        assert ensemble['final']['sensor4'] == [True, False, False, None]
+        assert ensemble['results'][2]['series'] == {'time': [0, 5, 10], 'sensor2': [0, 5, 5], 'sensor4': [True, True, False]}
+        assert 'KeyError' in ensemble['results'][3]['error']
+
+    # Runs can start from a checkpoint
+    sim = Simulator(realtime=False)
+    sim.load_yml('tests/test_water_plant.yml')
+    sim.run_until(20)
+    path = str(tmpdir.join('plant.ckp'))
+    sim.checkpoint(path)
+    ensemble = run_ensemble('tests/test_water_plant.yml', variants[:2], until=30, sensors=['sensor2'],
+                            processes=1, checkpoint=path)
+    assert ensemble['final']['sensor2'] == [30, 20]
@@ -0,0 +1,59 @@
+import threading
+
+from scadasim import Simulator
+from scadasim.eventloop import EventLoop
+from scadasim.rpc import BinaryRPCClient
+
+def plant(loop):
+    sim = Simulator(loop=loop)
+    sim.load_yml('default_config.yml')
+    sim.settings['transports'] = ['binary']
+    sim.settings['binary'] = {'host': '127.0.0.1', 'port': 0}
+    sim.set_speed(0.1)
+    return sim
+
+def test_simulators_share_a_loop():
+    loop = EventLoop()
+    sims = [plant(loop), plant(loop)]
+    threads = threading.active_count()
+    for sim in sims:
+        sim.start()
+    # Nothing runs until the loop does, and no thread was started
+    assert threading.active_count() == threads
+    assert sims[0].snapshot.tick == 0
+
+    reads = []
+    def client():
+        # Blocking client in its own thread, served by the loop
+        connection = BinaryRPCClient(sims[1].services[0].address)
+        reads.append(connection.read_sensor('plc1', 'reservoirsensor'))
+        connection.write_sensor('plc1', 'valve1sensor', False)
+        connection.close()
+        loop.call_soon_threadsafe(sims[0].pause)
+    thread = threading.Thread(target=client)
+    thread.start()
+
+    def orchestrate():
+        while thread.is_alive():
+            yield 0.05
+        # Runs queued before the pause are dropped as they come due
+        yield 0.2
+        paused_at = sims[0].snapshot.tick
+        yield 0.5
+        results.append(paused_at == sims[0].snapshot.tick)
+    results = []
+    loop.run_until_done(loop.spawn(orchestrate()))
+    thread.join()
+
+    assert results == [True]
+    assert len(reads) == 1 and reads[0] >= sims[1].snapshot.values['reservoirsensor']
+    assert sims[1].snapshot.values['reservoirsensor'] < 1000
+    assert sims[1].snapshot.tick > 5
+    assert sims[1].snapshot.values['valve1sensor'] is False
+
+    for sim in sims:
+        sim.stop()
+    assert loop.schedulers == []
+    # Only the wake-up pipe of the loop is left
+    assert len(loop.socket_map) == 1
+    loop.close()
@@ -0,0 +1,100 @@
+import pytest
+
+from scadasim import Simulator
+from scadasim.events import InvalidEvent
+
+EVENTS = """
+events:
+  - target: sensor2
+    type: override
+    value: 500
+    at: 5
+    duration: 3
+  - target: valve1
+    type: freeze
+    at: 10
+  - target: tank1
+    type: drift
+    rate: -0.5
+    at: 20
+    duration: 4
+  - target: sensor1
+    type: delay
+    seconds: 2
+    at: 30
+    duration: 5
+"""
+
+def test_events(tmpdir):
+    path = tmpdir.join('plant.yml')
+    path.write(open('tests/test_water_plant.yml').read() + EVENTS)
+    sim = Simulator(realtime=False)
+    sim.load_yml(str(path))
+
+    # Spoofed reading, the tank itself is untouched
+    sim.run_until(6)
+    assert sim.read_sensors(sensors=['sensor2'])[1] == [500]
+    assert sim.devices['tank1'].volume == 6
+    sim.run_until(9)
+    assert sim.read_sensors(sensors=['sensor2'])[1] == [9]
+
+    # Stuck valve: the write is ignored
+    sim.run_until(12)
+    sim.write_sensors({'sensor3': False})
+    sim.run_until(14)
+    assert sim.devices['valve1'].state is True
+    assert sim.read_sensors(sensors=['sensor3'])[1] == [True]
+
+    # Leak of 0.5 per second for 4 seconds
+    sim.run_until(30)
+    assert sim.devices['tank1'].volume == 28
+
+    # Readings of 2 seconds ago
+    sim.run_until(34)
+    assert sim.read_sensors(sensors=['sensor1'])[1] == [968]
+    assert sim.devices['reservoir1'].volume == 966
+    sim.run_until(36)
+    assert sim.read_sensors(sensors=['sensor1'])[1] == [964]
+
+def test_inject():
+    sim = Simulator(realtime=False)
+    sim.load_yml('tests/test_water_plant.yml')
+    sim.step(2)
+    noise = sim.inject('sensor2', 'noise', stddev=1)
+    sim.inject('tank1', 'override', at=1, duration=1, value=100)
+    sim.step(2)
+    assert sim.devices['tank1'].volume == 101
+    assert sim.read_sensors(sensors=['sensor2'])[1] != [101]
+    sim.cancel_event(noise)
+    sim.step()
+    assert sim.read_sensors(sensors=['sensor2'])[1] == [102]
+    assert sim.events.scheduled() == []
+
+    with pytest.raises(InvalidEvent):
+        sim.inject('sensor1', 'drift')
+    with pytest.raises(InvalidEvent):
+        sim.inject('valve1', 'delay', seconds=1)
+    with pytest.raises(KeyError):
+        sim.inject('valve9', 'freeze')
+
+def test_realtime_events(monkeypatch):
+    sim = Simulator()
+    sim.load_yml('tests/test_water_plant.yml')
+    wall = [1000.0]
+    monkeypatch.setattr(sim.scheduler, 'now', lambda: wall[0])
+    sim.set_speed(2)
+    start = sim.simulation_time()
+    event = sim.inject('sensor2', 'override', at=10, value=7)
+    assert event.start == start + 10
+
+    # Devices run every 2 seconds at speed 2, so 18 seconds later it's 9 simulated seconds later
+    wall[0] += 18
+    assert sim.simulation_time() == start + 9
+    sim.events.before_tick(sim.simulation_time())
+    sim.publish_snapshot()
+    assert sim.read_sensors(sensors=['sensor2'])[1] == [0]
+    sim.set_speed(1)
+    wall[0] += 1
+    sim.events.before_tick(sim.simulation_time())
+    sim.publish_snapshot()
+    assert sim.read_sensors(sensors=['sensor2'])[1] == [7]
@@ -1,5 +1,108 @@
-from scadasim.fluids import Water
+import pytest
+import yaml
+from scadasim import Simulator
+from scadasim.fluids import Water, mix, mix_ph, acidity, acidity_ph
+from scadasim.devices import Tank
 
 def test_water():
     water = Water()
     assert isinstance(water.ph, float)
+
+def test_shared_fluids():
+    config = """
+    - !tank
+      fluid: !water {}
+    - !tank
+      fluid: !water {}
+    - !tank
+      fluid: !chlorine {}
+    """
+    tanks = yaml.load(config)
+    assert tanks[0].fluid is tanks[1].fluid
+    assert tanks[0].fluid is not tanks[2].fluid
+    # Only within one load
+    assert yaml.load(config)[0].fluid is not tanks[0].fluid
+
+def test_mix():
+    assert mix(10, 1, 20, 3) == 17.5
+    assert mix(None, 0, 20, 1) == 20
+    assert mix(10, 1, None, 1) == 10
+    assert mix_ph(7.5, 100, 7.5, 1) == 7.5
+    # Diluting a strong acid tenfold, neutralizing it with as much strong base
+    assert abs(mix_ph(3, 1, 7, 9) - 4) < 1e-3
+    assert abs(mix_ph(2, 1, 12, 1) - 7) < 1e-6
+    assert abs(acidity_ph(acidity(13.2)) - 13.2) < 1e-9
+
+@pytest.mark.parametrize('engine', [None, 'vectorized'])
+def test_mixing_tanks(tmpdir, engine):
+    if engine:
+        pytest.importorskip('numpy')
+    path = tmpdir.join('plant.yml')
+    path.write("""
+settings:
+  speed: 1
+
+devices:
+  - !reservoir
+    label: reservoir1
+    volume: 1000
+    fluid: !water {}
+    ph: 8.0
+    temperature: 20
+    salinity: 0.5
+  - !pump
+    label: pump1
+    state: 'on'
+  - !tank
+    label: acidtank
+    volume: 100
+    fluid: !chlorine {}
+    ph: 3
+    temperature: 10
+    salinity: 0
+  - !pump
+    label: pump2
+    state: 'on'
+  - !tank
+    label: tank1
+    volume: 100
+    fluid: !water {}
+    ph: 7
+    temperature: 15
+    salinity: 1
+
+connections:
+  reservoir1:
+    outputs:
+     - pump1
+  pump1:
+    outputs:
+     - tank1
+  acidtank:
+    outputs:
+     - pump2
+  pump2:
+    outputs:
+     - tank1
+
+sensors:
+  - !ph
+    label: tank1ph
+    connected_to: tank1
+""")
+    sim = Simulator(realtime=False, engine=engine)
+    sim.load_yml(str(path))
+    sim.run_until(10)
+
+    tank = sim.devices['tank1']
+    assert tank.volume == 120
+    # The tank keeps its fluid, what arrives only changes the composition
+    assert tank.fluid.fluid_type == 'water'
+    assert abs(tank.temperature - 15) < 1e-9
+    assert abs(tank.salinity - 0.875) < 1e-9
+    expected = acidity_ph((100 * acidity(7) + 10 * acidity(8) + 10 * acidity(3)) / 120)
+    assert abs(tank.ph - expected) < 1e-9
+    assert sim.read_sensors(sensors=['tank1ph'])[1] == [tank.ph]
+    # The sources keep their composition
+    assert sim.devices['reservoir1'].ph == 8.0
+    assert sim.devices['acidtank'].ph == 3
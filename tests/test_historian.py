@@ -0,0 +1,44 @@
+import pytest
+pytest.importorskip('numpy')
+
+from scadasim import Simulator
+from scadasim.historian import query, HistorianMismatch
+
+@pytest.mark.parametrize('engine', [None, 'vectorized'])
+def test_historian(tmpdir, engine):
+    sim = Simulator(realtime=False, engine=engine)
+    sim.load_yml('tests/test_water_plant.yml')
+    historian = sim.record(str(tmpdir), chunk_size=4)
+
+    sim.run_until(10)
+    historian.flush()
+    sim.run_until(12)
+
+    # Ticks 1-10 are in chunk files, 11 and 12 are still pending
+    times, values = historian.query(5, 11, columns=['sensor2', 'tank1.volume', 'pump1.state'])
+    assert list(times) == [5, 6, 7, 8, 9, 10, 11]
+    assert list(values[:, 0]) == [5, 6, 7, 8, 9, 10, 11]
+    assert list(values[:, 1]) == list(values[:, 0])
+    assert all(values[:, 2] == 1)
+
+    historian.close()
+    times, values = query(str(tmpdir), start=12)
+    assert list(times) == [12]
+    assert values.shape == (1, len(historian.columns))
+
+def test_historian_columns(tmpdir):
+    sim = Simulator(realtime=False)
+    sim.load_yml('tests/test_water_plant.yml')
+    historian = sim.record(str(tmpdir))
+    sim.run_until(3)
+    historian.close()
+
+    # The same columns carry on, other columns would be mixed up with the recorded ones
+    historian = sim.record(str(tmpdir))
+    sim.run_until(5)
+    historian.close()
+    assert list(query(str(tmpdir))[0]) == [1, 2, 3, 4, 5]
+    other = Simulator(realtime=False)
+    other.load_yml('default_config.yml')
+    with pytest.raises(HistorianMismatch):
+        other.record(str(tmpdir))
@@ -0,0 +1,32 @@
+import socket
+
+from scadasim.loadgen import plan, run_load, check
+from scadasim.utils import parse_yml
+
+def test_plan():
+    assignments = plan(parse_yml('default_config.yml')['plcs'], 3)
+    assert [assignment['plc'] for assignment in assignments] == ['chlorinatorplc', 'plc1', 'plc2']
+    assert assignments[1]['unit'] == 1
+    assert ('valve1sensor', 'c', 1) in assignments[1]['sensors']
+
+def test_run_load():
+    for protocol in ('binary', 'modbus'):
+        result = run_load('default_config.yml', clients=4, scan_rate=20, write_ratio=0.5, seconds=0.5,
+                          protocol=protocol, processes=1)
+        assert result['error_rate'] == 0, result['messages']
+        assert result['scans'] >= 20
+        assert result['operations']['read']['requests'] >= result['scans']
+        assert result['operations']['write']['requests'] > 0
+        assert set(result['operations']['read']['latency_ms']) == set(['p50', 'p90', 'p99', 'max'])
+        assert check(result) == []
+        assert check(result, max_p99_ms=0) != []
+
+def test_unreachable():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    result = run_load('default_config.yml', clients=2, scan_rate=10, seconds=0.2, address=address, processes=1)
+    assert result['connect_errors'] > 0
+    assert result['error_rate'] == 1.0
+    assert check(result)
@@ -0,0 +1,47 @@
+import pytest
+
+from scadasim import Simulator
+from scadasim.fluids import Water
+from scadasim.modbus import ModbusServer, ModbusClient, ModbusError, ILLEGAL_DATA_ADDRESS, SLAVE_DEVICE_FAILURE
+
+def test_modbus():
+    sim = Simulator(realtime=False)
+    sim.load_yml('default_config.yml')
+    sim.step(10)
+
+    service = ModbusServer(sim, host='127.0.0.1', port=0)
+    service.start()
+    try:
+        client = ModbusClient(service.address)
+
+        # plc1: pump1sensor and valve1sensor on coils 0-1, reservoirsensor on input register 0
+        assert client.read_coils(1, 0, 2) == [True, True]
+        assert client.read_input_registers(1, 0) == [990]
+        # chlorinatorplc: chlorinetanksensor and chlorinatorsensor on input registers 0-1
+        assert client.read_input_registers(2, 0, 3) == [100, 0, 0]
+
+        # Writes are applied at the next tick
+        client.write_coil(1, 1, False)
+        assert sim.devices['valve1'].state is True
+        sim.step()
+        assert sim.devices['valve1'].state is False
+        client.write_coils(1, 0, [False, True])
+        sim.step()
+        assert client.read_coils(1, 0, 2) == [False, True]
+
+        with pytest.raises(ModbusError) as e:
+            client.write_coil(1, 5, True)
+        assert e.value.code == ILLEGAL_DATA_ADDRESS
+        with pytest.raises(ModbusError) as e:
+            client.read_coils(1, 0xfffe, 5)
+        assert e.value.code == ILLEGAL_DATA_ADDRESS
+
+        # A reading that doesn't fit a register fails the request, not the connection
+        sim.snapshot = sim.snapshot._replace(values=dict(sim.snapshot.values, reservoirsensor=Water()))
+        with pytest.raises(ModbusError) as e:
+            client.read_input_registers(1, 0)
+        assert e.value.code == SLAVE_DEVICE_FAILURE
+        assert client.read_coils(1, 0, 2) == [False, True]
+        client.close()
+    finally:
+        service.stop_server()
@@ -0,0 +1,59 @@
+import json
+import time
+
+from scadasim import Simulator
+
+def test_profiling():
+    sim = Simulator(realtime=False)
+    sim.load_yml('tests/test_water_plant.yml')
+    assert sim.profile() == {}
+
+    sim.enable_profiling()
+    sim.run_until(10)
+    report = sim.profile()
+
+    assert report['ticks']['count'] == 10
+    assert report['lag']['max_s'] == 0
+    pump = report['devices']['pump1']
+    assert pump['calls'] == 10
+    assert pump['total_s'] >= pump['max_s'] > 0
+    # The pump pulls from the reservoir and pushes to the tank once per run
+    assert report['devices']['reservoir1']['outputs'] == 10
+    assert report['devices']['tank1']['inputs'] == 10
+    # and the valves along its flow paths pass the fluid on
+    assert report['devices']['valve1']['outputs'] == 10
+    assert report['devices']['valve2']['inputs'] == 10
+    assert len(sim.profile(top=2)['devices']) == 2
+
+    sim.disable_profiling()
+    assert sim.profile() == {}
+    assert sim.devices['tank1'].profile is None
+
+def test_profiling_simulations():
+    sims = [Simulator(realtime=False), Simulator(realtime=False)]
+    for sim in sims:
+        sim.load_yml('tests/test_water_plant.yml')
+        sim.enable_profiling()
+    sims[0].run_until(5)
+    sims[1].run_until(3)
+
+    # Each profiler counts the devices of its own simulation
+    assert sims[0].profile()['devices']['tank1']['inputs'] == 5
+    assert sims[1].profile()['devices']['tank1']['inputs'] == 3
+    assert len(sims[1].profile()['devices']) == len(sims[1].devices) + len(sims[1].sensors)
+
+    sims[0].disable_profiling()
+    sims[1].run_until(4)
+    assert sims[1].profile()['devices']['tank1']['inputs'] == 4
+
+def test_profile_dump(tmpdir):
+    path = str(tmpdir.join('profile.json'))
+    sim = Simulator(realtime=False)
+    sim.load_yml('tests/test_water_plant.yml')
+    sim.enable_profiling(dump_interval=0.001, dump_path=path)
+    sim.step(2)
+    time.sleep(0.01)
+    sim.step()
+
+    with open(path) as stream:
+        assert json.load(stream)['ticks']['count'] == 3
@@ -0,0 +1,69 @@
+import pytest
+from scadasim import Simulator
+
+
+def edit(tmpdir, *replacements):
+    with open('tests/test_water_plant.yml') as stream:
+        config = stream.read()
+    for old, new in replacements:
+        config = config.replace(old, new)
+    path = tmpdir.join('plant.yml')
+    path.write(config)
+    return str(path)
+
+@pytest.mark.parametrize('engine', [None, 'vectorized'])
+def test_reload(tmpdir, engine):
+    sim = Simulator(realtime=False, engine=engine)
+    sim.load_yml(edit(tmpdir))
+    sim.run_until(10)
+
+    # Close valve2 and add a sensor on the tank
+    path = edit(tmpdir, ("label: valve2\n    state: 'open'", "label: valve2\n    state: 'closed'"),
+                ("label: sensor2", "label: sensor6\n    connected_to: tank1\n  - !volume\n    label: sensor2"))
+    changes = sim.reload(path)
+    assert changes['devices'] == {'added': [], 'removed': [], 'changed': ['valve2']}
+    assert changes['sensors'] == {'added': ['sensor6'], 'removed': [], 'changed': []}
+    assert changes['connections'] == {'added': [], 'removed': []}
+
+    # Untouched devices keep their state
+    assert sim.devices['tank1'].volume == 10
+    assert sim.read_sensors(sensors=['sensor6', 'sensor4']) == [10, [10, False]]
+    sim.step(5)
+    assert sim.now() == 15
+    assert sim.devices['tank1'].volume == 10
+    assert sim.sensors['sensor6'].read_sensor() == 10
+
+    # A broken config is rejected without changing anything
+    broken = edit(tmpdir, ("connected_to: tank1", "connected_to: tank2"))
+    with pytest.raises(KeyError):
+        sim.reload(broken)
+    assert sorted(sim.sensors) == ['sensor1', 'sensor2', 'sensor3', 'sensor4', 'sensor5', 'sensor6']
+
+    # Opening valve2 again and dropping sensor6, the write queued for it is dropped
+    sim.write_sensors({'sensor6': 0})
+    changes = sim.reload(edit(tmpdir))
+    assert changes['sensors']['removed'] == ['sensor6']
+    assert 'sensor6' not in sim.snapshot.values
+    sim.step(5)
+    assert not sim.pending_writes
+    assert sim.devices['tank1'].volume == 15
+
+@pytest.mark.parametrize('engine', [None, 'vectorized'])
+def test_reload_historian(tmpdir, engine):
+    pytest.importorskip('numpy')
+    sim = Simulator(realtime=False, engine=engine)
+    sim.load_yml(edit(tmpdir))
+    sim.record(str(tmpdir.join('history')))
+    sim.run_until(5)
+
+    # pump1 is rebuilt, the historian records the new pump and engine
+    sim.reload(edit(tmpdir, ("label: pump1\n", "label: pump1\n    capacity: 2\n")))
+    sim.run_until(8)
+    sim.write_sensors({'sensor5': False})
+    sim.run_until(10)
+
+    times, values = sim.historian.query(columns=['tank1.volume', 'pump1.state'])
+    assert list(times) == range(1, 11)
+    assert list(values[:, 0]) == [1, 2, 3, 4, 5, 6, 7, 8, 8, 8]
+    assert list(values[:, 1]) == [1] * 8 + [0, 0]
+    assert sim.devices['tank1'].volume == 8
@@ -0,0 +1,75 @@
+import xmlrpclib
+import pytest
+
+from scadasim import Simulator
+from scadasim.rpc import BulkRPCServer, BinaryRPCServer, BinaryRPCClient, ProtocolError
+
+def test_bulk_rpc():
+    sim = Simulator(realtime=False)
+    sim.load_yml('default_config.yml')
+    sim.step(10)
+
+    service = BulkRPCServer(sim, rpc_ip='127.0.0.1', rpc_port=0)
+    service.start()
+    try:
+        client = xmlrpclib.ServerProxy('http://%s:%s' % service.address, allow_none=True)
+
+        labels = client.plc_sensors('plc1')
+        assert labels == ['pump1sensor', 'valve1sensor', 'reservoirsensor']
+
+        timestamp, values = client.read_sensors('plc1')
+        assert timestamp == 10
+        assert values == [True, True, 990]
+
+        timestamp, results = client.write_sensors({'valve1sensor': False, 'pump1sensor': False})
+        assert results == [True, True]
+        # Writes are applied at the next tick
+        assert client.read_sensors(None, ['valve1sensor'])[1] == [True]
+        sim.step()
+
+        timestamp, values = client.read_sensors(None, ['valve1sensor', 'pump1sensor'])
+        assert values == [False, False]
+    finally:
+        service.stop_server()
+        service.join()
+
+def test_binary_rpc():
+    sim = Simulator(realtime=False)
+    sim.load_yml('default_config.yml')
+    sim.step(10)
+
+    service = BinaryRPCServer(sim, host='127.0.0.1', port=0)
+    service.start()
+    try:
+        client = BinaryRPCClient(service.address)
+
+        assert client.read_sensor('plc1', 'reservoirsensor') == 990
+        assert client.timestamp == 10
+        assert client.read_sensors('plc1') == [True, True, 990]
+        assert client.write_sensor('plc1', 'valve1sensor', False) is True
+        assert client.write_sensors({'pump1sensor': False}) == [True]
+        sim.step()
+        assert client.read_sensors(sensors=['valve1sensor', 'pump1sensor']) == [False, False]
+
+        with pytest.raises(ProtocolError):
+            client.read_sensor('plc1', 'valve2sensor')
+        # The connection stays usable after an error
+        assert client.read_sensor('plc2', 'valve2sensor') is True
+        client.close()
+    finally:
+        service.stop_server()
+
+def test_start_pause():
+    sim = Simulator(realtime=False)
+    sim.load_yml('default_config.yml')
+    sim.settings['transports'] = ['binary']
+    sim.settings['binary'] = {'host': '127.0.0.1', 'port': 0}
+
+    sim.start()
+    client = BinaryRPCClient(sim.services[0].address)
+    sim.step(5)
+    assert client.read_sensor('plc1', 'reservoirsensor') == 995
+    client.close()
+    sim.pause()
+
+    assert not sim.services
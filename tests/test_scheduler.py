@@ -0,0 +1,36 @@
+from scadasim.devices import Device
+from scadasim.scheduler import Scheduler
+
+import time
+
+class CountingDevice(Device):
+
+    def __init__(self, **kwargs):
+        self.count = 0
+        super(CountingDevice, self).__init__(device_type='valve', **kwargs)
+
+    def worker(self):
+        self.count += 1
+
+def test_scheduler():
+    scheduler = Scheduler()
+    # A failing hook doesn't stop the ticks
+    scheduler.before_tick.append(lambda: 1 / 0)
+    devices = [CountingDevice(label="Device%s" % i, worker_frequency=0.1) for i in range(100)]
+
+    for device in devices:
+        device.scheduler = scheduler
+        device.activate()
+
+    time.sleep(1)
+
+    for device in devices:
+        device.deactivate()
+
+    counts = [device.count for device in devices]
+    time.sleep(0.3)
+    scheduler.stop()
+
+    assert min(counts) >= 5
+    # Nothing runs once deactivated
+    assert counts == [device.count for device in devices]
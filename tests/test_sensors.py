@@ -1,6 +1,6 @@
 from scadasim.fluids import Water
 from scadasim.devices import Valve, Pump, Tank, Reservoir
-from scadasim.sensors import pHSensor
+from scadasim.sensors import Sensor, pHSensor, VolumeSensor, StateSensor
 
 import time
 
@@ -43,3 +43,31 @@ def test_sensors():
     assert reservoir1.fluid.ph == phsensor.read_sensor()
 
 
+
+def test_change_driven_sensors():
+    tank1 = Tank(label="Tank1")
+    valve1 = Valve(label="Valve1")
+    volumesensor = VolumeSensor(label="VolumeSensor")
+    statesensor = StateSensor(label="StateSensor")
+    volumesensor.monitor_device(tank1)
+    statesensor.monitor_device(valve1)
+
+    changes = []
+    class Observer(object):
+        def device_changed(self, device, name):
+            changes.append((device, name))
+    volumesensor.add_observer(Observer())
+    statesensor.add_observer(Observer())
+
+    # No worker loop needed to follow the monitored devices, polled sensors still get one
+    assert volumesensor.worker_frequency is None
+    assert statesensor.worker_frequency is None
+    class PolledSensor(Sensor):
+        change_driven = False
+    assert PolledSensor(label="PolledSensor").worker_frequency == 1
+    tank1.volume = 5
+    valve1.open()
+    valve1.open()
+
+    assert volumesensor.read_sensor() == 5
+    assert changes == [(volumesensor, 'volume'), (statesensor, 'state')]
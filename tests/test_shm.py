@@ -0,0 +1,63 @@
+import pytest
+
+from scadasim import Simulator
+from scadasim.shm import SharedStateReader
+
+@pytest.mark.parametrize('engine', [None, 'vectorized'])
+def test_shared_state(tmpdir, engine):
+    if engine:
+        pytest.importorskip('numpy')
+    sim = Simulator(realtime=False, engine=engine)
+    sim.load_yml('tests/test_water_plant.yml')
+    path = str(tmpdir.join('scadasim'))
+    sim.share_state(path)
+
+    reader = SharedStateReader(path)
+    assert reader.read_value('sensor2') == [0, 0]
+
+    sim.run_until(10)
+    assert reader.read(['sensor2', 'tank1.volume', 'pump1.state']) == [10, 10, [10, 10, 1]]
+
+    now, tick, values = reader.read()
+    assert len(values) == len(reader.labels)
+    assert values[reader.slots['sensor2']] == 10
+
+    reader.close()
+    sim.shared_state.close()
+
+def test_shared_state_events(tmpdir):
+    sim = Simulator(realtime=False)
+    sim.load_yml('tests/test_water_plant.yml')
+    path = str(tmpdir.join('scadasim'))
+    sim.share_state(path)
+    reader = SharedStateReader(path)
+    sim.run_until(2)
+
+    # Perturbed readings are published, and the real one again once the event ends
+    sim.inject('sensor3', 'override', duration=2, value=7)
+    sim.step()
+    assert reader.read_value('sensor3') == [3, 7]
+    sim.run_until(6)
+    assert reader.read_value('sensor3') == [6, 1]
+
+    reader.close()
+    sim.shared_state.close()
+
+def test_shared_state_immediate(tmpdir):
+    sim = Simulator()
+    sim.load_yml('tests/test_water_plant.yml')
+    sim.set_actuation('immediate')
+    sim.set_speed(60)
+    sim.devices['valve2'].close()
+    path = str(tmpdir.join('scadasim'))
+    sim.share_state(path)
+    reader = SharedStateReader(path)
+    sim.activate()
+
+    # Readers see the effect of a write actuated at once before the next tick
+    sim.write_sensors({'sensor4': True})
+    assert reader.read(['sensor2', 'sensor4', 'tank1.volume'])[2] == [1, 1, 1]
+
+    sim.scheduler.stop()
+    reader.close()
+    sim.shared_state.close()
@@ -0,0 +1,113 @@
+import pytest
+
+from scadasim import Simulator
+from scadasim.simulator import InvalidMode
+
+def test_fixed_step():
+    sim = Simulator(realtime=False)
+    sim.load_yml('tests/test_water_plant.yml')
+
+    sim.run_until(10)
+
+    assert sim.now() == 10
+    assert sim.devices['tank1'].volume == 10
+    assert sim.devices['reservoir1'].volume == 990
+    assert sim.sensors['sensor2'].read_sensor() == 10
+
+    sim.step(5)
+
+    assert sim.now() == 15
+    assert sim.devices['tank1'].volume == 15
+
+    # Devices are activated by the first step only
+    sim.devices['pump1'].deactivate()
+    sim.step()
+    assert not sim.devices['pump1'].active
+    assert sim.devices['tank1'].volume == 15
+
+def test_snapshots():
+    sim = Simulator(realtime=False)
+    sim.load_yml('tests/test_water_plant.yml')
+    sim.devices['pump1'].turn_off()
+    sim.step()
+
+    # Nothing changes while the pump is off, so the snapshot values are reused
+    values = sim.snapshot.values
+    sim.step()
+    assert sim.snapshot.values is values
+    assert sim.snapshot.tick == 2
+
+    sim.write_sensors({'sensor5': True})
+    sim.step(3)
+    assert sim.snapshot.values is not values
+    assert sim.read_sensors(sensors=['sensor2', 'sensor5']) == [5, [3, True]]
+
+def test_plc_sensors():
+    sim = Simulator(realtime=False)
+    sim.load_yml('default_config.yml')
+    sim.step(10)
+    sensors = sim.plcs['plc1']['sensors']
+
+    # The per-point PLC service reads the snapshot, not the live devices
+    sim.devices['reservoir1'].volume = 500
+    assert sensors['reservoirsensor']['read_sensor']() == 990
+
+    # and its writes wait for the next tick
+    assert sensors['valve1sensor']['write_sensor'](False) is True
+    assert sim.devices['valve1'].state is True
+    assert sensors['valve1sensor']['read_sensor']() is True
+    sim.step()
+    assert sim.devices['valve1'].state is False
+    assert sensors['valve1sensor']['read_sensor']() is False
+
+def test_partitioned():
+    single = Simulator(realtime=False)
+    single.load_yml('tests/test_two_sites.yml')
+    partitioned = Simulator(realtime=False, processes=2)
+    partitioned.load_yml('tests/test_two_sites.yml')
+    assert len(partitioned.partitions.workers) == 2
+
+    for sim in (single, partitioned):
+        sim.run_until(10)
+        sim.write_sensors({'sensor2': False, 'sensor4': False})
+        sim.run_until(20)
+
+    assert partitioned.now() == 20
+    assert partitioned.snapshot.values == single.snapshot.values
+    assert partitioned.read_sensors(sensors=['sensor1', 'sensor2']) == [20, [10, False]]
+    partitioned.partitions.close()
+
+@pytest.mark.parametrize('engine', [None, 'vectorized'])
+def test_immediate_actuation(engine):
+    if engine:
+        pytest.importorskip('numpy')
+    sim = Simulator(engine=engine)
+    sim.load_yml('tests/test_water_plant.yml')
+    sim.set_actuation('immediate')
+    sim.enable_profiling()
+    # Long periods, so only the writes move fluid during the test
+    sim.set_speed(60)
+    sim.devices['valve2'].close()
+    sim.activate()
+    assert sim.read_sensors(sensors=['sensor1', 'sensor2'])[1] == [1000, 0]
+
+    # The pump runs as soon as the valve opens, the tank reading follows before the write returns
+    sim.write_sensors({'sensor4': True})
+    assert sim.read_sensors(sensors=['sensor1', 'sensor2'])[1] == [999, 1]
+
+    # Once per period at most, later writes wait for the next run of the pump
+    sim.write_sensors({'sensor4': False})
+    sim.write_sensors({'sensor4': True})
+    assert sim.read_sensors(sensors=['sensor2', 'sensor4'])[1] == [1, True]
+
+    # Writes that change no valve or pump don't run anything
+    assert sim.actuate({'sensor4': True}) == []
+
+    actuation = sim.profile()['actuation']
+    assert actuation['count'] == 4
+    assert actuation['pumps'] == 1
+    assert 0 < actuation['max_s'] < 0.1
+    sim.scheduler.stop()
+
+    with pytest.raises(InvalidMode):
+        Simulator(realtime=False).set_actuation('immediate')
@@ -1,4 +1,5 @@
-from scadasim.utils import parse_yml, build_simulation
+from scadasim.utils import parse_yml, build_simulation, load_simulation, find_partitions
+from scadasim.utils import split_config, diff_configs
 
 def test_yml_processing():
 
@@ -20,3 +21,54 @@ def test_yml_processing():
     assert devices['valve1'].uid in devices['pump1'].inputs
     assert devices['reservoir1'].uid in devices['valve1'].inputs
     assert not devices['reservoir1'].inputs
+
+def test_simulation_cache(tmpdir):
+    config, simulation = load_simulation('tests/test_water_plant.yml', cache_dir=str(tmpdir))
+    simulation['devices']['pump1'].worker()
+    assert len(tmpdir.listdir()) == 1
+
+    # Loaded from the cache, untouched by the run above
+    config, cached = load_simulation('tests/test_water_plant.yml', cache_dir=str(tmpdir))
+    devices = cached['devices']
+    assert devices is not simulation['devices']
+    assert devices['tank1'].volume == 0
+    assert devices['pump1'].uid in devices['valve2'].inputs
+
+    devices['pump1'].worker()
+    assert devices['tank1'].volume == 1
+    assert cached['sensors']['sensor2'].read_sensor() == 1
+
+    # Configs with PLCs are cached too
+    load_simulation('default_config.yml', cache_dir=str(tmpdir))
+    config, cached = load_simulation('default_config.yml', cache_dir=str(tmpdir))
+    assert len(tmpdir.listdir()) == 2
+    assert not cached['plcs']['plc1']['registered']
+
+def test_partitions():
+    simulation = build_simulation(parse_yml('tests/test_two_sites.yml'))
+    assert simulation['partitions'] == [
+        ['pump1', 'reservoir1', 'sensor1', 'sensor2', 'tank1', 'valve1'],
+        ['pump2', 'reservoir2', 'sensor3', 'sensor4', 'tank2', 'valve2']]
+
+    # Zones keep components together
+    partitions = find_partitions(simulation['devices'], simulation['sensors'], {'site': ['tank1', 'tank2']})
+    assert len(partitions) == 1
+
+def test_diff_configs():
+    with open('tests/test_water_plant.yml') as stream:
+        old = stream.read()
+    new = old.replace("state: 'on'", "state: 'off'").replace("     - pump1\n", "     - pump1\n     - tank1\n")
+    new = new.replace("  - !state\n    label: sensor5\n    connected_to: pump1", "")
+
+    changes, nodes = diff_configs(old, new)
+    assert changes['devices'] == {'added': [], 'removed': [], 'changed': ['pump1']}
+    assert changes['sensors'] == {'added': [], 'removed': ['sensor5'], 'changed': []}
+    assert changes['connections'] == {'added': [('valve1', 'tank1')], 'removed': []}
+    assert not changes['settings']
+    # Only the entries that changed are parsed
+    assert sorted(nodes['devices']) == ['pump1']
+
+    # Configs that can't be split by their text are compared in full
+    anchored = new.replace("fluid: !water {}", "fluid: &water !water {}")
+    assert split_config(anchored) is None
+    assert diff_configs(old, anchored)[0] == changes